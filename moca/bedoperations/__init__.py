@@ -2,5 +2,8 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from .model import Bedfile
+from .index import PeakIndex
 from .fimo import fimo_to_sites
+from .fimo import iter_fimo_sites
+from .fimo import add_site_columns
 from .fimo import get_start_stop_intervals
@@ -0,0 +1,125 @@
+"""On-disk cache of parsed peak tables
+
+Each cached table is a directory with one .npy file per column
+so that it can be loaded back with memory mapped reads. Numeric
+columns of a loaded table are views of the memory maps and are
+only read from disk as they are used.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas
+from ..helpers import file_checksum
+from ..helpers import safe_makedir
+
+# Bump to invalidate caches written with an older layout
+__PEAK_CACHE_VERSION__ = 1
+
+__METADATA_FILE__ = 'metadata.json'
+__INDEX_FILE__ = 'index.npy'
+
+
+def peak_cache_location(cache_dir, bed_file, bed_format):
+    """Return the cache directory for a bed file
+
+    Parameters
+    ----------
+    cache_dir: str
+        Root directory for all cached peak tables
+    bed_file: str
+        Path to bed file
+    bed_format: str
+        Format of bed file
+
+    Returns
+    -------
+    location: str
+        Directory keyed by bed file content and format
+    """
+    key = '{}_{}_v{}'.format(file_checksum(bed_file), bed_format, __PEAK_CACHE_VERSION__)
+    return os.path.join(cache_dir, key)
+
+
+def save_peak_cache(bed_df, location, bed_format):
+    """Save a peak table to cache
+
+    The table is first written to a temporary directory which is
+    then renamed, so concurrent readers never see partial caches.
+
+    Parameters
+    ----------
+    bed_df: dataframe
+        Peak table
+    location: str
+        Cache directory as returned by `peak_cache_location`
+    bed_format: str
+        Format of bed file
+    """
+    parent_dir = safe_makedir(os.path.dirname(location))
+    temp_dir = tempfile.mkdtemp(dir=parent_dir)
+    metadata = {'bed_format': bed_format,
+                'columns': list(bed_df.columns),
+                'categories': {}}
+    for i, column in enumerate(bed_df.columns):
+        series = bed_df[column]
+        if series.dtype.name == 'category':
+            metadata['categories'][column] = [str(x) for x in series.cat.categories]
+            values = series.cat.codes.values
+        elif series.dtype.kind in ('O', 'U', 'S', 'T'):
+            values = series.values.astype(str)
+        else:
+            values = series.values
+        np.save(os.path.join(temp_dir, '{}.npy'.format(i)), values)
+    np.save(os.path.join(temp_dir, __INDEX_FILE__), bed_df.index.values)
+    with open(os.path.join(temp_dir, __METADATA_FILE__), 'w') as f:
+        json.dump(metadata, f)
+    try:
+        os.rename(temp_dir, location)
+    except OSError:
+        # Another process cached the same table first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_peak_cache(location):
+    """Load a cached peak table
+
+    Parameters
+    ----------
+    location: str
+        Cache directory as returned by `peak_cache_location`
+
+    Numeric columns are copy-on-write memory maps, changes to
+    them are private to the returned table and never reach the cache.
+
+    Returns
+    -------
+    bed_df: dataframe
+        Peak table in file order or None if not cached
+    bed_format: str
+        Format of bed file or None if not cached
+    """
+    metadata_file = os.path.join(location, __METADATA_FILE__)
+    if not os.path.isfile(metadata_file):
+        return None, None
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    columns = {}
+    for i, column in enumerate(metadata['columns']):
+        values = np.load(os.path.join(location, '{}.npy'.format(i)), mmap_mode='c')
+        if column in metadata['categories']:
+            columns[column] = pandas.Categorical.from_codes(values, metadata['categories'][column])
+        elif values.dtype.kind == 'U':
+            columns[column] = pandas.Series(values, dtype=object)
+        else:
+            columns[column] = values
+    index = np.load(os.path.join(location, __INDEX_FILE__), mmap_mode='c')
+    # One block per column, so that numeric columns are not copied
+    # into a consolidated block
+    bed_df = pandas.DataFrame(columns, columns=metadata['columns'],
+                              index=pandas.Index(index, copy=False), copy=False)
+    return bed_df, metadata['bed_format']
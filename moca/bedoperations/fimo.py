@@ -4,12 +4,41 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import numpy as np
 import pandas as pd
 from ..helpers import filename_extension
+from ..helpers import Intervals
 
+# Sequence names of extracted(and shuffled) fasta: chr:start-end[_shuf]
+__SEQUENCE_NAME_REGEX__ = r'^(?P<chrom>[^:]+):(?P<chromStart>\d+)-(?P<chromEnd>\d+)(?:_shuf)?$'
 
-def fimo_to_sites(fimo_file):
+# Columns of fimo.txt
+__FIMO_COLUMNS__ = ['#pattern name', 'sequence name', 'start', 'stop', 'strand',
+                    'score', 'p-value', 'q-value', 'matched sequence']
+
+# Dtypes of numeric fimo.txt columns, kept when there are no hits
+__FIMO_DTYPES__ = {'start': np.int64,
+                   'stop': np.int64,
+                   'score': np.float64,
+                   'p-value': np.float64,
+                   'q-value': np.float64}
+
+# Columns added by `add_site_columns`
+__SITE_DTYPES__ = [('chrom', object),
+                   ('chromStart', np.int64),
+                   ('chromEnd', np.int64),
+                   ('motifStartZeroBased', np.int64),
+                   ('motifEndOneBased', np.int64)]
+
+
+def fimo_to_sites(fimo_file, chunksize=None):
     """Convert fimo.txt to bed file
+
+    Sequence names are parsed in a vectorized manner and,
+    if `chunksize` is set, fimo.txt is processed in chunks of
+    `chunksize` hits. Use `iter_fimo_sites` to avoid holding all
+    sites in memory.
+
     fimi.txt columns:
     #pattern name:  The motif identifier
     #sequence name: The sequence identiifer
@@ -33,28 +62,106 @@ def fimo_to_sites(fimo_file):
                     See Storey JD, Tibshirani R. Statistical significance for genome-wide studies.\
                             Proc. Natl Acad. Sci. USA (2003) 100:9430-9445
     sequence:        The sequence matched to the motif.
+
+    Parameters
+    ----------
+    fimo_file: str
+        Path to fimo.txt
+    chunksize: int
+        Number of fimo hits processed at a time
+
+    Returns
+    -------
+    fimo_df: dataframe
+        fimo hits with chrom, chromStart, chromEnd, motifStartZeroBased
+        and motifEndOneBased columns. Also written to fimo.sites.txt.
+        Empty, with the same columns, if fimo found no hits
     """
     fimo_file = os.path.abspath(fimo_file)
-    fimo_df = pd.read_table(fimo_file)
     filename, ext = filename_extension(os.path.abspath(fimo_file))
     fimo_sites = os.path.join(os.path.dirname(fimo_file), '{}.sites{}'.format(filename, ext))
-    #Split chr-start:end to three columns
-    #TODO the _shuf is to handle cases coming from shuffled fasta, this can be generalised and is currently a hack
-    split_chr = lambda columnstr: pd.Series(s for s in columnstr.replace('_shuf', '').replace('-', ':').split(':'))
-    if fimo_df['sequence name'].str.contains(':|-').sum():
-        fimo_df[['chrom', 'chromStart', 'chromEnd']] = fimo_df['sequence name'].apply(split_chr)
-        fimo_df.loc[:, ['chromStart', 'chromEnd']] = fimo_df[['chromStart', 'chromEnd']].astype(int)
-        fimo_df.loc[:, 'motifStartZeroBased'] = fimo_df.chromStart+fimo_df.start-1
-        fimo_df.loc[:, 'motifEndOneBased'] = fimo_df.chromStart+fimo_df.stop
-    else:
-        fimo_df['chrom'] = fimo_df['sequence name']
-        fimo_df['chromStart'] = fimo_df['start']
-        fimo_df['chromEnd'] = fimo_df['stop']
-        fimo_df.loc[:, 'motifStartZeroBased'] = fimo_df.start-1
-        fimo_df['motifEndOneBased'] = fimo_df['stop']
-
-
-    fimo_df.to_csv(fimo_sites, index=False, sep='\t')
+    sites = []
+    with open(fimo_sites, 'w') as f:
+        for i, sites_df in enumerate(iter_fimo_sites(fimo_file, chunksize=chunksize)):
+            sites_df.to_csv(f, index=False, sep='\t', header=(i == 0))
+            sites.append(sites_df)
+        if not sites:
+            sites.append(empty_sites())
+            sites[0].to_csv(f, index=False, sep='\t')
+    return pd.concat(sites, ignore_index=True)
+
+
+def empty_sites():
+    """Return sites of a fimo run without hits
+
+    Returns
+    -------
+    fimo_df: dataframe
+        Empty dataframe with the columns and dtypes of `fimo_to_sites`
+    """
+    columns = [(column, __FIMO_DTYPES__.get(column, object)) for column in __FIMO_COLUMNS__]
+    columns += __SITE_DTYPES__
+    return pd.DataFrame({column: np.array([], dtype=dtype) for column, dtype in columns},
+                        columns=[column for column, _ in columns])
+
+
+def iter_fimo_sites(fimo_file, chunksize=None):
+    """Iterate over sites of fimo.txt in chunks
+
+    Parameters
+    ----------
+    fimo_file: str
+        Path to fimo.txt
+    chunksize: int
+        Number of fimo hits processed at a time. All hits are
+        processed at once if not set
+
+    Returns
+    -------
+    sites: generator
+        Dataframes as returned by `fimo_to_sites`, one per chunk
+    """
+    try:
+        fimo_chunks = pd.read_table(fimo_file, chunksize=chunksize, dtype=__FIMO_DTYPES__)
+    except pd.errors.EmptyDataError:
+        # fimo wrote nothing, not even a header
+        return
+    if chunksize is None:
+        fimo_chunks = [fimo_chunks]
+    for fimo_df in fimo_chunks:
+        yield add_site_columns(fimo_df)
+
+
+def add_site_columns(fimo_df):
+    """Add genomic coordinates of motif sites to fimo hits
+
+    Sequence names of the form `chr:start-end` (optionally suffixed
+    with `_shuf` for shuffled sequences) are treated as genomic
+    coordinates of the sequence, all others as standalone sequences.
+
+    Parameters
+    ----------
+    fimo_df: dataframe
+        fimo hits as read from fimo.txt
+
+    Returns
+    -------
+    fimo_df: dataframe
+        fimo hits with chrom, chromStart, chromEnd,
+        motifStartZeroBased and motifEndOneBased columns
+    """
+    parsed = fimo_df['sequence name'].astype(str).str.extract(__SEQUENCE_NAME_REGEX__, expand=True)
+    is_genomic = parsed['chrom'].notnull().values
+    start = fimo_df['start'].values.astype(np.int64)
+    stop = fimo_df['stop'].values.astype(np.int64)
+    chrom_start = np.where(is_genomic, pd.to_numeric(parsed['chromStart']).fillna(0).values, start).astype(np.int64)
+    chrom_end = np.where(is_genomic, pd.to_numeric(parsed['chromEnd']).fillna(0).values, stop).astype(np.int64)
+    offset = np.where(is_genomic, chrom_start, 0)
+    fimo_df['chrom'] = np.where(is_genomic, parsed['chrom'].values, fimo_df['sequence name'].values)
+    fimo_df['chromStart'] = chrom_start
+    fimo_df['chromEnd'] = chrom_end
+    fimo_df['motifStartZeroBased'] = offset + start - 1
+    fimo_df['motifEndOneBased'] = offset + stop
     return fimo_df
 
 def get_start_stop_intervals(fimo_file, flank_length):
@@ -69,14 +176,14 @@ def get_start_stop_intervals(fimo_file, flank_length):
 
     Returns
     -------
-    intervals: list
-        List of tuples (start, stop) where start is 0-based and stop is 1-based
+    intervals: Intervals
+        Columnar intervals (chrom, start, stop, strand) where start is 0-based and stop is 1-based.
+        Iterating over it yields tuples.
 
     """
 
     fimo_sites = fimo_to_sites(fimo_file)
-    subset = fimo_sites.loc[:, ['chrom', 'motifStartZeroBased', 'motifEndOneBased', 'strand']]
-    subset.loc[:, 'motifStartZeroBased'] = subset['motifStartZeroBased'] - flank_length
-    subset.loc[:, 'motifEndOneBased'] = subset['motifEndOneBased'] + flank_length
-    intervals = [tuple(x) for x in subset.to_records(index=False)]
-    return intervals
+    return Intervals.from_arrays(fimo_sites['chrom'].values,
+                                 fimo_sites['motifStartZeroBased'].values - flank_length,
+                                 fimo_sites['motifEndOneBased'].values + flank_length,
+                                 fimo_sites['strand'].values)
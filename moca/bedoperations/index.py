@@ -0,0 +1,136 @@
+"""Interval index over peaks for vectorized overlap queries"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+import numpy as np
+import pandas
+
+
+def _group_by_chrom(chroms):
+    """Return chromosome names and row positions grouped by chromosome
+
+    Parameters
+    ----------
+    chroms: array_like
+        Chromosome of each row
+
+    Returns
+    -------
+    groups: list
+        List of (chrom, rows) tuples
+    """
+    categorical = pandas.Categorical(np.asarray(chroms).astype(str))
+    codes = categorical.codes
+    order = np.argsort(codes, kind='mergesort')
+    boundaries = np.searchsorted(codes[order], np.arange(len(categorical.categories)+1))
+    return [(chrom, order[boundaries[i]:boundaries[i+1]])
+            for i, chrom in enumerate(categorical.categories)]
+
+
+class PeakIndex(object):
+    """Per chromosome sorted arrays of peak intervals and summits
+
+    Queries are answered with `np.searchsorted` and
+    are vectorized over all queried intervals.
+
+    Parameters
+    ----------
+    chroms: array_like
+        Chromosome of each peak
+    starts: array_like
+        0-based start of each peak
+    ends: array_like
+        1-based end of each peak
+    summits: array_like
+        0-based summit position of each peak
+    """
+    def __init__(self, chroms, starts, ends, summits):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        summits = np.asarray(summits, dtype=np.int64)
+        self.intervals = {}
+        self.summits = {}
+        for chrom, rows in _group_by_chrom(chroms):
+            order = np.argsort(starts[rows], kind='mergesort')
+            rows = rows[order]
+            chrom_ends = ends[rows]
+            # Running maximum of ends (and the row achieving it) lets
+            # us detect overlaps with peaks that start early but span long
+            max_ends = np.maximum.accumulate(chrom_ends)
+            positions = np.arange(len(rows))
+            max_positions = np.maximum.accumulate(np.where(chrom_ends == max_ends, positions, 0))
+            self.intervals[chrom] = (starts[rows], chrom_ends, max_ends, rows[max_positions], rows)
+            order = np.argsort(summits[rows], kind='mergesort')
+            self.summits[chrom] = (summits[rows][order], rows[order])
+
+    def overlaps(self, chroms, starts, ends):
+        """Find a peak overlapping each interval
+
+        Parameters
+        ----------
+        chroms: array_like
+            Chromosome of each interval
+        starts: array_like
+            0-based start of each interval
+        ends: array_like
+            1-based end of each interval
+
+        Returns
+        -------
+        peaks: np.array
+            Row position of an overlapping peak for each interval, -1 if none.
+            The overlapping peak starting last is preferred.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        peaks = np.full(len(starts), -1, dtype=np.int64)
+        for chrom, rows in _group_by_chrom(chroms):
+            if chrom not in self.intervals:
+                continue
+            peak_starts, peak_ends, max_ends, max_rows, peak_rows = self.intervals[chrom]
+            query_starts = starts[rows]
+            # Last peak starting before the end of interval
+            candidates = np.searchsorted(peak_starts, ends[rows], side='left') - 1
+            valid = candidates >= 0
+            candidates = np.where(valid, candidates, 0)
+            direct = valid & (peak_ends[candidates] > query_starts)
+            spanning = valid & ~direct & (max_ends[candidates] > query_starts)
+            matched = np.full(len(rows), -1, dtype=np.int64)
+            matched[direct] = peak_rows[candidates[direct]]
+            matched[spanning] = max_rows[candidates[spanning]]
+            peaks[rows] = matched
+        return peaks
+
+    def nearest_peak(self, chroms, positions):
+        """Find the peak with summit closest to each position
+
+        Parameters
+        ----------
+        chroms: array_like
+            Chromosome of each position
+        positions: array_like
+            0-based positions
+
+        Returns
+        -------
+        peaks: np.array
+            Row position of nearest peak, -1 if chromosome has no peaks
+        distances: np.array
+            Signed distance (position - summit), NaN if chromosome has no peaks
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        peaks = np.full(len(positions), -1, dtype=np.int64)
+        distances = np.full(len(positions), np.nan)
+        for chrom, rows in _group_by_chrom(chroms):
+            if chrom not in self.summits:
+                continue
+            summits, summit_rows = self.summits[chrom]
+            query = positions[rows]
+            right = np.clip(np.searchsorted(summits, query), 0, len(summits)-1)
+            left = np.clip(right - 1, 0, len(summits)-1)
+            use_left = np.abs(query - summits[left]) <= np.abs(query - summits[right])
+            nearest = np.where(use_left, left, right)
+            peaks[rows] = summit_rows[nearest]
+            distances[rows] = query - summits[nearest]
+        return peaks, distances
@@ -4,10 +4,16 @@ from __future__ import absolute_import
 from builtins import object
 import os
 from moca.helpers import MocaException
-from moca.helpers import make_uppercase_fasta
+from moca.helpers import IndexedFasta
+from moca.helpers import is_gzipped
 from moca.helpers import path_leaf
+from moca.helpers import strip_gz_extension
+from moca.helpers import write_fasta_record
+from .cache import load_peak_cache
+from .cache import peak_cache_location
+from .cache import save_peak_cache
+from .index import PeakIndex
 import pandas
-from pybedtools import BedTool
 import numpy as np
 
 __NARROWPEAK_COLUMNS__ = ['chrom', 'chromStart', 'chromEnd',
@@ -28,6 +34,51 @@ __BED_COLUMN_MAPPING__ = {9: __NARROWPEAK_COLUMNS__,
                           10: __BROADPEAK_COLUMNS__,
                           5: __MACSPEAK_COLUMNS__}
 
+# Compact dtypes used while loading peak files. `score` is left out
+# as it is an integer for ENCODE narrowPeaks but a float for MACS peaks
+# and is hence inferred from the first few rows of the file.
+__BED_DTYPES__ = {'chrom': 'category',
+                  'chromStart': np.int32,
+                  'chromEnd': np.int32,
+                  'name': object,
+                  'strand': 'category',
+                  'signalValue': np.float32,
+                  'p-value': np.float32,
+                  'q-value': np.float32,
+                  'peak': np.int32}
+
+# Peaks are ranked by descending score, ties are broken by position
+__SORT_COLUMNS__ = ['score', 'chrom', 'peakStartZeroBased']
+__SORT_ASCENDING__ = [False, True, True]
+
+# Columns written to score files
+__SCOREFILE_COLUMNS__ = ['chrom', 'peakStartZeroBased',
+                         'peakEndOneBased', 'name', 'score']
+
+# Number of rows read to infer the layout of a bed file
+__SNIFF_ROWS__ = 100
+
+
+def read_genome_table(genome_table):
+    """Read chromosome sizes from a genome table
+
+    Parameters
+    ----------
+    genome_table: string
+        Path to tab separated chromosome size file
+
+    Returns
+    -------
+    chrom_sizes: dict
+        Dictionary with {"chr": length} format
+    """
+    try:
+        genome_df = pandas.read_table(genome_table, header=None,
+                                      usecols=[0, 1], dtype={0: str, 1: np.int64})
+    except Exception as e:
+        raise MocaException('Error reading genome table {}\n Traceback: {}'.format(genome_table, e))
+    return dict(zip(genome_df[0], genome_df[1]))
+
 
 class Bedfile(object):
     """Class to crate a bed file object
@@ -35,15 +86,24 @@ class Bedfile(object):
     Parameters
     ----------
     filepath: string
-        Absolute path to bedfile
+        Absolute path to bedfile, optionally gzip or bgzip compressed
 
     genome_table: string
         Absolute path to geonme chromosome size file
 
     output_dir: string
         Output directory
+
+    cache_dir: string
+        Directory to cache parsed and sorted peaks in. Peaks
+        are parsed afresh if not set
+
+    keep_intermediates: bool
+        Write sorted, train and test score files to `output_dir`.
+        If False, these are passed around as dataframes instead
     """
-    def __init__(self, filepath, genome_table, output_dir=None):
+    def __init__(self, filepath, genome_table, output_dir=None, cache_dir=None,
+                 keep_intermediates=True):
         self.filepath = os.path.abspath(filepath)
         if not output_dir:
             output_dir = os.path.dirname(self.filepath)
@@ -51,30 +111,85 @@ class Bedfile(object):
         self.bed_format = None
         self.extracted_fasta = None
         self.bed = None
+        self.bed_df = None
         if not os.path.isfile(self.filepath):
             raise MocaException('Bed file {} not found'.format(self.filepath))
-        self._read()
-        self.bed_format = self.guess_bedformat()
-        self.total_peaks = self._count_peaks()
+        self.compression = None
+        if is_gzipped(self.filepath):
+            self.compression = 'gzip'
+        self.cache_dir = cache_dir
+        self.keep_intermediates = keep_intermediates
         self.train_peaks_count = None
         self.test_peaks_count = None
         self.genome_table = os.path.abspath(genome_table)
-        assert self.bed_format is not None
-        self._determine_peaks()
-        self._sort_bed()
-        self.write_to_scorefile(self.bed_df)
-
-    def _count_peaks(self):
-        with open(self.filepath) as f:
-            for i, l in enumerate(f):
-                pass
-        return i + 1
-
-    def _read(self):
+        self._chrom_sizes = None
+        self._peak_index = None
+        self._peak_ranks = None
+        columns, dtypes = self._sniff()
+        cache_location = None
+        if self.cache_dir:
+            cache_location = peak_cache_location(self.cache_dir, self.filepath,
+                                                 __BED_TYPES__[len(columns)])
+            self.bed_df, self.bed_format = load_peak_cache(cache_location)
+        if self.bed_df is None:
+            self._read(columns, dtypes)
+            self.bed_format = self.guess_bedformat()
+            assert self.bed_format is not None
+            self._determine_peaks()
+            if cache_location:
+                save_peak_cache(self.bed_df, cache_location, self.bed_format)
+        self.total_peaks = len(self.bed_df.index)
+        if self.keep_intermediates:
+            # Peaks are otherwise kept in file order, `top_peaks` ranks only those needed
+            self._sort_bed()
+            self.write_to_scorefile(self.bed_df)
+
+    def _sniff(self):
+        """Infer column names and dtypes from the first few rows
+
+        Returns
+        -------
+        columns: list
+            Column names for the detected bed layout
+        dtypes: dict
+            Mapping of column name to dtype to be used while reading
+        """
+        try:
+            sniffed_df = pandas.read_table(self.filepath, header=None, nrows=__SNIFF_ROWS__,
+                                           compression=self.compression)
+        except Exception as e:
+            raise MocaException('Error reading bed file {}\n Traceback: {}'.format(self.filepath, e))
+        count = len(sniffed_df.columns)
+        try:
+            columns = __BED_COLUMN_MAPPING__[count]
+        except KeyError:
+            raise MocaException('Bed file had {} columns. Supported column lengths are 5,9 or 10'.format(count))
+        dtypes = {column: __BED_DTYPES__[column] for column in columns if column in __BED_DTYPES__}
+        if np.issubdtype(sniffed_df[columns.index('score')].dtype, np.integer):
+            dtypes['score'] = np.int32
+        else:
+            dtypes['score'] = np.float32
+        return columns, dtypes
+
+    def _read(self, columns, dtypes):
         """ Read bedfile as a pandas dataframe
+
+        The file is read in a single pass with compact dtypes
+        (categorical chromosomes, int32 coordinates and float32 scores)
+        inferred from its first few rows. Compressed files are
+        decompressed on the fly.
+
+        Parameters
+        ----------
+        columns: list
+            Column names as returned by `_sniff`
+        dtypes: dict
+            Column dtypes as returned by `_sniff`
         """
         try:
-            self.bed_df = pandas.read_table(self.filepath, header=None)
+            self.bed_df = pandas.read_table(self.filepath, header=None,
+                                            names=columns, dtype=dtypes,
+                                            compression=self.compression)
         except Exception as e:
             raise MocaException('Error reading bed file {}\n Traceback: {}'.format(self.filepath, e))
 
@@ -103,7 +218,71 @@ class Bedfile(object):
     def _sort_bed(self):
         """Sort bed by default in descending order of scores
         """
-        return self.sort_by(columns=['score', 'chrom', 'peakStartZeroBased'], ascending=[False, True, True])
+        return self.sort_by(columns=__SORT_COLUMNS__, ascending=__SORT_ASCENDING__)
+
+    def top_peaks(self, peaks_count):
+        """Return the top ranked peaks without sorting all of them
+
+        Peaks are ranked in the same order as `_sort_bed`, i.e.
+        descending scores with ties broken by chromosome and position.
+        Peaks scoring above the `peaks_count`-th best peak are selected
+        (in linear time), the remaining places are filled from the peaks
+        tied with it by position and only the selected peaks are sorted.
+
+        Parameters
+        ----------
+        peaks_count: int
+            Number of top peaks to return
+
+        Returns
+        -------
+        top_bed_df: dataframe
+            Dataframe with `peaks_count` top ranked peaks in sorted order
+        """
+        peaks_count = min(int(peaks_count), self.total_peaks)
+        if peaks_count <= 0:
+            return self.bed_df.iloc[:0]
+        scores = self.bed_df['score'].values
+        kth = self.total_peaks - peaks_count
+        threshold = np.partition(scores, kth)[kth]
+        selected = np.flatnonzero(scores > threshold)
+        # Scores are often capped, so the tied peaks can be most of the file
+        ties = np.flatnonzero(scores == threshold)
+        selected = np.concatenate([selected, self._first_by_position(ties, peaks_count - len(selected))])
+        top_bed_df = self.bed_df.iloc[np.sort(selected)]
+        return top_bed_df.sort_values(by=__SORT_COLUMNS__,
+                                      ascending=__SORT_ASCENDING__,
+                                      kind='mergesort')
+
+    def _first_by_position(self, rows, count):
+        """Return the first `count` of `rows` by chromosome and position
+
+        Peaks at the same position are taken in file order,
+        as in a stable sort.
+
+        Parameters
+        ----------
+        rows: np.array
+            Ascending row numbers of `bed_df`
+        count: int
+            Number of rows to return
+
+        Returns
+        -------
+        first_rows: np.array
+            Row numbers in no particular order
+        """
+        if count >= len(rows):
+            return rows
+        if count <= 0:
+            return rows[:0]
+        chrom_codes = pandas.Categorical(self.bed_df['chrom'].values[rows]).codes.astype(np.int64)
+        starts = self.bed_df['peakStartZeroBased'].values[rows].astype(np.int64)
+        keys = chrom_codes * (starts.max() + 1) + starts
+        kth_key = np.partition(keys, count - 1)[count - 1]
+        first_rows = rows[keys < kth_key]
+        equal_rows = rows[keys == kth_key]
+        return np.concatenate([first_rows, equal_rows[:count - len(first_rows)]])
 
     def split_train_test_bed(self, train_peaks_count=500,
                              test_peaks_count=500,
@@ -123,58 +302,126 @@ class Bedfile(object):
         test_peaks_count: int
             Count of testing peaks
 
+        Returns
+        -------
+        train_bed, test_bed: string or dataframe
+            Paths to train and test score files or score
+            dataframes if `keep_intermediates` is not set
         """
         if train_peaks_count >= self.total_peaks:
             train_peaks_count = np.floor(self.total_peaks/2)
         if test_peaks_count >= self.total_peaks:
             test_peaks_count = np.ceil(self.total_peaks/2)
-        self._determine_peaks()
-        self._sort_bed()
+        train_peaks_count = int(train_peaks_count)
+        test_peaks_count = int(test_peaks_count)
+        top_bed_df = self.top_peaks(train_peaks_count + test_peaks_count)
+
+        self.train_bed_df = top_bed_df[:train_peaks_count]
+        self.test_bed_df = top_bed_df[train_peaks_count:]
 
-        self.train_bed_df = self.bed_df[:min(int(train_peaks_count), self.total_peaks)]
-        self.test_bed_df = self.bed_df[min(int(test_peaks_count), self.total_peaks):]
+        if not self.keep_intermediates:
+            return self.to_score_df(self.train_bed_df), self.to_score_df(self.test_bed_df)
 
         self.train_bed_file = self.write_to_scorefile(self.train_bed_df, out_suffix='train')
         self.test_bed_file = self.write_to_scorefile(self.test_bed_df, out_suffix='test')
 
         return self.train_bed_file, self.test_bed_file
 
+    @staticmethod
+    def to_score_df(bed_df):
+        """Return peaks in score file layout
+
+        Parameters
+        ----------
+        bed_df: dataframe
+            Peaks with determined peak positions
+
+        Returns
+        -------
+        score_df: dataframe
+            Dataframe with chrom, peakStartZeroBased, peakEndOneBased, name and score columns
+        """
+        return bed_df.loc[:, __SCOREFILE_COLUMNS__].reset_index(drop=True)
+
     def write_to_scorefile(self, bed_df, out_suffix='sorted'):
         """Write bed file as score file
 
         """
-        file_path, file_extension = os.path.splitext(self.filepath)
+        file_path, file_extension = os.path.splitext(strip_gz_extension(self.filepath))
         filename = path_leaf(file_path)
         filename = os.path.join(self.output_dir, filename+'.{}'.format(out_suffix))
         bed_df.to_csv(filename, header=False,
                       sep='\t',
                       index=False,
-                      columns=['chrom', 'peakStartZeroBased',
-                               'peakEndOneBased', 'name', 'score'])
+                      columns=__SCOREFILE_COLUMNS__)
         return filename
 
 
-    def slop_bed(self, bed_in, flank_length=50):
+    @property
+    def chrom_sizes(self):
+        """Chromosome sizes as listed in the genome table
+
+        The genome table is read only once per object.
+
+        Returns
+        -------
+        chrom_sizes: dict
+            Dictionary with {"chr": length} format
+        """
+        if self._chrom_sizes is None:
+            self._chrom_sizes = read_genome_table(self.genome_table)
+        return self._chrom_sizes
+
+    def slop_bed(self, bed_in, flank_length=50, bed_out=None, as_dataframe=False):
         """Add flanking sequences to bed file
 
+        Intervals are widened and clamped to chromosome
+        boundaries in memory, equivalent to `bedtools slop -b`.
+
         Parameters
         ----------
-        bed_in: string
-            Path to input bed file
+        bed_in: string or dataframe
+            Path to input bed file or a dataframe whose first three
+            columns are chrom, start and end
         flank_length: int
             the bed region is expanded in both direction by flank_length number of bases
+        bed_out: string
+            Path to write slopped bed file. Defaults to `bed_in` with
+            a `_slop_<flank_length>` suffix when `bed_in` is a path
+        as_dataframe: bool
+            Return the slopped dataframe instead of writing it to disk.
+            Implied if `bed_in` is a dataframe and `bed_out` is not set
 
         Returns
         -------
-        slopped_bed: dataframe
-            Slopped bed data object
+        slopped_bed: string or dataframe
+            Path to slopped bed file or slopped dataframe if `as_dataframe` is set
         """
-        inbed = BedTool(bed_in)
-        slopped_bed = inbed.slop(g=self.genome_table, b=flank_length)
-        filename, extension = os.path.splitext(bed_in)
-        filename += '_slop_{}'.format(flank_length) + extension
-        slopped_bed.saveas(filename)
-        return filename
+        if isinstance(bed_in, pandas.DataFrame):
+            bed_df = bed_in.copy()
+        else:
+            try:
+                bed_df = pandas.read_table(bed_in, header=None)
+            except Exception as e:
+                raise MocaException('Error reading bed file {}\n Traceback: {}'.format(bed_in, e))
+            if not bed_out:
+                filename, extension = os.path.splitext(bed_in)
+                bed_out = filename + '_slop_{}'.format(flank_length) + extension
+        chrom_col, start_col, end_col = bed_df.columns[:3]
+        chroms = pandas.Categorical(bed_df[chrom_col].astype(str))
+        chrom_sizes = self.chrom_sizes
+        missing = [chrom for chrom in chroms.categories if chrom not in chrom_sizes]
+        if missing:
+            raise MocaException('Chromosomes {} not found in genome table {}'.format(missing, self.genome_table))
+        lengths = np.array([chrom_sizes[chrom] for chrom in chroms.categories], dtype=np.int64)[chroms.codes]
+        starts = bed_df[start_col].values.astype(np.int64) - flank_length
+        ends = bed_df[end_col].values.astype(np.int64) + flank_length
+        bed_df[start_col] = np.clip(starts, 0, lengths)
+        bed_df[end_col] = np.clip(ends, 0, lengths)
+        if as_dataframe or not bed_out:
+            return bed_df
+        bed_df.to_csv(bed_out, header=False, sep='\t', index=False)
+        return bed_out
 
     def _determine_peaks(self):
         """Add extra columns representing peaks
@@ -195,7 +442,7 @@ class Bedfile(object):
             # By default peka is at 0-based offset from chromStart
             self.bed_df['peak_position'] = self.bed_df['chromStart'] + self.bed_df['peak']
             # Peak not called, so chromStart is the peak itself
-            self.bed_df.ix[self.bed_df.peak==-1, 'peak_position'] = self.bed_df.ix[self.bed_df.peak==-1, 'chromStart']
+            self.bed_df.loc[self.bed_df.peak==-1, 'peak_position'] = self.bed_df.loc[self.bed_df.peak==-1, 'chromStart']
 
             ## Append explicit chromStart and chromEnd position based on peak_position
             self.bed_df['peakStartZeroBased'] = self.bed_df['peak_position'].astype(int)
@@ -210,29 +457,59 @@ class Bedfile(object):
         else:
             raise MocaException('Format should be one of {}'.format(list(__BED_TYPES__.values())))
 
-    def extract_fasta(self, bed_in, fasta_in, fasta_out=None):
+    def extract_fasta(self, bed_in, fasta_in, fasta_out=None, in_memory=False):
         """Extract fasta of bed regions
 
+        Regions are sliced from a memory mapped, indexed reference
+        and written upper case in a single pass. Records are named
+        `chrom:start-end` as by `bedtools getfasta`.
+
         Parameters
         ----------
-        bed_in: string
-            Path to input bed
+        bed_in: string or dataframe
+            Path to input bed or a dataframe whose first three
+            columns are chrom, start and end
         fasta_in: string
             Absolute path to location of reference fasta file
 
         fasta_out: string
             Path to write extracted fasta sequence
+        in_memory: bool
+            Return the extracted sequences
 
         Returns
         -------
-        fasta: string
-            Fasta sequence combined
+        fasta: string or list
+            Path to `fasta_out` or list of (name, sequence) tuples if `in_memory` is set
         """
-        bed = BedTool(bed_in)
-        extracted_fasta = bed.sequence(fi=os.path.abspath(fasta_in))
-        temp_fasta = extracted_fasta.seqfn
-        make_uppercase_fasta(temp_fasta, os.path.abspath(fasta_out))
-        os.remove(temp_fasta)
+        if isinstance(bed_in, pandas.DataFrame):
+            bed_df = bed_in
+        else:
+            try:
+                bed_df = pandas.read_table(bed_in, header=None)
+            except Exception as e:
+                raise MocaException('Error reading bed file {}\n Traceback: {}'.format(bed_in, e))
+        if not fasta_out and not in_memory:
+            raise MocaException('One of fasta_out or in_memory is required')
+        chrom_col, start_col, end_col = bed_df.columns[:3]
+        intervals = zip(bed_df[chrom_col].astype(str), bed_df[start_col], bed_df[end_col])
+        sequences = []
+        out_handle = open(os.path.abspath(fasta_out), 'wb') if fasta_out else None
+        try:
+            with IndexedFasta(fasta_in) as reference:
+                for chrom, start, end in intervals:
+                    name = '{}:{}-{}'.format(chrom, start, end)
+                    sequence = reference.fetch(chrom, start, end)
+                    if out_handle:
+                        write_fasta_record(out_handle, name, sequence)
+                    if in_memory:
+                        sequences.append((name, sequence))
+        finally:
+            if out_handle:
+                out_handle.close()
+        if in_memory:
+            return sequences
+        return os.path.abspath(fasta_out)
 
     def sort_by(self, columns=None, ascending=False):
         """Method to sort columns of bedfiles
@@ -250,11 +527,124 @@ class Bedfile(object):
             dataframe with sorted columns
         """
         assert type(columns) is list
+        self._peak_index = None
+        self._peak_ranks = None
         return self.bed_df.sort_values(by=columns, ascending=ascending, inplace=True)
 
+    @property
+    def peak_index(self):
+        """Interval index over peaks, built on first use
+
+        Row positions returned by the index refer to
+        rows of `bed_df`, see `peak_ranks` for their ranks
+
+        Returns
+        -------
+        peak_index: PeakIndex
+            Index over peak intervals and summits
+        """
+        if self._peak_index is None:
+            self._peak_index = PeakIndex(self.bed_df['chrom'].values,
+                                         self.bed_df['chromStart'].values,
+                                         self.bed_df['chromEnd'].values,
+                                         self.bed_df['peakStartZeroBased'].values)
+        return self._peak_index
+
+    @property
+    def peak_ranks(self):
+        """Rank of each row of `bed_df` in the order of `_sort_bed`
+
+        Computed on first use, `bed_df` itself stays in file order.
+
+        Returns
+        -------
+        peak_ranks: np.array
+            0-based rank of each row
+        """
+        if self._peak_ranks is None:
+            order = self.bed_df.reset_index(drop=True).sort_values(by=__SORT_COLUMNS__,
+                                                                   ascending=__SORT_ASCENDING__,
+                                                                   kind='mergesort').index.values
+            self._peak_ranks = np.empty(len(order), dtype=np.int64)
+            self._peak_ranks[order] = np.arange(len(order))
+        return self._peak_ranks
+
+    def overlaps(self, intervals):
+        """Find the peak overlapping each interval
+
+        Parameters
+        ----------
+        intervals: dataframe
+            Dataframe whose first three columns are chrom, start(0-based) and end(1-based)
+
+        Returns
+        -------
+        peaks: np.array
+            Row position in `bed_df` of an overlapping peak, -1 if none
+        """
+        chrom_col, start_col, end_col = intervals.columns[:3]
+        return self.peak_index.overlaps(intervals[chrom_col].values,
+                                        intervals[start_col].values,
+                                        intervals[end_col].values)
+
+    def nearest_peak(self, chroms, positions):
+        """Find the peak whose summit is closest to each position
+
+        Parameters
+        ----------
+        chroms: array_like
+            Chromosome of each position
+        positions: array_like
+            0-based positions
+
+        Returns
+        -------
+        peaks: np.array
+            Row position in `bed_df` of nearest peak, -1 if none
+        distances: np.array
+            Signed distance from summit (position - summit)
+        """
+        return self.peak_index.nearest_peak(chroms, positions)
+
+    def annotate_sites(self, sites_df):
+        """Annotate motif sites with their source peak
+
+        Parameters
+        ----------
+        sites_df: dataframe
+            Sites as returned by `fimo_to_sites`
+
+        Returns
+        -------
+        sites_df: dataframe
+            Copy of sites with `peakRank` (0-based rank of the peak, -1 if the site lies
+            outside all peaks) and `summitDistance` (motif center - summit) columns
+        """
+        sites_df = sites_df.copy()
+        starts = sites_df['motifStartZeroBased'].values
+        ends = sites_df['motifEndOneBased'].values
+        peaks = self.peak_index.overlaps(sites_df['chrom'].values, starts, ends)
+        summits = self.bed_df['peakStartZeroBased'].values
+        centers = (starts + ends) // 2
+        sites_df['peakRank'] = np.where(peaks >= 0, self.peak_ranks[peaks], -1)
+        sites_df['summitDistance'] = np.where(peaks >= 0, centers - summits[peaks], np.nan)
+        return sites_df
+
     def __str__(self):
         return repr(self.bed_df)
 
     @property
     def get_total_peaks(self):
         return self.total_peaks
+
+    @property
+    def get_memory_usage(self):
+        """Return memory used by the loaded peaks
+
+        Returns
+        -------
+        memory_usage: Series
+            Bytes used by each column of the bed dataframe
+            along with an 'Index' entry
+        """
+        return self.bed_df.memory_usage(deep=True)
@@ -13,6 +13,8 @@ from .filename import filename_extension
 from .filename import get_filename_without_ext
 from .filename import search_files
 from .filename import path_leaf
+from .filename import is_gzipped
+from .filename import strip_gz_extension
 from .meme import read_memefile
 from .meme import get_motif_ic
 from .meme import get_motif_bg_freq
@@ -21,3 +23,13 @@ from .meme import create_position_profile
 from .meme import get_total_sequences
 from .fasta import make_uppercase_fasta
 from .fasta import get_fasta_metadata
+from .fasta import IndexedFasta
+from .fasta import iter_fasta
+from .fasta import write_fasta_record
+from .checksum import file_checksum
+from .intervals import Intervals
+from .scores import save_scores
+from .scores import load_scores
+from .scores import save_profile
+from .scores import export_scores_text
+from .scores import read_score_metadata
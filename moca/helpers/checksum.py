@@ -0,0 +1,26 @@
+"""Content hashes for files"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+import hashlib
+
+def file_checksum(path, blocksize=1 << 20):
+    """Return sha1 hexdigest of a file's content
+
+    Parameters
+    ----------
+    path: str
+        Path to file
+    blocksize: int
+        Number of bytes read at a time
+
+    Returns
+    -------
+    checksum: str
+        Hex digest of file content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
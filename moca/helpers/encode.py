@@ -8,7 +8,6 @@ import requests
 import shutil
 #from pymongo import MongoClient
 import io
-import gzip
 import json
 
 __base_url__ = 'https://www.encodeproject.org/'
@@ -43,14 +42,14 @@ def safe_makedir(dname):
     return dname
 
 def download_peakfile(source_url, filename, destination_dir):
-    """Download peakfile from encode"""
+    """Download peakfile from encode
+
+    The peakfile is saved as is(gzipped) since
+    it can be read directly by `Bedfile`
+    """
     response = requests.get(source_url, stream=True)
     with open(os.path.join(destination_dir, filename), 'wb') as f:
         shutil.copyfileobj(response.raw, f)
-
-    with gzip.open(os.path.join(destination_dir, filename), 'rb') as in_file:
-        with open(os.path.join(destination_dir, filename.replace('.gz','')), 'wb') as out_file:
-            out_file.write( in_file.read()  )
     del response
 
 def download_idr_tfs(root_dir, metadata):
@@ -69,7 +68,7 @@ def download_idr_tfs(root_dir, metadata):
         print(source_url)
         download_peakfile(source_url, peakfilename, dataset_dir)
         save_metadata_json(idr_record, dataset_dir)
-        return {'assembly': idr_record['assembly'],'bedfile': os.path.join(dataset_dir, peakfilename.replace('.gz',''))}
+        return {'assembly': idr_record['assembly'],'bedfile': os.path.join(dataset_dir, peakfilename)}
 
 def save_metadata(metadata):
     """Save metadata to mongodb"""
@@ -3,10 +3,19 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from builtins import zip
+from builtins import object
+import mmap
 import os
 from Bio import SeqIO
 import pandas
 import numpy as np
+from .exceptions import MocaException
+
+# Translation table mapping lower case ASCII letters to upper case
+__UPPERCASE_TABLE__ = bytes(bytearray(range(256)).upper())
+
+# Line width used while writing fasta, same as Biopython's SeqIO
+__FASTA_LINE_WIDTH__ = 60
 
 def get_fasta_metadata(in_fasta):
     """Return metadata about fasta
@@ -52,3 +61,186 @@ def make_uppercase_fasta(mixed_fasta, upper_fasta):
     records = (rec.upper() for rec in SeqIO.parse(os.path.abspath(mixed_fasta), 'fasta'))
     SeqIO.write(records, os.path.abspath(upper_fasta), 'fasta')
 
+
+
+def build_fasta_index(fasta_location):
+    """Build a samtools style (.fai) index of a fasta file
+
+    Parameters
+    ----------
+    fasta_location: str
+        Path to fasta file
+
+    Returns
+    -------
+    fasta_index: dict
+        Dictionary with {"chr": (length, offset, linebases, linewidth)} format
+    """
+    fasta_index = {}
+    name = None
+    length = offset = linebases = linewidth = 0
+    position = 0
+    with open(fasta_location, 'rb') as f:
+        for line in f:
+            line_length = len(line)
+            if line.startswith(b'>'):
+                if name is not None:
+                    fasta_index[name] = (length, offset, linebases, linewidth)
+                name = line[1:].split()[0].decode('ascii')
+                length = linebases = linewidth = 0
+                offset = position + line_length
+            else:
+                bases = len(line.rstrip(b'\r\n'))
+                if not linebases:
+                    linebases = bases
+                    linewidth = line_length
+                length += bases
+            position += line_length
+    if name is not None:
+        fasta_index[name] = (length, offset, linebases, linewidth)
+    return fasta_index
+
+
+def write_fasta_index(fasta_index, index_location):
+    """Write a fasta index in samtools .fai format
+
+    The index is written to a temporary file which is then
+    renamed, so concurrent readers never see a partial index.
+
+    Parameters
+    ----------
+    fasta_index: dict
+        Index as returned by `build_fasta_index`
+    index_location: str
+        Path to .fai file
+    """
+    temp_location = '{}.{}.tmp'.format(index_location, os.getpid())
+    with open(temp_location, 'w') as f:
+        for name, (length, offset, linebases, linewidth) in fasta_index.items():
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, offset, linebases, linewidth))
+    os.rename(temp_location, index_location)
+
+
+class IndexedFasta(object):
+    """Memory mapped fasta reader backed by a .fai index
+
+    The index is read from `<fasta>.fai` if it is not older than
+    the fasta, else it is built by scanning the fasta once and
+    saved as `<fasta>.fai` for later runs.
+
+    Parameters
+    ----------
+    fasta_location: str
+        Path to fasta file
+    """
+    def __init__(self, fasta_location):
+        self.fasta_location = os.path.abspath(fasta_location)
+        if not os.path.isfile(self.fasta_location):
+            raise MocaException('Fasta file {} not found'.format(self.fasta_location))
+        index_location = self.fasta_location + '.fai'
+        if (os.path.isfile(index_location)
+                and os.path.getmtime(index_location) >= os.path.getmtime(self.fasta_location)):
+            self.index = self._read_index(index_location)
+        else:
+            self.index = build_fasta_index(self.fasta_location)
+            try:
+                write_fasta_index(self.index, index_location)
+            except (IOError, OSError):
+                # Fasta directory is not writable, index again next time
+                pass
+        self._handle = open(self.fasta_location, 'rb')
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _read_index(index_location):
+        index_df = pandas.read_table(index_location, header=None,
+                                     usecols=[0, 1, 2, 3, 4], dtype={0: str})
+        return {row[0]: tuple(int(x) for x in row[1:]) for row in index_df.itertuples(index=False)}
+
+    def fetch(self, chrom, start, end):
+        """Fetch upper case sequence of a region
+
+        Parameters
+        ----------
+        chrom: str
+            Chromosome name
+        start: int
+            0-based start
+        end: int
+            1-based end
+
+        Returns
+        -------
+        sequence: bytes
+            Upper case sequence of the region
+        """
+        try:
+            length, offset, linebases, linewidth = self.index[chrom]
+        except KeyError:
+            raise MocaException('Chromosome {} not found in {}'.format(chrom, self.fasta_location))
+        start = int(start)
+        end = int(end)
+        if start < 0 or end > length or start > end:
+            raise MocaException('Invalid interval {}:{}-{} for chromosome of length {}'.format(chrom, start, end, length))
+        start_offset = offset + (start // linebases) * linewidth + start % linebases
+        end_offset = offset + (end // linebases) * linewidth + end % linebases
+        return self._mmap[start_offset:end_offset].translate(__UPPERCASE_TABLE__, b'\r\n')
+
+    def close(self):
+        """Close the memory map and underlying file"""
+        self._mmap.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_fasta_record(handle, name, sequence, line_width=__FASTA_LINE_WIDTH__):
+    """Write a single fasta record to an open binary handle
+
+    Parameters
+    ----------
+    handle: file
+        File opened in binary mode
+    name: str
+        Record identifier
+    sequence: bytes
+        Record sequence
+    line_width: int
+        Number of bases written per line
+    """
+    handle.write(b'>' + name.encode('ascii') + b'\n')
+    for i in range(0, len(sequence), line_width):
+        handle.write(sequence[i:i+line_width] + b'\n')
+
+
+def iter_fasta(fasta_location):
+    """Iterate over records of a fasta file
+
+    Parameters
+    ----------
+    fasta_location: str
+        Path to fasta file
+
+    Returns
+    -------
+    records: generator
+        (name, sequence) tuples where name is the first word of
+        the header and sequence is upper case bytes
+    """
+    name = None
+    chunks = []
+    with open(fasta_location, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(chunks).translate(__UPPERCASE_TABLE__)
+                name = line[1:].split()[0].decode('ascii')
+                chunks = []
+            else:
+                chunks.append(line.rstrip(b'\r\n'))
+    if name is not None:
+        yield name, b''.join(chunks).translate(__UPPERCASE_TABLE__)
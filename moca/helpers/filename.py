@@ -9,6 +9,17 @@ def touch(fp):
     """Touch an empty file"""
     open(fp, 'a').close()
 
+def is_gzipped(path):
+    """Check if a file is gzip (or bgzip) compressed"""
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def strip_gz_extension(path):
+    """Remove trailing .gz extension, if any, from a path"""
+    if path.endswith('.gz'):
+        return path[:-3]
+    return path
+
 def path_leaf(path):
     """Return head, tail of an absolute path"""
     head, tail = ntpath.split(path)
@@ -0,0 +1,157 @@
+"""Columnar container for stranded genomic intervals"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+from builtins import zip
+import numpy as np
+import pandas
+
+__INTERVAL_DTYPE__ = np.dtype([('chrom', np.int32),
+                               ('start', np.int64),
+                               ('end', np.int64),
+                               ('strand', np.int8)])
+
+__STRAND_CODES__ = {'+': 1, '-': -1, '.': 0}
+__STRAND_SYMBOLS__ = {1: '+', -1: '-', 0: '.'}
+
+
+class Intervals(object):
+    """Stranded intervals stored as a numpy structured array
+
+    Each record holds a chromosome code(index into `chrom_names`),
+    0-based start, 1-based end and strand(+1, -1 or 0 for '.').
+    Iterating yields (chrom, start, end, strand) tuples so that
+    an Intervals object can be used wherever a list of tuples is expected.
+
+    Parameters
+    ----------
+    chrom_names: array_like
+        Chromosome names indexed by chromosome codes
+    records: np.array
+        Structured array with chrom, start, end and strand fields
+    """
+    def __init__(self, chrom_names, records):
+        self.chrom_names = np.asarray(chrom_names, dtype=object)
+        self.records = np.asarray(records, dtype=__INTERVAL_DTYPE__)
+
+    @classmethod
+    def from_arrays(cls, chroms, starts, ends, strands):
+        """Create intervals from column arrays
+
+        Parameters
+        ----------
+        chroms: array_like
+            Chromosome names
+        starts: array_like
+            0-based starts
+        ends: array_like
+            1-based ends
+        strands: array_like
+            Strands as '+', '-' or '.'
+
+        Returns
+        -------
+        intervals: Intervals
+        """
+        categorical = pandas.Categorical(np.asarray(chroms).astype(str))
+        strand_codes = pandas.Series(np.asarray(strands)).map(__STRAND_CODES__).fillna(0).values
+        records = np.empty(len(categorical), dtype=__INTERVAL_DTYPE__)
+        records['chrom'] = categorical.codes
+        records['start'] = starts
+        records['end'] = ends
+        records['strand'] = strand_codes
+        return cls(list(categorical.categories), records)
+
+    @classmethod
+    def from_tuples(cls, tuples):
+        """Create intervals from (chrom, start, end, strand) tuples"""
+        tuples = list(tuples)
+        if not tuples:
+            return cls([], np.empty(0, dtype=__INTERVAL_DTYPE__))
+        chroms, starts, ends, strands = zip(*tuples)
+        return cls.from_arrays(chroms, starts, ends, strands)
+
+    @classmethod
+    def concatenate(cls, intervals_list):
+        """Join several Intervals objects, in order
+
+        Parameters
+        ----------
+        intervals_list: list
+            Intervals objects
+
+        Returns
+        -------
+        intervals: Intervals
+        """
+        chrom_names = []
+        for intervals in intervals_list:
+            chrom_names.extend(x for x in intervals.chrom_names if x not in chrom_names)
+        chrom_codes = dict((chrom, code) for code, chrom in enumerate(chrom_names))
+        records = []
+        for intervals in intervals_list:
+            remap = np.array([chrom_codes[x] for x in intervals.chrom_names], dtype=np.int32)
+            shifted = intervals.records.copy()
+            if len(shifted):
+                shifted['chrom'] = remap[shifted['chrom']]
+            records.append(shifted)
+        if not records:
+            return cls([], np.empty(0, dtype=__INTERVAL_DTYPE__))
+        return cls(chrom_names, np.concatenate(records))
+
+    @property
+    def chroms(self):
+        """Chromosome name of each interval"""
+        return self.chrom_names[self.records['chrom']]
+
+    @property
+    def starts(self):
+        return self.records['start']
+
+    @property
+    def ends(self):
+        return self.records['end']
+
+    @property
+    def strands(self):
+        return self.records['strand']
+
+    @property
+    def widths(self):
+        return self.records['end'] - self.records['start']
+
+    def group_by_chrom(self):
+        """Group intervals by chromosome
+
+        Returns
+        -------
+        groups: list
+            List of (chrom, rows) tuples where rows are positions
+            of intervals on chrom in their original order
+        """
+        codes = self.records['chrom']
+        order = np.argsort(codes, kind='mergesort')
+        boundaries = np.searchsorted(codes[order], np.arange(len(self.chrom_names)+1))
+        return [(chrom, order[boundaries[i]:boundaries[i+1]])
+                for i, chrom in enumerate(self.chrom_names)
+                if boundaries[i+1] > boundaries[i]]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            record = self.records[key]
+            return (self.chrom_names[record['chrom']], int(record['start']),
+                    int(record['end']), __STRAND_SYMBOLS__[int(record['strand'])])
+        return Intervals(self.chrom_names, self.records[key])
+
+    def __iter__(self):
+        chroms = self.chroms
+        strands = [__STRAND_SYMBOLS__[x] for x in self.records['strand']]
+        return zip(chroms, self.records['start'].tolist(),
+                   self.records['end'].tolist(), strands)
+
+    def __repr__(self):
+        return 'Intervals({} intervals on {} chromosomes)'.format(len(self), len(self.chrom_names))
@@ -0,0 +1,203 @@
+"""Read and write conservation score files
+
+Scores of a track are saved as <prefix>.raw.npy (one row per site)
+and <prefix>.mean.npy (mean profile), both float32, with a
+<prefix>.json file describing how they were extracted.
+Profile only runs save <prefix>.var.npy and <prefix>.count.npy
+in place of raw scores.
+Text files as written by older versions(<prefix>.raw.txt,
+<prefix>.mean.txt) can be exported alongside and are still readable.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+import json
+import os
+import warnings
+import numpy as np
+from .filename import touch
+
+__SCORE_FORMAT_VERSION__ = 1
+
+# Minus strand sites are reversed so that all rows read 5'->3' on the motif
+__STRAND_HANDLING__ = 'reverse_minus'
+
+
+def score_file_paths(out_directory, out_prefix):
+    """Return paths of raw scores, mean scores and metadata for a track
+
+    Parameters
+    ----------
+    out_directory: str
+        Directory holding the score files
+    out_prefix: str
+        Track name
+
+    Returns
+    -------
+    paths: dict
+        Paths with keys 'raw', 'mean', 'variance', 'count' and 'metadata'
+    """
+    return {'raw': os.path.join(out_directory, '{}.raw.npy'.format(out_prefix)),
+            'mean': os.path.join(out_directory, '{}.mean.npy'.format(out_prefix)),
+            'variance': os.path.join(out_directory, '{}.var.npy'.format(out_prefix)),
+            'count': os.path.join(out_directory, '{}.count.npy'.format(out_prefix)),
+            'metadata': os.path.join(out_directory, '{}.json'.format(out_prefix))}
+
+
+def save_scores(scores, out_directory, out_prefix, flank_length=None, wig_file=None,
+                export_text=False):
+    """Save raw scores and their mean profile
+
+    Parameters
+    ----------
+    scores: np.array
+        Matrix of scores with one row per site
+    out_directory: str
+        Directory to write score files
+    out_prefix: str
+        Track name
+    flank_length: int
+        Number of bases flanking the motif on each side
+    wig_file: str
+        Track the scores were read from
+    export_text: bool
+        Also write <prefix>.raw.txt and <prefix>.mean.txt
+
+    Returns
+    -------
+    mean_file: str
+        Path to mean scores
+    """
+    paths = score_file_paths(out_directory, out_prefix)
+    scores = np.asarray(scores, dtype=np.float32)
+    if len(scores):
+        with warnings.catch_warnings():
+            # Positions with no score on any site stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(scores, axis=0).astype(np.float32)
+    else:
+        mean = np.zeros(0, dtype=np.float32)
+    np.save(paths['raw'], scores)
+    np.save(paths['mean'], mean)
+    metadata = {'version': __SCORE_FORMAT_VERSION__,
+                'mode': 'raw',
+                'track': out_prefix,
+                'wig_file': wig_file,
+                'flank_length': flank_length,
+                'strand': __STRAND_HANDLING__,
+                'total_sites': int(scores.shape[0]),
+                'width': int(scores.shape[1]) if scores.ndim > 1 else 0}
+    with open(paths['metadata'], 'w') as f:
+        json.dump(metadata, f)
+    if export_text:
+        export_scores_text(out_directory, out_prefix)
+    return paths['mean']
+
+
+def save_profile(mean, variance, count, out_directory, out_prefix, total_sites=None,
+                 flank_length=None, wig_file=None, export_text=False):
+    """Save mean profile of scores without raw scores
+
+    Parameters
+    ----------
+    mean: np.array
+        Mean score at each position
+    variance: np.array
+        Variance of scores at each position
+    count: np.array
+        Number of sites with a score at each position
+    out_directory: str
+        Directory to write score files
+    out_prefix: str
+        Track name
+    total_sites: int
+        Number of sites accumulated
+    flank_length: int
+        Number of bases flanking the motif on each side
+    wig_file: str
+        Track the scores were read from
+    export_text: bool
+        Also write <prefix>.mean.txt
+
+    Returns
+    -------
+    mean_file: str
+        Path to mean scores
+    """
+    paths = score_file_paths(out_directory, out_prefix)
+    np.save(paths['mean'], np.asarray(mean, dtype=np.float32))
+    np.save(paths['variance'], np.asarray(variance, dtype=np.float32))
+    np.save(paths['count'], np.asarray(count, dtype=np.int64))
+    metadata = {'version': __SCORE_FORMAT_VERSION__,
+                'mode': 'profile',
+                'track': out_prefix,
+                'wig_file': wig_file,
+                'flank_length': flank_length,
+                'strand': __STRAND_HANDLING__,
+                'total_sites': total_sites,
+                'width': int(len(mean))}
+    with open(paths['metadata'], 'w') as f:
+        json.dump(metadata, f)
+    if export_text:
+        np.savetxt(os.path.join(out_directory, '{}.mean.txt'.format(out_prefix)), mean, fmt='%.4f')
+    return paths['mean']
+
+
+def export_scores_text(out_directory, out_prefix):
+    """Write saved scores as <prefix>.raw.txt and <prefix>.mean.txt
+
+    Parameters
+    ----------
+    out_directory: str
+        Directory holding the score files
+    out_prefix: str
+        Track name
+    """
+    paths = score_file_paths(out_directory, out_prefix)
+    scores = load_scores(paths['raw'])
+    raw_txt = os.path.join(out_directory, '{}.raw.txt'.format(out_prefix))
+    mean_txt = os.path.join(out_directory, '{}.mean.txt'.format(out_prefix))
+    if np.any(scores):
+        np.savetxt(raw_txt, scores, fmt='%.4f')
+        np.savetxt(mean_txt, load_scores(paths['mean']), fmt='%.4f')
+    else:
+        touch(raw_txt)
+        touch(mean_txt)
+
+
+def load_scores(score_file):
+    """Load a score file
+
+    Parameters
+    ----------
+    score_file: str
+        Path to .npy(memory mapped) or text score file
+
+    Returns
+    -------
+    scores: np.array
+        Scores as saved
+    """
+    if score_file.endswith('.npy'):
+        return np.load(score_file, mmap_mode='r')
+    return np.loadtxt(score_file)
+
+
+def read_score_metadata(out_directory, out_prefix):
+    """Return metadata saved with the scores of a track
+
+    Parameters
+    ----------
+    out_directory: str
+        Directory holding the score files
+    out_prefix: str
+        Track name
+
+    Returns
+    -------
+    metadata: dict
+        Track, flank length, strand handling and size of the scores
+    """
+    with open(score_file_paths(out_directory, out_prefix)['metadata']) as f:
+        return json.load(f)
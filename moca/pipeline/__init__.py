@@ -4,3 +4,11 @@ from __future__ import division
 from __future__ import absolute_import
 from .job_processor import Pipeline
 
+from .motif_scanner import MotifScanner
+from .shuffler import shuffle_fasta
+from .shuffler import shuffle_sequence
+from .shuffler import cached_shuffle_fasta
+from .scheduler import Task
+from .scheduler import TaskGraph
+from .motif_workers import run_motif_chain
+from .motif_workers import run_motif_chains
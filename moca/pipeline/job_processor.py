@@ -10,9 +10,25 @@ from ..helpers import ConfigurationParser
 from ..helpers import run_job
 from ..helpers import xstr
 from ..helpers import get_cpu_count
-from ..helpers.filename import touch
+from ..helpers import read_memefile
+from ..helpers import safe_makedir
+from ..helpers.scores import save_scores
+from ..helpers.scores import save_profile
+from ..bedoperations.fimo import add_site_columns
+from ..helpers import iter_fasta
+from ..helpers import Intervals
+from .motif_scanner import MotifScanner
+from .motif_scanner import scan_motifs
+from .motif_scanner import write_fimo_txt
+from .shuffler import shuffle_fasta
+from .shuffler import cached_shuffle_fasta
+from .tool_cache import __MAX_CACHE_SIZE__
+from .tool_cache import load_tool_result
+from .tool_cache import save_tool_result
+from .tool_cache import tool_cache_location
 
-from ..wigoperations import WigReader
+from ..wigoperations import query_matrix_parallel
+from ..wigoperations import query_profile
 import numpy as np
 
 class Pipeline(ConfigurationParser):
@@ -22,9 +38,17 @@ class Pipeline(ConfigurationParser):
     ----------
     config_file: string
         Optional file input to load all configurations
+    cache_dir: string
+        Directory to cache meme, fimo, centrimo and meme-chip runs in.
+        Runs with the same program, arguments and inputs are restored
+        from cache instead of being run again
+    cache_size: int
+        Size limit of the run cache in bytes
     """
-    def __init__(self, config_file=None):
+    def __init__(self, config_file=None, cache_dir=None, cache_size=__MAX_CACHE_SIZE__):
         super(Pipeline, self).__init__(config_file)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
         self.commands_run = list()
         #TODO This can be removed if config_file is optional
         if not os.path.isfile(xstr(config_file)):
@@ -38,7 +62,10 @@ class Pipeline(ConfigurationParser):
         self.fimo_default_params = ''
         self.fimo_strargs = None
         self.fimo_location = 'fimo'
-        self.shuffler_location = 'fasta-shuffle-letters'
+        self.fimo_threshold = 1e-4
+        # Shuffling is done in-process unless this is set to a
+        # fasta-shuffle-letters binary
+        self.shuffler_location = None
         self.centrimo_args = None
         self.centrimo_location = 'centrimo'
         self.memechip_default_params = '-dna -meme-mod zoops -meme-nmotifs 5 -meme-minw 6 -meme-maxw 30 -meme-maxsize 1000000 -meme-p {}'.format(self.cpu_cores)
@@ -53,6 +80,62 @@ class Pipeline(ConfigurationParser):
         return True
 
 
+    def _cached_tool_result(self, cmd, binary, input_files, out_dir):
+        """Restore the output of a MEME suite program run from cache
+
+        Parameters are as for `_run_tool`
+
+        Returns
+        -------
+        location: str
+            Cache directory of the run, None if caching is disabled
+        result: dict
+            As returned by `load_tool_result`, None if not cached
+        """
+        if not self.cache_dir:
+            return None, None
+        location = tool_cache_location(self.cache_dir, cmd, binary, input_files, out_dir)
+        return location, load_tool_result(location, out_dir)
+
+    def _run_tool(self, cmd, binary, input_files, out_dir, cwd=None, cache_location=None):
+        """Run a MEME suite program, restoring its output from cache if it was run before
+
+        Parameters
+        ----------
+        cmd: str
+            Command line to run
+        binary: str
+            Program as it appears at the start of `cmd`
+        input_files: list
+            Files read by the program, as they appear in `cmd`
+        out_dir: str
+            Output directory as it appears in `cmd`
+        cwd: str
+            Working directory (Default: parent of `out_dir`)
+        cache_location: str
+            Cache directory of a run already looked up with
+            `_cached_tool_result`, the cache is then not read again
+
+        Returns
+        -------
+        stdout: bytes
+        stderr: bytes
+        exitcode: int
+        cached: bool
+            True if the output was restored from cache
+        """
+        if cwd is None:
+            cwd = os.path.dirname(out_dir)
+        location = cache_location
+        if location is None:
+            location, result = self._cached_tool_result(cmd, binary, input_files, out_dir)
+            if result is not None:
+                return result['stdout'], result['stderr'], 0, True
+        stdout, stderr, exitcode = run_job(cmd=cmd, cwd=cwd)
+        if location and exitcode == 0 and os.path.isdir(out_dir):
+            save_tool_result(location, out_dir, stdout, stderr, max_size=self.cache_size)
+        return stdout, stderr, exitcode, False
+
     def run_meme(self, fasta_in, out_dir=None, strargs=None):
         """Run meme
         Run meme on a given input fasta
@@ -73,9 +156,9 @@ class Pipeline(ConfigurationParser):
         meme_out: string
             Location of meme output
         """
-        self.meme_strargs = strargs
-        if not self.meme_strargs:
-            self.meme_strargs = self.meme_default_params
+        # Arguments are kept local, runs may share the pipeline across threads
+        if not strargs:
+            strargs = self.meme_default_params
         meme_binary = self.get_binary_path('meme').strip()
         if not meme_binary or meme_binary == '':
             # Use meme from envirnonment
@@ -83,25 +166,33 @@ class Pipeline(ConfigurationParser):
         else:
             #  Use absolute path meme
             meme_binary += '/meme'
-        self.meme_location = meme_binary
         if not out_dir:
             out_dir = os.path.join(os.path.dirname(fasta_in), 'meme_out')
         out_dir = os.path.abspath(out_dir)
-        regex = re.compile(r'-p.*')
-        if self.can_run_meme_parallel('{} -p 2'.format(meme_binary)) and not regex.findall(self.meme_strargs):
-            self.meme_strargs += ' -p {}'.format(self.cpu_cores)
-        cmd = '{} {} -oc {} {}'.format(self.meme_location, self.meme_strargs,
+        cmd = '{} {} -oc {} {}'.format(meme_binary, strargs,
                                        out_dir, os.path.abspath(fasta_in))
-        stdout, stderr, exitcode = run_job(cmd=cmd,
-                                           cwd=os.path.dirname(out_dir))
+        # The process count is not part of the cache key, so the cache is
+        # read before starting meme to check for parallel support
+        location, result = self._cached_tool_result(cmd, meme_binary, [os.path.abspath(fasta_in)], out_dir)
+        if result is not None:
+            stdout, stderr, exitcode, cached = result['stdout'], result['stderr'], 0, True
+        else:
+            regex = re.compile(r'-p.*')
+            if self.can_run_meme_parallel('{} -p 2'.format(meme_binary)) and not regex.findall(strargs):
+                strargs += ' -p {}'.format(self.cpu_cores)
+                cmd = '{} {} -oc {} {}'.format(meme_binary, strargs,
+                                               out_dir, os.path.abspath(fasta_in))
+            stdout, stderr, exitcode, cached = self._run_tool(cmd, meme_binary,
+                                                              [os.path.abspath(fasta_in)], out_dir,
+                                                              cache_location=location)
 
         output = {'out_dir': out_dir, 'stdout': stdout,
                   'stderr': stderr, 'exitcode': exitcode,
-                  'cmd': cmd}
+                  'cmd': cmd, 'cached': cached}
         self.commands_run.append({'cmd': cmd, 'metadata': output})
         return output
 
-    def run_fimo(self, motif_file, motif_num, sequence_file, out_dir=None, strargs=None):
+    def run_fimo(self, motif_file, motif_num, sequence_file, out_dir=None, strargs=None, native=False):
         """Run fimo to find out locations where motif occurs
 
         Parameters
@@ -116,12 +207,22 @@ class Pipeline(ConfigurationParser):
             Location to output fimo results
         strargs: str
             string arguments as would be passed to fimo commandline
+        native: bool
+            Scan in-process with `run_fimo_native` instead of running fimo.
+            Only the --thresh argument of `strargs` is honored
         """
+        if native:
+            threshold = self.fimo_threshold
+            thresh_arg = re.search(r'--thresh\s+(\S+)', xstr(strargs))
+            if thresh_arg:
+                threshold = float(thresh_arg.group(1))
+            return self.run_fimo_native(motif_file, motif_num, sequence_file,
+                                        out_dir=out_dir, threshold=threshold)
         #TODO This code is same as in the above fmethod. Make this a separate method?
-        self.fimo_strargs = strargs
         if not out_dir:
             out_dir = os.path.join(os.path.dirname(motif_file), 'fimo_out')
-        self.fimo_strargs = xstr(self.fimo_strargs) + ' --motif {} -oc {}'.format(motif_num, os.path.abspath(out_dir))
+        # Arguments are kept local, runs may share the pipeline across threads
+        strargs = xstr(strargs) + ' --motif {} -oc {}'.format(motif_num, os.path.abspath(out_dir))
         fimo_binary = self.get_binary_path('meme')
         if not fimo_binary or fimo_binary == '':
             # Use meme from envirnonment
@@ -129,38 +230,184 @@ class Pipeline(ConfigurationParser):
         else:
             #  Use absolute path meme
             fimo_binary += '/fimo'
-        self.fimo_location = fimo_binary
-        cmd = '{}{} {} {}'.format(self.fimo_location, self.fimo_strargs,
+        cmd = '{}{} {} {}'.format(fimo_binary, strargs,
                                   os.path.abspath(motif_file),
                                   os.path.abspath(sequence_file))
-        stdout, stderr, exitcode = run_job(cmd=cmd,
-                                           cwd=os.path.dirname(out_dir))
+        stdout, stderr, exitcode, cached = self._run_tool(cmd, fimo_binary,
+                                                          [os.path.abspath(motif_file),
+                                                           os.path.abspath(sequence_file)],
+                                                          os.path.abspath(out_dir),
+                                                          cwd=os.path.dirname(out_dir))
         output = {'out_dir': out_dir, 'stdout': stdout,
                   'stderr': stderr, 'exitcode': exitcode,
-                  'cmd': cmd}
+                  'cmd': cmd, 'cached': cached}
         self.commands_run.append({'cmd': cmd, 'metadata': output})
         return output
 
-    def run_fasta_shuffler(self, fasta_in, fasta_out):
-        """Run fasta-dinucleotide-shuffle to generate random fasta"""
-        shuffler_binary = self.get_binary_path('meme')
-        if not shuffler_binary or shuffler_binary == '':
-            # Use meme from envirnonment
-            shuffler_binary = 'fasta-shuffle-letters'
-        else:
-            #  Use absolute path meme
-            shuffler_binary += '/fasta-shuffle-letters'
-        self.shuffler_location = shuffler_binary
-        cmd = '{} -kmer 2 -dna {} '.format(self.shuffler_location,
-                                             os.path.abspath(fasta_in))
+    def run_fimo_native(self, motif_file, motif_num, sequence_file, out_dir=None, threshold=None):
+        """Find locations where motif occurs without running fimo
+
+        Sequences are scanned in-process by `MotifScanner` and
+        results are written to `out_dir`/fimo.txt in fimo's format.
+
+        Parameters
+        ---------
+        motif_file: str
+            Path to meme.txt
+        motif_num: int
+            Motif number to investigate
+        sequence_file: str
+            Path to sequence file
+        out_dir: str
+            Location to output fimo results
+        threshold: float
+            p-value threshold (Default: 1e-4 as in fimo)
+
+        Returns
+        -------
+        output: dict
+            A dictionary with 'stderr,stdout,cmd,exitcode,out_dir' as
+            returned by `run_fimo` and 'sites' as returned by `fimo_to_sites`
+        """
+        if not out_dir:
+            out_dir = os.path.join(os.path.dirname(motif_file), 'fimo_out')
+        outputs = self.scan_motifs(motif_file, sequence_file, {motif_num: out_dir}, threshold=threshold)
+        return outputs[motif_num]
+
+    def scan_motifs(self, motif_file, sequence_file, out_dirs, threshold=None):
+        """Find locations of several motifs reading sequences only once
+
+        All motifs are scored in the same pass over `sequence_file`
+        and results for each motif are written to its
+        own directory in fimo's format.
+
+        Parameters
+        ---------
+        motif_file: str
+            Path to meme.txt
+        sequence_file: str
+            Path to sequence file
+        out_dirs: dict
+            Output directory for each motif number to scan as {motif_num: out_dir}
+        threshold: float
+            p-value threshold (Default: 1e-4 as in fimo)
+
+        Returns
+        -------
+        outputs: dict
+            Output of `run_fimo_native` for each motif number
+        """
+        if threshold is None:
+            threshold = self.fimo_threshold
+        motif_nums = sorted(out_dirs.keys())
+        meme_summary = read_memefile(motif_file)
+        scanners = [MotifScanner.from_motif_record(meme_summary['motif_records'][motif_num-1],
+                                                   meme_summary['bg_frequencies'],
+                                                   motif_name=motif_num)
+                    for motif_num in motif_nums]
+        fimo_dfs = scan_motifs(scanners, iter_fasta(os.path.abspath(sequence_file)), threshold=threshold)
+        outputs = {}
+        for motif_num, fimo_df in zip(motif_nums, fimo_dfs):
+            out_dir = safe_makedir(os.path.abspath(out_dirs[motif_num]))
+            write_fimo_txt(fimo_df, os.path.join(out_dir, 'fimo.txt'))
+            cmd = 'native-fimo --thresh {} --motif {} -oc {} {} {}'.format(threshold, motif_num, out_dir,
+                                                                          os.path.abspath(motif_file),
+                                                                          os.path.abspath(sequence_file))
+            output = {'out_dir': out_dir, 'stdout': b'',
+                      'stderr': b'', 'exitcode': 0,
+                      'cmd': cmd, 'sites': add_site_columns(fimo_df)}
+            self.commands_run.append({'cmd': cmd, 'metadata': output})
+            outputs[motif_num] = output
+        return outputs
+
+    def run_fasta_shuffler(self, fasta_in, fasta_out, kmer=2, seed=1, processes=None):
+        """Generate random fasta preserving dinucleotide frequencies
+
+        Sequences are shuffled in-process (as `fasta-shuffle-letters -kmer 2`)
+        and streamed to `fasta_out`. If `shuffler_location` is set, that
+        program is run instead.
+
+        Parameters
+        ----------
+        fasta_in: str
+            Path to fasta to shuffle
+        fasta_out: str
+            Path to write shuffled fasta
+        kmer: int
+            Length of k-mers whose counts are preserved
+        seed: int
+            Random seed, same seed gives same output
+        processes: int
+            Number of processes to use (Default: all cores)
+
+        Returns
+        -------
+        output: dict
+            A dictionary with 'stderr,stdout,cmd,exitcode'
+        """
+        if self.shuffler_location:
+            return self._run_external_shuffler(fasta_in, fasta_out, kmer=kmer, seed=seed)
+        if processes is None:
+            processes = self.cpu_cores
+        total_sequences = shuffle_fasta(os.path.abspath(fasta_in), os.path.abspath(fasta_out),
+                                        kmer=kmer, seed=seed, processes=processes)
+        cmd = 'native-shuffle -kmer {} -seed {} {}'.format(kmer, seed, os.path.abspath(fasta_in))
+        output = {'stdout': b'',
+                  'stderr': b'',
+                  'exitcode': 0,
+                  'cmd': cmd,
+                  'total_sequences': total_sequences}
+        self.commands_run.append({'cmd': cmd, 'metadata': output})
+        return output
+
+    def _run_external_shuffler(self, fasta_in, fasta_out, kmer=2, seed=1):
+        """Run `shuffler_location` to generate random fasta"""
+        cmd = '{} -kmer {} -dna -seed {} {}'.format(self.shuffler_location, kmer, seed,
+                                                    os.path.abspath(fasta_in))
         stdout, stderr, exitcode = run_job(cmd=cmd,
-                                           cwd=os.path.dirname(fasta_out))
+                                           cwd=os.path.dirname(os.path.abspath(fasta_out)))
         with open(os.path.abspath(fasta_out), 'w') as f:
             f.write(stdout.decode('utf-8'))
         output = {'stdout': stdout,
                   'stderr': stderr,
                   'exitcode': exitcode,
                   'cmd': cmd}
+        self.commands_run.append({'cmd': cmd, 'metadata': output})
+        return output
+
+    def get_background_fasta(self, fasta_in, cache_dir, kmer=2, seed=1, processes=None):
+        """Shuffled background for a fasta, generated once and reused
+
+        Backgrounds are cached under `cache_dir` keyed by the content
+        of `fasta_in`, `kmer` and `seed` so all motifs and later runs
+        on the same sequences share one shuffle.
+
+        Parameters
+        ----------
+        fasta_in: str
+            Path to fasta to shuffle
+        cache_dir: str
+            Directory to cache shuffled fasta
+        kmer: int
+            Length of k-mers whose counts are preserved
+        seed: int
+            Random seed
+
+        Returns
+        -------
+        output: dict
+            A dictionary with 'fasta' as path to shuffled fasta
+            and 'cached' as True if no shuffling was done.
+        Backgrounds are always shuffled in-process, `shuffler_location`
+        is not used
+        """
+        if processes is None:
+            processes = self.cpu_cores
+        fasta_out, cached = cached_shuffle_fasta(os.path.abspath(fasta_in), os.path.abspath(cache_dir),
+                                                 kmer=kmer, seed=seed, processes=processes)
+        cmd = 'native-shuffle -kmer {} -seed {} {}'.format(kmer, seed, os.path.abspath(fasta_in))
+        output = {'fasta': fasta_out, 'cached': cached, 'cmd': cmd}
+        self.commands_run.append({'cmd': cmd, 'metadata': output})
         return output
 
     def run_centrimo(self, fasta_in, meme_file, out_dir):
@@ -177,7 +424,7 @@ class Pipeline(ConfigurationParser):
         Returns
         -------
         output: dict
-            A dictionary with 'stderr,stdout,cmd,exitcode,out_dir'
+            A dictionary with 'stderr,stdout,cmd,exitcode,out_dir,cached'
 
         """
         centrimo_binary = self.get_binary_path('meme').strip()
@@ -185,19 +432,20 @@ class Pipeline(ConfigurationParser):
             centrimo_binary = 'centrimo'
         else:
             centrimo_binary += '/centrimo'
-        self.centrimo_location = centrimo_binary
         if not out_dir:
             out_dir = os.path.join(os.path.abspath(os.path.join(os.path.dirname(fasta_in), os.pardir)), 'centrimo_out')
         else:
             out_dir = os.path.abspath(out_dir)
 
-        cmd = '{} -oc {} {} {}'.format(self.centrimo_location, out_dir, os.path.abspath(fasta_in), os.path.abspath(meme_file))
-        stdout, stderr, exitcode = run_job(cmd=cmd,
-                                           cwd=os.path.dirname(out_dir))
+        cmd = '{} -oc {} {} {}'.format(centrimo_binary, out_dir, os.path.abspath(fasta_in), os.path.abspath(meme_file))
+        stdout, stderr, exitcode, cached = self._run_tool(cmd, centrimo_binary,
+                                                          [os.path.abspath(fasta_in),
+                                                           os.path.abspath(meme_file)],
+                                                          out_dir)
 
         output = {'out_dir': out_dir, 'stdout': stdout,
                   'stderr': stderr, 'exitcode': exitcode,
-                  'cmd': cmd}
+                  'cmd': cmd, 'cached': cached}
         self.commands_run.append({'cmd': cmd, 'metadata': output})
         return output
 
@@ -220,11 +468,10 @@ class Pipeline(ConfigurationParser):
         Returns
         -------
         output: dict
-            A dictionary with 'stderr,stdout,cmd,exitcode,out_dir'
+            A dictionary with 'stderr,stdout,cmd,exitcode,out_dir,cached'
         """
-        self.memechip_strargs = strargs
-        if not self.memechip_strargs:
-            self.memechip_strargs = self.memechip_default_params
+        if not strargs:
+            strargs = self.memechip_default_params
         meme_binary = self.get_binary_path('meme').strip()
         if not meme_binary or meme_binary == '':
             # Use meme from envirnonment
@@ -232,23 +479,24 @@ class Pipeline(ConfigurationParser):
         else:
             #  Use absolute path meme
             meme_binary += '/meme-chip'
-        self.meme_location = meme_binary
         if not out_dir:
             out_dir = os.path.join(os.path.dirname(fasta_in), 'memechip_out')
         out_dir = os.path.abspath(out_dir)
-        cmd = '{} {} -oc {} {}'.format(self.meme_location, self.memechip_strargs,
+        cmd = '{} {} -oc {} {}'.format(meme_binary, strargs,
                                        out_dir, os.path.abspath(fasta_in))
-        stdout, stderr, exitcode = run_job(cmd=cmd,
-                                           cwd=os.path.dirname(out_dir))
+        stdout, stderr, exitcode, cached = self._run_tool(cmd, meme_binary,
+                                                          [os.path.abspath(fasta_in)], out_dir)
 
         output = {'out_dir': out_dir, 'stdout': stdout,
                   'stderr': stderr, 'exitcode': exitcode,
-                  'cmd': cmd}
+                  'cmd': cmd, 'cached': cached}
         self.commands_run.append({'cmd': cmd, 'metadata': output})
         return output
 
     @staticmethod
-    def save_conservation_scores(intervals, wig_file, out_directory, out_prefix='phylop'):
+    def save_conservation_scores(intervals, wig_file, out_directory, out_prefix='phylop', processes=1,
+                                 flank_length=None, export_text=False, profile_only=False,
+                                 approximate=False, tolerance=None):
         """Extract and save conservation scores
         Parameters
         ----------
@@ -263,19 +511,130 @@ class Pipeline(ConfigurationParser):
 
         out_prefix: string
             Out file prefix
+
+        processes: int
+            Number of processes to extract scores with
+
+        flank_length: int
+            Flank length around motif, saved with the scores
+
+        export_text: bool
+            Also write scores as text(.raw.txt, .mean.txt)
+
+        profile_only: bool
+            Save mean, variance and count profiles accumulated over
+            batches of sites instead of raw scores
+
+        approximate: bool
+            Read profiles from bigwig zoom levels, implies `profile_only`
+
+        tolerance: float
+            Maximum mean absolute error of zoom levels before
+            falling back to exact values
+
+        Returns
+        -------
+        mean_file: str
+            Path to mean scores(.mean.npy)
         """
-        wig = WigReader(wig_file)
-        conservation_scores = wig.query(intervals)
-        if np.any(conservation_scores):
-            conservation_scores_mean = np.nanmean(conservation_scores, axis=0)
-            np.savetxt(os.path.join(out_directory, '{}.raw.txt'.format(out_prefix)),
-                       conservation_scores, fmt='%.4f')
-            np.savetxt(os.path.join(out_directory, '{}.mean.txt'.format(out_prefix)),
-                       conservation_scores_mean, fmt='%.4f')
-        else:
-            touch(os.path.join(out_directory, '{}.mean.txt'.format(out_prefix)))
-            touch(os.path.join(out_directory, '{}.raw.txt'.format(out_prefix)))
-        return os.path.join(out_directory, '{}.mean.txt'.format(out_prefix))
+        if profile_only or approximate:
+            profile = query_profile(wig_file, intervals, processes=processes,
+                                    approximate=approximate, tolerance=tolerance)
+            return save_profile(profile.mean, profile.variance(), profile.count, out_directory, out_prefix,
+                                total_sites=profile.total_sites, flank_length=flank_length,
+                                wig_file=wig_file, export_text=export_text)
+        conservation_scores, valid = query_matrix_parallel(wig_file, intervals, processes=processes)
+        return save_scores(conservation_scores[valid], out_directory, out_prefix,
+                           flank_length=flank_length, wig_file=wig_file, export_text=export_text)
+
+    @staticmethod
+    def save_multi_conservation_scores(intervals_list, wig_files, out_directories, processes=1,
+                                       flank_length=None, export_text=False, profile_only=False,
+                                       approximate=False, tolerance=None):
+        """Extract and save conservation scores of all tracks together
+
+        All interval sets(e.g. sample and control) are queried
+        against all tracks in one pass.
+
+        Parameters
+        ----------
+        intervals_list: list
+            Interval sets, each an Intervals or list of tuples
+
+        wig_files: dict
+            Wig file location for each track as {out_prefix: wig_file}
+
+        out_directories: list
+            Out file directory for each interval set
+
+        processes: int
+            Number of processes to extract scores with
+
+        flank_length: int
+            Flank length around motif, saved with the scores
+
+        export_text: bool
+            Also write scores as text(.raw.txt, .mean.txt)
+
+        profile_only: bool
+            Save mean, variance and count profiles accumulated over
+            batches of sites instead of raw scores
+
+        approximate: bool
+            Read profiles from bigwig zoom levels, implies `profile_only`
+
+        tolerance: float
+            Maximum mean absolute error of zoom levels before
+            falling back to exact values
+
+        Returns
+        -------
+        mean_files: list
+            Dictionary of {out_prefix: mean score file} for each interval set
+        """
+        prefixes = sorted(wig_files.keys())
+        intervals_list = [x if isinstance(x, Intervals) else Intervals.from_tuples(x)
+                          for x in intervals_list]
+        if profile_only or approximate:
+            return [Pipeline._save_multi_conservation_profiles(intervals, wig_files, out_directory,
+                                                               processes, flank_length, export_text,
+                                                               approximate, tolerance)
+                    for intervals, out_directory in zip(intervals_list, out_directories)]
+        intervals = Intervals.concatenate(intervals_list)
+        scores, valid = query_matrix_parallel([wig_files[prefix] for prefix in prefixes], intervals,
+                                              processes=processes)
+        boundaries = np.cumsum([0] + [len(x) for x in intervals_list])
+        mean_files = []
+        for i, out_directory in enumerate(out_directories):
+            rows = slice(boundaries[i], boundaries[i+1])
+            set_mean_files = {}
+            for track, out_prefix in enumerate(prefixes):
+                conservation_scores = scores[rows, :, track][valid[rows, track]]
+                set_mean_files[out_prefix] = save_scores(conservation_scores, out_directory, out_prefix,
+                                                         flank_length=flank_length,
+                                                         wig_file=wig_files[out_prefix],
+                                                         export_text=export_text)
+            mean_files.append(set_mean_files)
+        return mean_files
+
+    @staticmethod
+    def _save_multi_conservation_profiles(intervals, wig_files, out_directory, processes,
+                                          flank_length, export_text, approximate=False, tolerance=None):
+        """Save profiles of all tracks for one interval set"""
+        prefixes = sorted(wig_files.keys())
+        profile = query_profile([wig_files[prefix] for prefix in prefixes], intervals, processes=processes,
+                                approximate=approximate, tolerance=tolerance)
+        mean = profile.mean
+        variance = profile.variance()
+        mean_files = {}
+        for track, out_prefix in enumerate(prefixes):
+            mean_files[out_prefix] = save_profile(mean[:, track], variance[:, track], profile.count[:, track],
+                                                  out_directory, out_prefix,
+                                                  total_sites=profile.total_sites,
+                                                  flank_length=flank_length,
+                                                  wig_file=wig_files[out_prefix],
+                                                  export_text=export_text)
+        return mean_files
 
     @property
     def get_meme_default_params(self):
@@ -0,0 +1,350 @@
+"""Native position weight matrix scanner
+
+In-process replacement for FIMO. Motifs are converted to
+log-odds matrices against the MEME background and all sequences
+are scored on both strands with vectorized sliding windows.
+p-values are computed from the exact distribution of (scaled, integer)
+scores under the background model, as done by FIMO.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+import numpy as np
+import pandas
+from ..helpers import iter_fasta
+
+__BASES__ = ['A', 'C', 'G', 'T']
+
+# Code of each byte; A,C,G,T map to 0-3 and everything else to 4(invalid)
+__BASE_CODES__ = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(__BASES__):
+    __BASE_CODES__[ord(_base)] = _code
+    __BASE_CODES__[ord(_base.lower())] = _code
+
+__COMPLEMENT_TABLE__ = bytearray(range(256))
+for _base, _complement in zip(bytearray(b'ACGTN'), bytearray(b'TGCAN')):
+    __COMPLEMENT_TABLE__[_base] = _complement
+__COMPLEMENT_TABLE__ = bytes(__COMPLEMENT_TABLE__)
+
+__FIMO_COLUMNS__ = ['#pattern name', 'sequence name', 'start', 'stop',
+                    'strand', 'score', 'p-value', 'q-value', 'matched sequence']
+
+# FIMO defaults
+__PSEUDOCOUNT__ = 0.1
+__DEFAULT_NSITES__ = 20
+__THRESHOLD__ = 1e-4
+
+# Number of integer bins the score range of a motif is scaled to
+__SCORE_RANGE__ = 1000
+
+# Bases scanned at a time, sequences are batched upto this size
+__BATCH_SIZE__ = 1 << 24
+
+
+def reverse_complement(sequence):
+    """Reverse complement a DNA sequence in bytes"""
+    return sequence.translate(__COMPLEMENT_TABLE__)[::-1]
+
+
+def encode_sequence(sequence):
+    """Encode sequence bytes as base codes(A:0, C:1, G:2, T:3, others:4)"""
+    return __BASE_CODES__[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def benjamini_hochberg(pvalues, total_tests):
+    """Return q-values of the smallest p-values out of `total_tests` tests
+
+    Parameters
+    ----------
+    pvalues: np.array
+        p-values of reported hits
+    total_tests: int
+        Number of tests performed(positions scanned)
+
+    Returns
+    -------
+    qvalues: np.array
+        q-values in the same order as `pvalues`
+    """
+    if not len(pvalues):
+        return np.array([])
+    order = np.argsort(pvalues, kind='mergesort')
+    ranked = pvalues[order] * total_tests / np.arange(1, len(pvalues)+1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    qvalues = np.empty(len(pvalues))
+    qvalues[order] = np.minimum(ranked, 1)
+    return qvalues
+
+
+def _score_windows(codes, matrix):
+    """Sum of matrix entries over all windows of `codes`
+
+    Parameters
+    ----------
+    codes: np.array
+        Encoded sequence
+    matrix: np.array
+        (4, motif_length) score matrix
+
+    Returns
+    -------
+    scores: np.array
+        Score of each window starting at position i
+    """
+    length = matrix.shape[1]
+    n_windows = len(codes) - length + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=matrix.dtype)
+    # Invalid bases score 0, windows containing them are masked by the caller
+    padded = np.vstack([matrix, np.zeros((1, length), dtype=matrix.dtype)])
+    scores = np.zeros(n_windows, dtype=matrix.dtype)
+    for j in range(length):
+        scores += padded[codes[j:j+n_windows], j]
+    return scores
+
+
+class MotifScanner(object):
+    """Score sequences against a motif, both strands
+
+    Parameters
+    ----------
+    pwm: dict
+        Letter probability matrix as {"A": [p1, p2, ...], ...}
+        (e.g. `record.pwm` of a Biopython motif)
+    bg_frequencies: dict
+        Background frequencies as returned by `get_motif_bg_freq`
+    nsites: int
+        Number of sites the motif was built from(used for pseudocounts)
+    motif_name: str
+        Name reported in the '#pattern name' column
+    pseudocount: float
+        Pseudocount added to motif counts, weighted by background frequency
+    """
+    def __init__(self, pwm, bg_frequencies, nsites=None, motif_name='1',
+                 pseudocount=__PSEUDOCOUNT__, score_range=__SCORE_RANGE__):
+        self.motif_name = str(motif_name)
+        frequencies = np.array([list(pwm[base]) for base in __BASES__], dtype=np.float64)
+        bg = np.array([bg_frequencies[base] for base in __BASES__], dtype=np.float64)
+        self.bg = bg / bg.sum()
+        nsites = nsites or __DEFAULT_NSITES__
+        frequencies = (frequencies * nsites + pseudocount * self.bg[:, None]) / (nsites + pseudocount)
+        self.length = frequencies.shape[1]
+        self.log_odds = np.log2(frequencies / self.bg[:, None])
+        column_min = self.log_odds.min(axis=0)
+        column_range = (self.log_odds.max(axis=0) - column_min).sum()
+        self.scale = score_range / column_range if column_range > 0 else 1.0
+        self.int_matrix = np.round((self.log_odds - column_min) * self.scale).astype(np.int64)
+        self.pvalues = self._pvalue_table()
+
+    @classmethod
+    def from_motif_record(cls, record, bg_frequencies, motif_name='1', **kwargs):
+        """Create scanner from a Biopython motif record
+
+        Parameters
+        ----------
+        record: Bio.motifs.Motif
+            Motif record as in `read_memefile(meme_file)['motif_records']`
+        bg_frequencies: dict
+            Background frequencies as returned by `get_motif_bg_freq`
+        motif_name: str
+            Name reported in the '#pattern name' column
+        """
+        nsites = getattr(record, 'num_occurrences', None)
+        return cls(record.pwm, bg_frequencies, nsites=nsites, motif_name=motif_name, **kwargs)
+
+    def _pvalue_table(self):
+        """Probability of a background sequence scoring at least each integer score
+
+        Returns
+        -------
+        pvalues: np.array
+            pvalues[s] = P(score >= s)
+        """
+        distribution = np.array([1.0])
+        for j in range(self.length):
+            column = self.int_matrix[:, j]
+            convolved = np.zeros(len(distribution) + column.max())
+            for base in range(len(__BASES__)):
+                convolved[column[base]:column[base]+len(distribution)] += self.bg[base] * distribution
+            distribution = convolved
+        return np.minimum(np.cumsum(distribution[::-1])[::-1], 1.0)
+
+    def _scan_batch(self, batch, threshold):
+        """Scan an encoded batch of sequences
+
+        Parameters
+        ----------
+        batch: SequenceBatch
+            Encoded sequences
+        threshold: float
+            Report hits with p-value below threshold
+
+        Returns
+        -------
+        hits: list
+            List of hit tuples in fimo.txt column order(without q-value)
+        tested: int
+            Number of positions scored on both strands
+        """
+        valid = batch.valid_windows(self.length)
+        if not len(valid):
+            return [], 0
+        hits = []
+        strands = (('+', self.log_odds, self.int_matrix),
+                   ('-', self.log_odds[::-1, ::-1], self.int_matrix[::-1, ::-1]))
+        for strand, matrix, int_matrix in strands:
+            pvalues = self.pvalues[_score_windows(batch.codes, int_matrix)]
+            positions = np.flatnonzero(valid & (pvalues < threshold))
+            if not len(positions):
+                continue
+            scores = _score_windows(batch.codes, matrix)[positions]
+            sequence_index = np.searchsorted(batch.offsets, positions, side='right') - 1
+            starts = positions - batch.offsets[sequence_index]
+            for position, index, start, score, pvalue in zip(positions, sequence_index, starts,
+                                                             scores, pvalues[positions]):
+                matched = batch.joined[position:position+self.length]
+                if strand == '-':
+                    matched = reverse_complement(matched)
+                hits.append((self.motif_name, batch.names[index], int(start)+1, int(start)+self.length,
+                             strand, float(score), float(pvalue), matched.decode('ascii')))
+        return hits, 2 * int(valid.sum())
+
+    def scan(self, records, threshold=__THRESHOLD__):
+        """Scan sequences for motif occurrences
+
+        Parameters
+        ----------
+        records: iterable
+            (name, sequence) tuples, sequence being bytes
+        threshold: float
+            Report hits with p-value below threshold
+
+        Returns
+        -------
+        fimo_df: dataframe
+            Hits in fimo.txt format, sorted by p-value
+        """
+        return scan_motifs([self], records, threshold=threshold)[0]
+
+    def scan_fasta(self, fasta_location, threshold=__THRESHOLD__):
+        """Scan all sequences of a fasta file
+
+        Parameters
+        ----------
+        fasta_location: str
+            Path to fasta file
+        threshold: float
+            Report hits with p-value below threshold
+
+        Returns
+        -------
+        fimo_df: dataframe
+            Hits in fimo.txt format, sorted by p-value
+        """
+        return self.scan(iter_fasta(fasta_location), threshold=threshold)
+
+
+class SequenceBatch(object):
+    """Sequences joined and encoded for scanning
+
+    Sequences are joined with an invalid base so no window spans two sequences
+
+    Parameters
+    ----------
+    names: list
+        Sequence names
+    sequences: list
+        Sequences as bytes
+    """
+    def __init__(self, names, sequences):
+        self.names = names
+        self.offsets = np.cumsum([0] + [len(sequence)+1 for sequence in sequences])
+        self.joined = b'N'.join(sequences)
+        self.codes = encode_sequence(self.joined)
+        self.invalid = np.concatenate([[0], np.cumsum(self.codes == 4)])
+
+    def valid_windows(self, length):
+        """Mask of windows of `length` containing only A,C,G,T"""
+        n_windows = len(self.codes) - length + 1
+        if n_windows <= 0:
+            return np.zeros(0, dtype=bool)
+        return (self.invalid[length:] - self.invalid[:n_windows]) == 0
+
+
+def iter_sequence_batches(records, batch_size=__BATCH_SIZE__):
+    """Group records into encoded batches of about `batch_size` bases
+
+    Parameters
+    ----------
+    records: iterable
+        (name, sequence) tuples, sequence being bytes
+
+    Returns
+    -------
+    batches: generator
+        SequenceBatch objects
+    """
+    names = []
+    sequences = []
+    batch_length = 0
+    for name, sequence in records:
+        names.append(name)
+        sequences.append(sequence)
+        batch_length += len(sequence)
+        if batch_length >= batch_size:
+            yield SequenceBatch(names, sequences)
+            names, sequences, batch_length = [], [], 0
+    if sequences:
+        yield SequenceBatch(names, sequences)
+
+
+def scan_motifs(scanners, records, threshold=__THRESHOLD__):
+    """Scan sequences for occurrences of several motifs in one pass
+
+    Each batch of sequences is read and encoded once
+    and then scored against every motif.
+
+    Parameters
+    ----------
+    scanners: list
+        MotifScanner objects
+    records: iterable
+        (name, sequence) tuples, sequence being bytes
+    threshold: float
+        Report hits with p-value below threshold
+
+    Returns
+    -------
+    fimo_dfs: list
+        Hits in fimo.txt format, sorted by p-value, one per scanner
+    """
+    hits = [[] for _ in scanners]
+    tested = [0 for _ in scanners]
+    for batch in iter_sequence_batches(records):
+        for i, scanner in enumerate(scanners):
+            batch_hits, batch_tested = scanner._scan_batch(batch, threshold)
+            hits[i].extend(batch_hits)
+            tested[i] += batch_tested
+    fimo_dfs = []
+    for scanner_hits, scanner_tested in zip(hits, tested):
+        fimo_df = pandas.DataFrame(scanner_hits, columns=[c for c in __FIMO_COLUMNS__ if c != 'q-value'])
+        fimo_df.insert(__FIMO_COLUMNS__.index('q-value'), 'q-value',
+                       benjamini_hochberg(fimo_df['p-value'].values, scanner_tested))
+        fimo_dfs.append(fimo_df.sort_values(by='p-value', kind='mergesort').reset_index(drop=True))
+    return fimo_dfs
+
+
+def write_fimo_txt(fimo_df, fimo_file):
+    """Write hits in fimo.txt format
+
+    Parameters
+    ----------
+    fimo_df: dataframe
+        Hits as returned by `MotifScanner.scan`
+    fimo_file: str
+        Path to write fimo.txt
+    """
+    fimo_df.to_csv(fimo_file, sep='\t', index=False, float_format='%.6g',
+                   columns=__FIMO_COLUMNS__)
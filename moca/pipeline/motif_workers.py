@@ -0,0 +1,179 @@
+"""Run the per motif stages of find_motifs in worker processes
+
+After MEME every motif goes through the same independent chain:
+FIMO on the shuffled background, FIMO on the test sequences,
+conservation score extraction and plotting. `run_motif_chains`
+runs one chain per motif in a pool of processes, writing to
+the same directories as a serial run.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from multiprocessing import Pool
+import os
+import traceback
+from ..bedoperations.fimo import get_start_stop_intervals
+from ..helpers import MocaException
+from ..helpers.scores import score_file_paths
+from .job_processor import Pipeline
+from .tool_cache import __MAX_CACHE_SIZE__
+
+
+def motif_directories(meme_out_dir, motif):
+    """Return FIMO output directories of a motif
+
+    Parameters
+    ----------
+    meme_out_dir: str
+        MEME output directory
+    motif: int
+        1-based motif number
+
+    Returns
+    -------
+    fimo_main_dir: str
+        FIMO results on test sequences
+    fimo_rand_dir: str
+        FIMO results on shuffled background
+    """
+    return (os.path.join(meme_out_dir, 'fimo_out_{}'.format(motif)),
+            os.path.join(meme_out_dir, 'fimo_random_{}'.format(motif)))
+
+
+def run_motif_chain(config_file, meme_file, motif, sequence_file, random_fasta, wig_files,
+                    tracks=None, centrimo_dir=None, plot_title=None, run_fimo=True,
+                    flank_length=5, processes=1, score_options=None, cache_dir=None,
+                    cache_size=__MAX_CACHE_SIZE__):
+    """Run FIMO, score extraction and plotting for a single motif
+
+    Parameters
+    ----------
+    config_file: str
+        Configuration file
+    meme_file: str
+        Path to meme.txt
+    motif: int
+        1-based motif number
+    sequence_file: str
+        Test sequences
+    random_fasta: str
+        Shuffled background
+    wig_files: dict
+        Conservation tracks as {prefix: path}
+    tracks: list
+        Order of tracks in the plot, all of `wig_files` if None
+    centrimo_dir: str
+        Centrimo output directory, no plot is made if None
+    plot_title: str
+        Plot title
+    run_fimo: bool
+        Run FIMO, False if fimo.txt was already written(e.g. by the native scanner)
+    flank_length: int
+        Number of bases flanking the motif on each side
+    processes: int
+        Number of processes extracting scores
+    score_options: dict
+        Keyword arguments to `Pipeline.save_multi_conservation_scores`
+    cache_dir: str
+        Directory caching fimo runs, as for `Pipeline`
+    cache_size: int
+        Size limit of the run cache in bytes
+
+    Returns
+    -------
+    output: dict
+        'motif', 'sample_score_files', 'control_score_files' and
+        'commands_run' of the chain
+    """
+    pipeline = Pipeline(config_file, cache_dir=cache_dir, cache_size=cache_size)
+    fimo_main_dir, fimo_rand_dir = motif_directories(os.path.dirname(meme_file), motif)
+    if run_fimo:
+        for sequences, out_dir in [(random_fasta, fimo_rand_dir), (sequence_file, fimo_main_dir)]:
+            fimo_out = pipeline.run_fimo(motif_file=meme_file, motif_num=motif,
+                                         sequence_file=sequences, out_dir=out_dir)
+            if fimo_out['exitcode'] != 0:
+                raise MocaException('Error running fimo: {}'.format(fimo_out['stderr']))
+    main_intervals = get_start_stop_intervals(os.path.join(fimo_main_dir, 'fimo.txt'), flank_length=flank_length)
+    random_intervals = get_start_stop_intervals(os.path.join(fimo_rand_dir, 'fimo.txt'), flank_length=flank_length)
+    pipeline.save_multi_conservation_scores([main_intervals, random_intervals],
+                                            wig_files,
+                                            [fimo_main_dir, fimo_rand_dir],
+                                            processes=processes,
+                                            flank_length=flank_length,
+                                            **(score_options or {}))
+    if tracks is None:
+        tracks = sorted(wig_files.keys())
+    tracks = [key for key in tracks if key in wig_files]
+    sample_score_files = [score_file_paths(fimo_main_dir, key)['mean'] for key in tracks]
+    control_score_files = [score_file_paths(fimo_rand_dir, key)['mean'] for key in tracks]
+    if centrimo_dir is not None:
+        # matplotlib is only needed for plotting
+        from ..plotter import create_plot
+        create_plot(meme_file,
+                    plot_title,
+                    centrimo_dir=centrimo_dir,
+                    motif_number=motif,
+                    flank_length=flank_length,
+                    sample_score_files=sample_score_files,
+                    control_score_files=control_score_files,
+                    reg_plot_titles=[key.capitalize() for key in tracks],
+                    annotate=None)
+    return {'motif': motif,
+            'sample_score_files': sample_score_files,
+            'control_score_files': control_score_files,
+            'commands_run': pipeline.commands_run}
+
+
+def _run_motif_chain(kwargs):
+    """Pool worker, returns failures instead of raising"""
+    try:
+        return kwargs['motif'], run_motif_chain(**kwargs), None
+    except Exception as e:
+        return kwargs['motif'], None, '{}\n{}'.format(e, traceback.format_exc())
+
+
+def run_motif_chains(motifs, workers=1, **kwargs):
+    """Run `run_motif_chain` for every motif in worker processes
+
+    A failed motif does not stop the others; failures are
+    raised together once all motifs have finished.
+
+    Parameters
+    ----------
+    motifs: list
+        1-based motif numbers
+    workers: int
+        Number of motifs processed at a time
+    kwargs: dict
+        Arguments to `run_motif_chain` other than `motif`.
+        Pool workers cannot start processes of their own, so
+        scores are extracted by a single process per motif
+        when `workers` > 1.
+
+    Returns
+    -------
+    results: dict
+        Output of `run_motif_chain` as {motif: output}
+    """
+    tasks = [dict(kwargs, motif=motif) for motif in motifs]
+    if workers > 1 and len(tasks) > 1:
+        for task in tasks:
+            task['processes'] = 1
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            outputs = pool.map(_run_motif_chain, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [_run_motif_chain(task) for task in tasks]
+    results = {}
+    failures = []
+    for motif, result, error in outputs:
+        if error is not None:
+            failures.append('Motif {} failed: {}'.format(motif, error))
+        else:
+            results[motif] = result
+    if failures:
+        raise MocaException('\n'.join(failures))
+    return results
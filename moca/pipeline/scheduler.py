@@ -0,0 +1,209 @@
+"""Run pipeline stages as a dependency graph
+
+Each task declares the files it reads(inputs) and writes(outputs).
+A task depends on every task producing one of its inputs and
+runs in a thread as soon as all of them have finished, upto
+a fixed number of tasks at a time. Stages are mostly external
+programs or numpy code, so threads run them concurrently.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+from collections import OrderedDict
+import os
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from ..helpers import MocaException
+
+
+class Task(object):
+    """A single stage of the pipeline
+
+    Parameters
+    ----------
+    name: str
+        Unique task name
+    func: callable
+        Function to run, e.g. a `Pipeline.run_*` method
+    args: tuple
+        Positional arguments to `func`
+    kwargs: dict
+        Keyword arguments to `func`
+    inputs: list
+        Files read by the task
+    outputs: list
+        Files or directories written by the task
+    requires: list
+        Names of tasks to wait for besides those producing `inputs`
+    exclusive: str
+        Tasks sharing the same `exclusive` name never run together
+        (e.g. for code that is not thread safe)
+    """
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=(),
+                 requires=(), exclusive=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.inputs = [os.path.abspath(x) for x in inputs]
+        self.outputs = [os.path.abspath(x) for x in outputs]
+        self.requires = list(requires)
+        self.exclusive = exclusive
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return 'Task({})'.format(self.name)
+
+
+class TaskGraph(object):
+    """Dependency graph of tasks run with a concurrency limit
+
+    Parameters
+    ----------
+    max_workers: int
+        Maximum number of tasks running at a time
+    """
+    def __init__(self, max_workers=1):
+        self.max_workers = max(int(max_workers), 1)
+        self.tasks = OrderedDict()
+
+    def add_task(self, name, func, args=(), kwargs=None, inputs=(), outputs=(),
+                 requires=(), exclusive=None):
+        """Add a task to the graph, arguments as for `Task`
+
+        Returns
+        -------
+        task: Task
+        """
+        if name in self.tasks:
+            raise MocaException('Task {} already exists'.format(name))
+        task = Task(name, func, args=args, kwargs=kwargs, inputs=inputs, outputs=outputs,
+                    requires=requires, exclusive=exclusive)
+        self.tasks[name] = task
+        return task
+
+    def dependencies(self):
+        """Names of tasks each task waits for
+
+        Returns
+        -------
+        dependencies: dict
+            {task_name: set of task names}
+        """
+        producers = {}
+        for task in self.tasks.values():
+            for output in task.outputs:
+                producers[output] = task.name
+        dependencies = {}
+        for task in self.tasks.values():
+            names = set(task.requires)
+            for path in task.inputs:
+                # An input is produced by a task writing it or a directory containing it
+                parent = path
+                while parent:
+                    if parent in producers:
+                        names.add(producers[parent])
+                        break
+                    if os.path.dirname(parent) == parent:
+                        break
+                    parent = os.path.dirname(parent)
+            names.discard(task.name)
+            missing = [x for x in names if x not in self.tasks]
+            if missing:
+                raise MocaException('Task {} requires unknown tasks: {}'.format(task.name, missing))
+            dependencies[task.name] = names
+        return dependencies
+
+    def order(self):
+        """Return task names in an order respecting dependencies
+
+        Raises MocaException if the graph has a cycle
+        """
+        dependencies = self.dependencies()
+        ordered = []
+        remaining = OrderedDict((name, set(deps)) for name, deps in dependencies.items())
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise MocaException('Tasks have cyclic dependencies: {}'.format(list(remaining.keys())))
+            for name in ready:
+                ordered.append(name)
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return ordered
+
+    def run(self, on_finish=None):
+        """Run all tasks
+
+        Tasks start as soon as their dependencies have finished.
+        If a task fails no new tasks are started, running tasks
+        are waited for and a MocaException is raised.
+
+        Parameters
+        ----------
+        on_finish: callable
+            Called with the task name as each task finishes(in the calling thread)
+
+        Returns
+        -------
+        results: dict
+            Return value of each task as {task_name: result}
+        """
+        dependencies = self.dependencies()
+        order = self.order()
+        finished = queue.Queue()
+        results = {}
+        failures = OrderedDict()
+        done = set()
+        running = {}
+        busy = set()
+
+        def _run(task):
+            try:
+                finished.put((task.name, task.run(), None))
+            except Exception as e:
+                finished.put((task.name, None, (e, traceback.format_exc())))
+
+        pending = list(order)
+        while pending or running:
+            if not failures:
+                for name in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    task = self.tasks[name]
+                    if not dependencies[name] <= done:
+                        continue
+                    if task.exclusive is not None and task.exclusive in busy:
+                        continue
+                    pending.remove(name)
+                    if task.exclusive is not None:
+                        busy.add(task.exclusive)
+                    thread = threading.Thread(target=_run, args=(task,), name='moca-{}'.format(name))
+                    thread.daemon = True
+                    running[name] = thread
+                    thread.start()
+            if not running:
+                break
+            name, result, error = finished.get()
+            running.pop(name).join()
+            busy.discard(self.tasks[name].exclusive)
+            if error is not None:
+                failures[name] = error
+            else:
+                results[name] = result
+                done.add(name)
+                if on_finish is not None:
+                    on_finish(name)
+        if failures:
+            message = '\n'.join('Task {} failed: {}\n{}'.format(name, error, trace)
+                                for name, (error, trace) in failures.items())
+            raise MocaException(message)
+        return results
@@ -0,0 +1,245 @@
+"""Native k-mer preserving sequence shuffler
+
+In-process replacement for `fasta-shuffle-letters -kmer k`.
+Each sequence is shuffled with the Altschul-Erickson algorithm:
+the sequence is seen as an Eulerian path over the graph of its
+(k-1)-mers, a random arborescence rooted at the last (k-1)-mer
+fixes the last exit edge of every vertex and the remaining
+edges are permuted, so that the resulting walk uses every
+k-mer exactly as many times as the original sequence.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import range
+from multiprocessing import Pool
+import os
+import tempfile
+import numpy as np
+from ..helpers import file_checksum
+from ..helpers import iter_fasta
+from ..helpers import safe_makedir
+from ..helpers import write_fasta_record
+
+# fasta-shuffle-letters defaults
+__DEFAULT_KMER__ = 2
+__DEFAULT_SEED__ = 1
+__SHUFFLED_SUFFIX__ = '_shuf'
+
+# Records sent to a worker at a time
+__CHUNKSIZE__ = 64
+
+# Bump to invalidate backgrounds cached by an older shuffler
+__BACKGROUND_CACHE_VERSION__ = 1
+
+
+def _random_arborescence(edge_starts, edge_counts, edge_targets, root, rng):
+    """Choose the last exit edge of every vertex (Wilson's algorithm)
+
+    Parameters
+    ----------
+    edge_starts: np.array
+        Index of the first out-edge of each vertex in `edge_targets`
+    edge_counts: np.array
+        Number of out-edges of each vertex
+    edge_targets: np.array
+        Target vertex of each edge, edges grouped by source vertex
+    root: int
+        Vertex the sequence ends at
+    rng: np.random.RandomState
+        Random number generator
+
+    Returns
+    -------
+    last_edges: list
+        Edge index of last exit from each vertex other than root
+    """
+    n_vertices = len(edge_starts)
+    in_tree = [False] * n_vertices
+    in_tree[root] = True
+    next_edge = [0] * n_vertices
+    for vertex in range(n_vertices):
+        u = vertex
+        while not in_tree[u]:
+            next_edge[u] = edge_starts[u] + rng.randint(edge_counts[u])
+            u = edge_targets[next_edge[u]]
+        u = vertex
+        while not in_tree[u]:
+            in_tree[u] = True
+            u = edge_targets[next_edge[u]]
+    return [next_edge[vertex] for vertex in range(n_vertices) if vertex != root]
+
+
+def shuffle_sequence(sequence, kmer=__DEFAULT_KMER__, rng=None):
+    """Shuffle a sequence preserving its k-mer counts
+
+    Parameters
+    ----------
+    sequence: bytes
+        Sequence to shuffle
+    kmer: int
+        Length of k-mers whose counts are preserved (2 for dinucleotides)
+    rng: np.random.RandomState
+        Random number generator
+
+    Returns
+    -------
+    shuffled: bytes
+        Shuffled sequence, beginning and ending with the
+        same (k-1)-mers as `sequence`
+    """
+    if rng is None:
+        rng = np.random.RandomState(__DEFAULT_SEED__)
+    codes = np.frombuffer(sequence, dtype=np.uint8)
+    if kmer < 2:
+        return codes[rng.permutation(len(codes))].tobytes()
+    n_edges = len(codes) - kmer + 1
+    if n_edges < 2:
+        return bytes(sequence)
+    # Vertices are the distinct (k-1)-mers
+    words = np.column_stack([codes[j:j+n_edges+1] for j in range(kmer-1)])
+    vertex_words, vertices = np.unique(words, axis=0, return_inverse=True)
+    vertices = vertices.ravel()
+    sources = vertices[:-1]
+    targets = vertices[1:]
+    n_vertices = len(vertex_words)
+    # Group edges by source vertex
+    order = np.argsort(sources, kind='mergesort')
+    sources = sources[order]
+    targets = targets[order]
+    edge_counts = np.bincount(sources, minlength=n_vertices)
+    edge_starts = np.concatenate([[0], np.cumsum(edge_counts)[:-1]])
+    root = vertices[-1]
+    is_last = np.zeros(n_edges, dtype=bool)
+    is_last[_random_arborescence(edge_starts.tolist(), edge_counts.tolist(),
+                                 targets.tolist(), root, rng)] = True
+    # Randomly order the out-edges of each vertex, keeping the last edge last
+    order = np.lexsort((rng.random_sample(n_edges), is_last, sources))
+    targets = targets[order].tolist()
+    last_letters = vertex_words[:, -1].tolist()
+    positions = edge_starts.tolist()
+    shuffled = bytearray(vertex_words[vertices[0]].tobytes())
+    vertex = vertices[0]
+    for _ in range(n_edges):
+        edge = positions[vertex]
+        positions[vertex] += 1
+        vertex = targets[edge]
+        shuffled.append(last_letters[vertex])
+    return bytes(shuffled)
+
+
+def _shuffle_record(task):
+    """Shuffle a single fasta record with its own seeded generator"""
+    index, name, sequence, kmer, seed = task
+    rng = np.random.RandomState([seed, index])
+    return name + __SHUFFLED_SUFFIX__, shuffle_sequence(sequence, kmer=kmer, rng=rng)
+
+
+def shuffle_fasta(fasta_in, fasta_out, kmer=__DEFAULT_KMER__, seed=__DEFAULT_SEED__, processes=1):
+    """Write k-mer preserving shuffles of all sequences of a fasta file
+
+    Every record gets its own generator seeded by `seed` and
+    the record number, so output does not depend on `processes`.
+
+    Parameters
+    ----------
+    fasta_in: str
+        Path to input fasta
+    fasta_out: str
+        Path to write shuffled fasta
+    kmer: int
+        Length of k-mers whose counts are preserved
+    seed: int
+        Random seed
+    processes: int
+        Number of processes shuffling sequences in parallel
+
+    Returns
+    -------
+    total_sequences: int
+        Number of sequences written
+    """
+    tasks = ((index, name, sequence, kmer, seed)
+             for index, (name, sequence) in enumerate(iter_fasta(fasta_in)))
+    pool = None
+    if processes and processes > 1:
+        pool = Pool(processes)
+        shuffled = pool.imap(_shuffle_record, tasks, chunksize=__CHUNKSIZE__)
+    else:
+        shuffled = (_shuffle_record(task) for task in tasks)
+    total_sequences = 0
+    try:
+        with open(fasta_out, 'wb') as f:
+            for name, sequence in shuffled:
+                write_fasta_record(f, name, sequence)
+                total_sequences += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total_sequences
+
+
+def background_cache_location(cache_dir, fasta_in, kmer=__DEFAULT_KMER__, seed=__DEFAULT_SEED__):
+    """Return the cached location of shuffled background for a fasta
+
+    Parameters
+    ----------
+    cache_dir: str
+        Root directory for all cached backgrounds
+    fasta_in: str
+        Path to fasta to shuffle
+    kmer: int
+        Length of k-mers whose counts are preserved
+    seed: int
+        Random seed
+
+    Returns
+    -------
+    location: str
+        Fasta path keyed by input content, k-mer length and seed
+    """
+    key = '{}_k{}_s{}_v{}.fasta'.format(file_checksum(fasta_in), kmer, seed,
+                                        __BACKGROUND_CACHE_VERSION__)
+    return os.path.join(cache_dir, key)
+
+
+def cached_shuffle_fasta(fasta_in, cache_dir, kmer=__DEFAULT_KMER__, seed=__DEFAULT_SEED__, processes=1):
+    """Shuffle a fasta unless the same shuffle is already cached
+
+    The background is first written to a temporary file which is
+    then renamed, so concurrent readers never see partial files.
+
+    Parameters
+    ----------
+    fasta_in: str
+        Path to fasta to shuffle
+    cache_dir: str
+        Root directory for all cached backgrounds
+    kmer: int
+        Length of k-mers whose counts are preserved
+    seed: int
+        Random seed
+    processes: int
+        Number of processes shuffling sequences in parallel
+
+    Returns
+    -------
+    location: str
+        Path to shuffled fasta
+    cached: bool
+        True if the background was already cached
+    """
+    location = background_cache_location(cache_dir, fasta_in, kmer=kmer, seed=seed)
+    if os.path.isfile(location):
+        return location, True
+    safe_makedir(cache_dir)
+    handle, temp_location = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(handle)
+    try:
+        shuffle_fasta(fasta_in, temp_location, kmer=kmer, seed=seed, processes=processes)
+        os.rename(temp_location, location)
+    finally:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+    return location, False
@@ -0,0 +1,246 @@
+"""On-disk cache of MEME suite program outputs
+
+Each run of meme, fimo, centrimo or meme-chip is keyed by the
+identity of the program binary, its argument string and the content
+of its input files. A cached run is a directory holding a copy of
+the program's output directory and its stdout/stderr, so a repeated
+run restores the output directory instead of running the program.
+Least recently used runs are evicted once the cache exceeds its size.
+Each run records its size and last use in a small sidecar file, so
+eviction reads neither the cached outputs nor their stdout/stderr.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from ..helpers import file_checksum
+from ..helpers import safe_makedir
+
+# Bump to invalidate runs cached with an older layout
+__TOOL_CACHE_VERSION__ = 3
+
+# Default size limit of the cache in bytes
+__MAX_CACHE_SIZE__ = 10 * (1 << 30)
+
+__RESULT_FILE__ = 'result.json'
+__OUTPUT_DIR__ = 'output'
+# Holds the size of a cached run in bytes, its mtime is the last use
+__SIZE_FILE__ = 'size'
+
+# Names of cached runs, as made by `tool_cache_location`
+__ENTRY_REGEX__ = re.compile(r'^[0-9a-f]{40}_v(\d+)$')
+
+# Process counts(meme -p, meme-chip -meme-p) do not change the output
+__PROCESSES_ARG_REGEX__ = re.compile(r'(^|\s)-(meme-)?p\s+\d+(?=\s|$)')
+
+
+def binary_identity(binary):
+    """Return a string identifying a program binary
+
+    Binaries are resolved through PATH and identified by their
+    real path, size and modification time, so upgrading a
+    program invalidates its cached runs.
+
+    Parameters
+    ----------
+    binary: str
+        Program name or path
+
+    Returns
+    -------
+    identity: str
+    """
+    candidates = [binary]
+    if not os.path.dirname(binary):
+        candidates = [os.path.join(path, binary) for path in os.environ.get('PATH', '').split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            path = os.path.realpath(candidate)
+            stat = os.stat(path)
+            return '{}:{}:{}'.format(path, stat.st_size, int(stat.st_mtime))
+    return binary
+
+
+def tool_cache_location(cache_dir, cmd, binary, input_files, out_dir):
+    """Return the cache directory for a program run
+
+    Process counts (meme's -p, meme-chip's -meme-p) are left out
+    of the key, a run with a different number of processes gives
+    the same output.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Root directory for all cached runs
+    cmd: str
+        Command line as run
+    binary: str
+        Program as it appears at the start of `cmd`
+    input_files: list
+        Files read by the program, as they appear in `cmd`
+    out_dir: str
+        Output directory as it appears in `cmd`
+
+    Returns
+    -------
+    location: str
+        Directory keyed by binary, arguments and input content
+    """
+    # Paths are replaced by placeholders so that the same run
+    # into a different output directory is a cache hit
+    args = cmd[len(binary):] if cmd.startswith(binary) else cmd
+    args = __PROCESSES_ARG_REGEX__.sub('', args)
+    args = args.replace(out_dir, '{out_dir}')
+    for i, path in enumerate(input_files):
+        args = args.replace(path, '{{input{}}}'.format(i))
+    sha1 = hashlib.sha1()
+    sha1.update(binary_identity(binary).encode('utf-8'))
+    sha1.update(args.encode('utf-8'))
+    for path in input_files:
+        sha1.update(file_checksum(path).encode('utf-8'))
+    key = '{}_v{}'.format(sha1.hexdigest(), __TOOL_CACHE_VERSION__)
+    return os.path.join(cache_dir, key)
+
+
+def load_tool_result(location, out_dir):
+    """Restore the output directory of a cached run
+
+    Parameters
+    ----------
+    location: str
+        Cache directory as returned by `tool_cache_location`
+    out_dir: str
+        Output directory to restore
+
+    Returns
+    -------
+    result: dict
+        'stdout' and 'stderr' of the cached run or None if not cached
+    """
+    result_file = os.path.join(location, __RESULT_FILE__)
+    if not os.path.isfile(result_file):
+        return None
+    try:
+        with open(result_file) as f:
+            result = json.load(f)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        shutil.copytree(os.path.join(location, __OUTPUT_DIR__), out_dir)
+        # Mark as recently used
+        os.utime(os.path.join(location, __SIZE_FILE__), None)
+    except (IOError, OSError, ValueError):
+        # Evicted by another process while restoring
+        return None
+    return {'stdout': result['stdout'].encode('utf-8'),
+            'stderr': result['stderr'].encode('utf-8')}
+
+
+def save_tool_result(location, out_dir, stdout, stderr, max_size=__MAX_CACHE_SIZE__):
+    """Cache the output directory of a run
+
+    The run is first copied to a temporary directory which is
+    then renamed, so concurrent readers never see partial runs.
+    Least recently used runs are then evicted to keep the
+    cache under `max_size`.
+
+    Parameters
+    ----------
+    location: str
+        Cache directory as returned by `tool_cache_location`
+    out_dir: str
+        Output directory of the run
+    stdout: bytes
+        Standard output of the run
+    stderr: bytes
+        Standard error of the run
+    max_size: int
+        Size limit of the cache in bytes
+    """
+    cache_dir = safe_makedir(os.path.dirname(location))
+    temp_dir = tempfile.mkdtemp(dir=cache_dir)
+    shutil.copytree(out_dir, os.path.join(temp_dir, __OUTPUT_DIR__))
+    result = {'stdout': stdout.decode('utf-8', 'replace'),
+              'stderr': stderr.decode('utf-8', 'replace')}
+    with open(os.path.join(temp_dir, __RESULT_FILE__), 'w') as f:
+        json.dump(result, f)
+    # Recorded so that eviction need not walk cached directories
+    with open(os.path.join(temp_dir, __SIZE_FILE__), 'w') as f:
+        f.write(str(_directory_size(temp_dir)))
+    try:
+        os.rename(temp_dir, location)
+    except OSError:
+        # Another process cached the same run first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    evict_tool_cache(cache_dir, max_size=max_size, keep=[location])
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                continue
+    return size
+
+
+def evict_tool_cache(cache_dir, max_size=__MAX_CACHE_SIZE__, keep=()):
+    """Remove least recently used runs until the cache fits `max_size`
+
+    Runs cached with an older layout, which can no longer be
+    restored, are always removed.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Root directory for all cached runs
+    max_size: int
+        Size limit of the cache in bytes
+    keep: list
+        Cache directories never evicted
+
+    Returns
+    -------
+    evicted: list
+        Cache directories removed
+    """
+    entries = []
+    evicted = []
+    for name in os.listdir(cache_dir):
+        match = __ENTRY_REGEX__.match(name)
+        if not match:
+            # Run being written by `save_tool_result`
+            continue
+        location = os.path.join(cache_dir, name)
+        if int(match.group(1)) != __TOOL_CACHE_VERSION__:
+            shutil.rmtree(location, ignore_errors=True)
+            evicted.append(location)
+            continue
+        size_file = os.path.join(location, __SIZE_FILE__)
+        try:
+            last_used = os.path.getmtime(size_file)
+            with open(size_file) as f:
+                size = int(f.read())
+        except (IOError, OSError, ValueError):
+            # Removed by another process
+            continue
+        entries.append((last_used, location, size))
+    total_size = sum(size for _, _, size in entries)
+    if total_size <= max_size:
+        return evicted
+    keep = set(os.path.abspath(location) for location in keep)
+    for _, location, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        if os.path.abspath(location) in keep:
+            continue
+        shutil.rmtree(location, ignore_errors=True)
+        total_size -= size
+        evicted.append(location)
+    return evicted
@@ -28,6 +28,7 @@ click.disable_unicode_literals_warning = True
 
 from moca.helpers import get_max_occuring_bases
 from moca.helpers import get_total_sequences
+from moca.helpers import load_scores
 from moca.helpers import MocaException
 from moca.helpers import read_centrimo_stats
 from moca.helpers import read_centrimo_txt
@@ -509,9 +510,9 @@ def create_plot(meme_file,
     motif_number: int
         1-based number of motif in the motif file
     sample_score_files: list
-        Path to conservation scores files for sample
+        Path to conservation scores files for sample(.npy or text)
     control_score_files: list
-        Path to conservation score files for control
+        Path to conservation score files for control(.npy or text)
     legend_titles: list
         List of legend titles
     """
@@ -550,9 +551,9 @@ def create_plot(meme_file,
     sample_conservation_scores = []
     control_conservation_scores = []
     for i in range(0, len(sample_score_files)):
-        sample_conservation_scores.append(np.loadtxt(sample_score_files[i]))
+        sample_conservation_scores.append(load_scores(sample_score_files[i]))
     for i in range(0, len(control_score_files)):
-        control_conservation_scores.append(np.loadtxt(control_score_files[i]))
+        control_conservation_scores.append(load_scores(control_score_files[i]))
 
     motif = record
     motif_length = motif.length
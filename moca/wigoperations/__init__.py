@@ -2,3 +2,17 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from .query import WigReader
+from .query import read_zoom_levels
+from .parallel import query_matrix_parallel
+from .memmap import MemmapWigReader
+from .memmap import build_track_cache
+from .memmap import track_cache_location
+from .memmap import is_track_cache
+from .memmap import open_wig
+from .multi import MultiWigReader
+from .profile import ProfileAccumulator
+from .profile import iter_query_matrix
+from .profile import query_profile
+from .pool import HandlePool
+from .pool import get_handle_pool
+from .pool import set_max_open_files
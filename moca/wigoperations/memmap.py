@@ -0,0 +1,212 @@
+"""Dense conservation tracks stored as memory mapped arrays
+
+A bigwig is decompressed once into a directory holding one
+.npy file per chromosome. `MemmapWigReader` reads such a directory
+with the same interface as `WigReader`, regions being slices
+of the memory mapped arrays.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import range
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from ..helpers import MocaException
+from ..helpers import safe_makedir
+from .query import WigReader
+
+# Bump to invalidate tracks written with an older layout
+__TRACK_CACHE_VERSION__ = 1
+
+__TRACK_DTYPES__ = ['float16', 'float32']
+__METADATA_FILE__ = 'metadata.json'
+
+# Bases decompressed from the bigwig at a time
+__BUILD_CHUNK_SIZE__ = 1 << 24
+
+
+def track_cache_location(config_file, genome_build, key, dtype='float32'):
+    """Return the directory of a dense track built for a genome
+
+    Tracks are stored next to the configuration file
+    as moca_tracks/<genome_build>/<key>_<dtype>
+
+    Parameters
+    ----------
+    config_file: str
+        Path to configuration file
+    genome_build: str
+        Genome name as in 'genome:<genome_build>' section
+    key: str
+        Track key (phylop, gerp, phastcons)
+    dtype: str
+        float16 or float32
+
+    Returns
+    -------
+    location: str
+        Track directory
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(config_file)), 'moca_tracks',
+                        genome_build, '{}_{}'.format(key, dtype))
+
+
+def is_track_cache(location):
+    """Check if location is a dense track directory"""
+    return os.path.isfile(os.path.join(location, __METADATA_FILE__))
+
+
+def build_track_cache(wig_location, location, dtype='float32', chunk_size=__BUILD_CHUNK_SIZE__):
+    """Decompress a bigwig into per chromosome memory mapped arrays
+
+    Arrays are first written to a temporary directory which is
+    then renamed, so readers never see partial tracks.
+
+    Parameters
+    ----------
+    wig_location: str
+        Path to bigwig
+    location: str
+        Track directory as returned by `track_cache_location`
+    dtype: str
+        float16 or float32
+    chunk_size: int
+        Bases read from the bigwig at a time
+
+    Returns
+    -------
+    location: str
+        Track directory
+    """
+    if dtype not in __TRACK_DTYPES__:
+        raise MocaException('Track dtype should be one of {}, found: {}'.format(__TRACK_DTYPES__, dtype))
+    parent_dir = safe_makedir(os.path.dirname(os.path.abspath(location)))
+    temp_dir = tempfile.mkdtemp(dir=parent_dir)
+    wig = WigReader(wig_location)
+    chrom_lengths = wig.get_chromosomes
+    try:
+        for i, (chrom, chrom_length) in enumerate(sorted(chrom_lengths.items())):
+            track = np.lib.format.open_memmap(os.path.join(temp_dir, '{}.npy'.format(i)), mode='w+',
+                                              dtype=dtype, shape=(chrom_length,))
+            for start in range(0, chrom_length, chunk_size):
+                end = min(start + chunk_size, chrom_length)
+                track[start:end] = wig.values(chrom, start, end)
+            track.flush()
+            del track
+        metadata = {'source': os.path.abspath(wig_location),
+                    'dtype': dtype,
+                    'chroms': sorted(chrom_lengths.keys()),
+                    'lengths': [chrom_lengths[chrom] for chrom in sorted(chrom_lengths.keys())],
+                    'version': __TRACK_CACHE_VERSION__}
+        with open(os.path.join(temp_dir, __METADATA_FILE__), 'w') as f:
+            json.dump(metadata, f)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    finally:
+        wig.close()
+    if os.path.isdir(location):
+        shutil.rmtree(location)
+    os.rename(temp_dir, location)
+    return location
+
+
+class MemmapWigReader(WigReader):
+    """Read and query dense tracks built by `build_track_cache`
+
+    Parameters
+    ----------
+    track_location: str
+        Track directory
+    """
+    def __init__(self, track_location):
+        self.wig_location = track_location
+        metadata_file = os.path.join(track_location, __METADATA_FILE__)
+        if not os.path.isfile(metadata_file):
+            raise MocaException('Error reading track: {} not found'.format(metadata_file))
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        if metadata['version'] != __TRACK_CACHE_VERSION__:
+            raise MocaException('Track {} was built by an older version, rebuild it'.format(track_location))
+        self.dtype = metadata['dtype']
+        self.chrom_lengths = dict(zip(metadata['chroms'], metadata['lengths']))
+        self.chrom_files = dict((chrom, os.path.join(track_location, '{}.npy'.format(i)))
+                                for i, chrom in enumerate(metadata['chroms']))
+        self.tracks = {}
+
+    def track(self, chrom):
+        """Memory mapped scores of a chromosome"""
+        if chrom not in self.tracks:
+            self.tracks[chrom] = np.load(self.chrom_files[chrom], mmap_mode='r')
+        return self.tracks[chrom]
+
+    def values(self, chrom, start, end):
+        """Scores at each base of a region as a view into the track"""
+        return self.track(chrom)[start:end]
+
+    @property
+    def zoom_levels(self):
+        """Dense tracks have no zoom levels"""
+        return []
+
+    def acquire(self):
+        """Memory maps need no handle"""
+        return None
+
+    def release(self, wig):
+        pass
+
+    def value_fetcher(self, wig):
+        return self.values
+
+    def bin_means(self, chrom, start, end, bins, exact=False, wig=None):
+        """Mean score of equal bins of a region, always exact for dense tracks"""
+        values = np.asarray(self.values(chrom, start, end), dtype=np.float32)
+        if len(values) % bins == 0:
+            values = values.reshape(bins, -1)
+            present = ~np.isnan(values)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (np.where(present, values, 0).sum(axis=1) / present.sum(axis=1)).astype(np.float32)
+        means = np.full(bins, np.nan, dtype=np.float32)
+        for i, chunk in enumerate(np.array_split(values, bins)):
+            chunk = chunk[~np.isnan(chunk)]
+            if len(chunk):
+                means[i] = chunk.mean()
+        return means
+
+    @property
+    def get_chromosomes(self):
+        """Return list of chromsome and their sizes
+        as in the source wig file
+
+        Returns
+        -------
+        chroms: dict
+            Dictionary with {"chr": "Length"} format
+
+        """
+        return self.chrom_lengths
+
+    def close(self):
+        """Release memory maps"""
+        self.tracks = {}
+
+
+def open_wig(location):
+    """Open a bigwig or a dense track directory
+
+    Parameters
+    ----------
+    location: str
+        Path to bigwig or track directory
+
+    Returns
+    -------
+    reader: WigReader or MemmapWigReader
+    """
+    if os.path.isdir(location):
+        return MemmapWigReader(location)
+    return WigReader(location)
@@ -0,0 +1,130 @@
+"""Query several conservation tracks together
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+import warnings
+import numpy as np
+from ..helpers import Intervals
+from ..helpers import MocaException
+from .memmap import open_wig
+from .query import _equal_width_intervals
+
+
+class MultiWigReader(object):
+    """Read and query several bigwigs(or dense tracks) at once
+
+    Parameters
+    ----------
+    wig_locations: list
+        Paths to bigwigs or dense track directories
+    """
+    def __init__(self, wig_locations):
+        self.wig_location = list(wig_locations)
+        self.readers = [open_wig(location) for location in self.wig_location]
+        self.chrom_lengths = [reader.get_chromosomes for reader in self.readers]
+
+    def query_matrix(self, intervals):
+        """Query regions of equal width for scores on all tracks
+
+        Intervals are grouped by chromosome and validated once,
+        every interval is then read from all tracks.
+
+        Parameters
+        ----------
+        intervals: Intervals or list of tuples
+            Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+
+        Returns
+        -------
+        scores: np.array
+            float32 array of shape (len(intervals), width, tracks)
+        valid: np.array
+            Boolean mask of shape (len(intervals), tracks), False where
+            the chromosome of an interval does not appear in a track
+        """
+        if not isinstance(intervals, Intervals):
+            intervals = Intervals.from_tuples(intervals)
+        widths = np.unique(intervals.widths)
+        if len(widths) > 1:
+            raise MocaException('All intervals should have the same width, found: {}'.format(widths))
+        width = int(widths[0]) if len(widths) else 0
+        scores = np.full((len(intervals), width, len(self.readers)), np.nan, dtype=np.float32)
+        valid = np.zeros((len(intervals), len(self.readers)), dtype=bool)
+        starts = intervals.starts
+        ends = intervals.ends
+        # Handles stay pinned for the whole query
+        wigs = []
+        try:
+            for reader in self.readers:
+                wigs.append(reader.acquire())
+            fetches = [reader.value_fetcher(wig) for reader, wig in zip(self.readers, wigs)]
+            for chrom, rows in intervals.group_by_chrom():
+                tracks = [i for i, chrom_lengths in enumerate(self.chrom_lengths) if chrom in chrom_lengths]
+                if not tracks:
+                    warnings.warn('Chromosome {} does not appear in the bigwig'.format(chrom), UserWarning)
+                    continue
+                chrom_length = min(self.chrom_lengths[i][chrom] for i in tracks)
+                if starts[rows].max() > chrom_length:
+                    raise MocaException('Chromsome start point exceeds chromosome length: {}>{}'.format(starts[rows].max(), chrom_length))
+                elif ends[rows].max() > chrom_length:
+                    raise MocaException('Chromsome end point exceeds chromosome length: {}>{}'.format(ends[rows].max(), chrom_length))
+                track_fetches = [(i, fetches[i]) for i in tracks]
+                for row, start, end in zip(rows.tolist(), starts[rows].tolist(), ends[rows].tolist()):
+                    for i, fetch in track_fetches:
+                        scores[row, :, i] = fetch(chrom, start, end)
+                valid[np.ix_(rows, tracks)] = True
+        finally:
+            for reader, wig in zip(self.readers, wigs):
+                reader.release(wig)
+        minus = intervals.strands == -1
+        scores[minus] = scores[minus, ::-1]
+        return scores, valid
+
+    def query_approximate(self, intervals, bins=None, tolerance=None, exact=False):
+        """Query mean scores of bins of each region on all tracks
+
+        Each track is queried with `WigReader.query_approximate`.
+        By default all tracks use the largest number of bins every
+        track's zoom levels can serve, regions narrower than that
+        are read with `query_matrix`, one bin per base.
+
+        Returns
+        -------
+        scores: np.array
+            float32 array of shape (len(intervals), bins, tracks)
+        valid: np.array
+            Boolean mask of shape (len(intervals), tracks)
+        """
+        if bins is None:
+            intervals, width = _equal_width_intervals(intervals)
+            bins = min(reader.approximate_bins(width) for reader in self.readers)
+            if not bins:
+                return self.query_matrix(intervals)
+        results = [reader.query_approximate(intervals, bins=bins, tolerance=tolerance, exact=exact)
+                   for reader in self.readers]
+        scores = np.stack([result[0] for result in results], axis=-1)
+        valid = np.stack([result[1] for result in results], axis=-1)
+        return scores, valid
+
+    @property
+    def get_chromosomes(self):
+        """Return chromosomes appearing in any track and their sizes
+
+        Returns
+        -------
+        chroms: dict
+            Dictionary with {"chr": "Length"} format
+
+        """
+        chroms = {}
+        for chrom_lengths in self.chrom_lengths:
+            for chrom, length in chrom_lengths.items():
+                chroms[chrom] = min(length, chroms.get(chrom, length))
+        return chroms
+
+    def close(self):
+        """Close all tracks"""
+        for reader in self.readers:
+            reader.close()
@@ -0,0 +1,136 @@
+"""Query bigwig files with a pool of worker processes
+
+Intervals are sharded by chromosome (large chromosomes are split
+further) and every worker opens its own handle to the bigwig once.
+Shard results are written back into the rows they came from, so
+output order is that of the input intervals.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import range
+from multiprocessing import Pool
+import warnings
+import numpy as np
+from ..helpers import Intervals
+from ..helpers import MocaException
+from .memmap import open_wig
+from .multi import MultiWigReader
+
+# Maximum intervals in a single shard
+__SHARD_SIZE__ = 20000
+
+# Handle opened once in every worker process
+_worker_wig = None
+
+
+def _open_reader(wig_location):
+    """Open one track, or all tracks of a list with `MultiWigReader`"""
+    if isinstance(wig_location, (list, tuple)):
+        return MultiWigReader(wig_location)
+    return open_wig(wig_location)
+
+
+def _open_worker_wig(wig_location):
+    """Pool initializer, opens the bigwig for the worker"""
+    global _worker_wig
+    _worker_wig = _open_reader(wig_location)
+
+
+def _query_shard(shard):
+    """Query one shard of intervals in a worker"""
+    rows, intervals = shard
+    scores, valid = _worker_wig.query_matrix(intervals)
+    return rows, scores, valid
+
+
+def shard_intervals(intervals, shard_size=__SHARD_SIZE__):
+    """Split intervals into per chromosome shards
+
+    Parameters
+    ----------
+    intervals: Intervals
+        Intervals to split
+    shard_size: int
+        Maximum number of intervals in a shard
+
+    Returns
+    -------
+    shards: list
+        List of (rows, intervals) tuples where rows are
+        positions of the shard intervals in `intervals`
+    """
+    shards = []
+    for _, rows in intervals.group_by_chrom():
+        for i in range(0, len(rows), shard_size):
+            shard_rows = rows[i:i+shard_size]
+            shards.append((shard_rows, intervals[shard_rows]))
+    # Largest shards first so that workers finish together
+    shards.sort(key=lambda shard: -len(shard[0]))
+    return shards
+
+
+def query_matrix_parallel(wig_location, intervals, processes=1, shard_size=__SHARD_SIZE__):
+    """Query regions of equal width for scores using several processes
+
+    Parameters
+    ----------
+    wig_location: str or list
+        Path to bigwig or dense track directory, a list
+        of paths queries all of them with `MultiWigReader`
+    intervals: Intervals or list of tuples
+        Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+    processes: int
+        Number of worker processes
+    shard_size: int
+        Maximum number of intervals queried by a worker at a time
+
+    Returns
+    -------
+    scores: np.array
+        float32 matrix of shape (len(intervals), width) as returned by
+        `WigReader.query_matrix` or (len(intervals), width, tracks) for a list of paths
+    valid: np.array
+        Boolean mask, False for intervals that could not be queried
+    """
+    if not isinstance(intervals, Intervals):
+        intervals = Intervals.from_tuples(intervals)
+    if not processes or processes <= 1 or len(intervals) <= shard_size:
+        wig = _open_reader(wig_location)
+        try:
+            return wig.query_matrix(intervals)
+        finally:
+            wig.close()
+    widths = np.unique(intervals.widths)
+    if len(widths) > 1:
+        raise MocaException('All intervals should have the same width, found: {}'.format(widths))
+    tracks = ()
+    if isinstance(wig_location, (list, tuple)):
+        tracks = (len(wig_location),)
+    scores = np.full((len(intervals), int(widths[0])) + tracks, np.nan, dtype=np.float32)
+    valid = np.zeros((len(intervals),) + tracks, dtype=bool)
+    wig = _open_reader(wig_location)
+    chrom_lengths = wig.get_chromosomes
+    wig.close()
+    missing_chroms = set()
+    shards = []
+    for rows, shard in shard_intervals(intervals, shard_size=shard_size):
+        chrom = shard.chrom_names[shard.records['chrom'][0]]
+        if chrom not in chrom_lengths:
+            # Warn here, warnings raised in workers are not shown
+            if chrom not in missing_chroms:
+                warnings.warn('Chromosome {} does not appear in the bigwig'.format(chrom), UserWarning)
+                missing_chroms.add(chrom)
+            continue
+        shards.append((rows, shard))
+    if not shards:
+        return scores, valid
+    pool = Pool(min(processes, len(shards)), initializer=_open_worker_wig, initargs=(wig_location,))
+    try:
+        for rows, shard_scores, shard_valid in pool.imap_unordered(_query_shard, shards):
+            scores[rows] = shard_scores
+            valid[rows] = shard_valid
+    finally:
+        pool.close()
+        pool.join()
+    return scores, valid
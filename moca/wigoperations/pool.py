@@ -0,0 +1,157 @@
+"""Process-wide pool of open bigwig handles
+
+Opening a bigwig parses its header and index, which is slow for
+multi-gigabyte tracks. Handles are kept open in a pool shared by all
+`WigReader` objects of a process, least recently used handles
+being closed once more than `max_open` files are open.
+Handles pinned by a running query(`acquire`) are only closed
+once released.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+from collections import OrderedDict
+import os
+import threading
+import pyBigWig
+
+# Maximum bigwigs kept open by a process
+__MAX_OPEN_FILES__ = 32
+
+
+class HandlePool(object):
+    """LRU pool of open bigwig handles
+
+    Parameters
+    ----------
+    max_open: int
+        Maximum number of handles kept open
+    """
+    def __init__(self, max_open=__MAX_OPEN_FILES__):
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        # {id(handle): [handle, pin count]} of handles in use
+        self._pins = {}
+        # ids of pinned handles to close once released
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Forget handles inherited from a parent process
+
+        A forked child shares file offsets with its parent,
+        so it must open its own handles.
+        """
+        if os.getpid() != self._pid:
+            self._handles = OrderedDict()
+            self._pins = {}
+            self._retired = set()
+            self._pid = os.getpid()
+
+    def _close_handle(self, handle):
+        """Close a handle now or, if pinned, once released"""
+        if id(handle) in self._pins:
+            self._retired.add(id(handle))
+        else:
+            handle.close()
+
+    def _get(self, location):
+        key = os.path.abspath(location)
+        self._check_fork()
+        handle = self._handles.pop(key, None)
+        if handle is None:
+            handle = pyBigWig.open(location)
+            if handle is None:
+                raise IOError('Unable to open {}'.format(location))
+        self._handles[key] = handle
+        while len(self._handles) > max(self.max_open, 1):
+            _, evicted = self._handles.popitem(last=False)
+            self._close_handle(evicted)
+        return handle
+
+    def get(self, location):
+        """Return an open handle for a bigwig, opening it if needed
+
+        Parameters
+        ----------
+        location: str
+            Path to bigwig
+
+        Returns
+        -------
+        handle: pyBigWig.bigWigFile
+        """
+        with self._lock:
+            return self._get(location)
+
+    def acquire(self, location):
+        """Return an open handle pinned open until `release`
+
+        Parameters
+        ----------
+        location: str
+            Path to bigwig
+
+        Returns
+        -------
+        handle: pyBigWig.bigWigFile
+        """
+        with self._lock:
+            handle = self._get(location)
+            self._pins.setdefault(id(handle), [handle, 0])[1] += 1
+            return handle
+
+    def release(self, handle):
+        """Unpin a handle returned by `acquire`"""
+        with self._lock:
+            pin = self._pins.get(id(handle))
+            if pin is None:
+                return
+            pin[1] -= 1
+            if pin[1] == 0:
+                del self._pins[id(handle)]
+                if id(handle) in self._retired:
+                    self._retired.discard(id(handle))
+                    handle.close()
+
+    def __contains__(self, location):
+        return os.path.abspath(location) in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+    def close(self, location=None):
+        """Close the handle of `location`, or of all bigwigs if None"""
+        with self._lock:
+            self._check_fork()
+            if location is None:
+                keys = list(self._handles.keys())
+            else:
+                keys = [os.path.abspath(location)]
+            for key in keys:
+                handle = self._handles.pop(key, None)
+                if handle is not None:
+                    self._close_handle(handle)
+
+
+_handle_pool = HandlePool()
+
+
+def get_handle_pool():
+    """Return the pool shared by the process"""
+    return _handle_pool
+
+
+def set_max_open_files(max_open):
+    """Change the bound on bigwigs kept open by the process
+
+    Extra handles are closed on the next open.
+
+    Parameters
+    ----------
+    max_open: int
+        Maximum number of handles kept open
+    """
+    _handle_pool.max_open = max_open
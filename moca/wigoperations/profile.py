@@ -0,0 +1,179 @@
+"""Mean profiles of scores accumulated over batches of sites
+
+Only per-position counts, means and sums of squared deviations
+are kept, so memory does not grow with the number of sites.
+Batches are merged with the pairwise update of Chan et al.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from builtins import object
+from builtins import range
+import numpy as np
+from ..helpers import Intervals
+from .parallel import _open_reader
+from .parallel import query_matrix_parallel
+
+# Sites queried at a time
+__PROFILE_BATCH_SIZE__ = 100000
+
+
+class ProfileAccumulator(object):
+    """Running NaN-aware per position count, mean and variance
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of a single site's scores, e.g. (width,) or (width, tracks)
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.total_sites = 0
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self._mean = np.zeros(self.shape, dtype=np.float64)
+        self._m2 = np.zeros(self.shape, dtype=np.float64)
+
+    def update(self, scores):
+        """Add a batch of sites
+
+        Parameters
+        ----------
+        scores: np.array
+            Scores of shape (sites,) + shape, NaN where missing
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        self.total_sites += len(scores)
+        present = ~np.isnan(scores)
+        batch_count = present.sum(axis=0)
+        if not batch_count.any():
+            return
+        values = np.where(present, scores, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batch_mean = values.sum(axis=0) / batch_count
+        batch_mean[batch_count == 0] = 0
+        batch_m2 = (np.where(present, scores - batch_mean, 0) ** 2).sum(axis=0)
+        total = self.count + batch_count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = batch_mean - self._mean
+            weight = np.where(total > 0, batch_count / np.maximum(total, 1), 0)
+            self._m2 += batch_m2 + delta ** 2 * self.count * weight
+            self._mean += delta * weight
+        self.count = total
+
+    @property
+    def mean(self):
+        """Mean at each position, NaN where no site has a score"""
+        mean = self._mean.copy()
+        mean[self.count == 0] = np.nan
+        return mean
+
+    def variance(self, ddof=0):
+        """Variance at each position, NaN where fewer than ddof+1 sites have a score"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self._m2 / (self.count - ddof)
+        variance[self.count <= ddof] = np.nan
+        return variance
+
+
+def _bins_to_bases(scores, width):
+    """Repeat bin means of each site over the bases of the bin
+
+    Bins are laid out as by `pyBigWig.stats`, bin i covering
+    bases [i*width//bins, (i+1)*width//bins).
+    """
+    bins = scores.shape[1]
+    if bins == width:
+        return scores
+    edges = (np.arange(bins + 1) * width) // bins
+    return scores[:, np.searchsorted(edges, np.arange(width), side='right') - 1]
+
+
+def iter_query_matrix(wig_location, intervals, batch_size=__PROFILE_BATCH_SIZE__, processes=1,
+                      approximate=False, tolerance=None):
+    """Query intervals in batches
+
+    Parameters
+    ----------
+    wig_location: str or list
+        Path to bigwig or dense track directory, or a list of them
+    intervals: Intervals or list of tuples
+        Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+    batch_size: int
+        Number of intervals queried at a time
+    processes: int
+        Number of worker processes
+    approximate: bool
+        Read bin means from zoom levels with `WigReader.query_approximate`,
+        every base taking the mean of its bin
+    tolerance: float
+        Maximum error of zoom levels before exact values are read
+
+    Returns
+    -------
+    batches: generator
+        (scores, valid) as returned by `query_matrix_parallel` for each batch
+    """
+    if not isinstance(intervals, Intervals):
+        intervals = Intervals.from_tuples(intervals)
+    if approximate:
+        # Zoom level reads are cheap, a single reader is used
+        widths = np.unique(intervals.widths)
+        width = int(widths[0]) if len(widths) else 0
+        wig = _open_reader(wig_location)
+        try:
+            for start in range(0, len(intervals), batch_size):
+                scores, valid = wig.query_approximate(intervals[start:start+batch_size], tolerance=tolerance)
+                yield _bins_to_bases(scores, width), valid
+        finally:
+            wig.close()
+        return
+    if processes and processes > 1:
+        for start in range(0, len(intervals), batch_size):
+            yield query_matrix_parallel(wig_location, intervals[start:start+batch_size],
+                                        processes=processes)
+        return
+    wig = _open_reader(wig_location)
+    try:
+        for start in range(0, len(intervals), batch_size):
+            yield wig.query_matrix(intervals[start:start+batch_size])
+    finally:
+        wig.close()
+
+
+def query_profile(wig_location, intervals, batch_size=__PROFILE_BATCH_SIZE__, processes=1,
+                  approximate=False, tolerance=None):
+    """Mean, variance and count of scores at each position without keeping all scores
+
+    Parameters
+    ----------
+    wig_location: str or list
+        Path to bigwig or dense track directory, or a list of them
+    intervals: Intervals or list of tuples
+        Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+    batch_size: int
+        Number of intervals queried at a time
+    processes: int
+        Number of worker processes
+    approximate: bool
+        Read bin means from zoom levels instead of base level values
+    tolerance: float
+        Maximum error of zoom levels before exact values are read
+
+    Returns
+    -------
+    profile: ProfileAccumulator
+        Accumulated scores of shape (width,) or (width, tracks) for a list of tracks
+    """
+    if not isinstance(intervals, Intervals):
+        intervals = Intervals.from_tuples(intervals)
+    widths = np.unique(intervals.widths)
+    shape = (int(widths[0]) if len(widths) else 0,)
+    if isinstance(wig_location, (list, tuple)):
+        shape += (len(wig_location),)
+    profile = ProfileAccumulator(shape)
+    for scores, _ in iter_query_matrix(wig_location, intervals, batch_size=batch_size,
+                                       processes=processes, approximate=approximate,
+                                       tolerance=tolerance):
+        # Rows that could not be queried are all NaN and add nothing
+        profile.update(scores)
+    return profile
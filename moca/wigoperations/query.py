@@ -4,26 +4,129 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from builtins import object
+from functools import partial
+import struct
 import warnings
 import numpy as np
 import pyBigWig
 from ..helpers import MocaException
+from ..helpers import Intervals
+from .pool import get_handle_pool
+
+# pyBigWig can return numpy arrays directly if built with numpy support
+__PYBIGWIG_NUMPY__ = bool(getattr(pyBigWig, 'numpy', 0))
+
+# Regions read exactly to estimate error of zoom level summaries
+__CHECK_SITES__ = 100
+
+# Narrowest bin read from zoom levels. libBigWig searches the zoom
+# level index separately for every bin, which costs about as much
+# as reading this many base level values
+__MIN_ZOOM_BIN_WIDTH__ = 4096
+
+__BIGWIG_MAGIC__ = 0x888FFC26
+
+# Sizes of the bigwig header and of each zoom level header
+__BIGWIG_HEADER_SIZE__ = 64
+__ZOOM_HEADER_SIZE__ = 24
+
+
+def read_zoom_levels(wig_location):
+    """Return the reduction levels of a bigwig's zoom levels
+
+    A zoom level with reduction level r summarises bins of at
+    least r bases, so zoom levels only serve queries with bins at
+    least that wide.
+
+    Parameters
+    ----------
+    wig_location: str
+        Path to bigwig
+
+    Returns
+    -------
+    levels: list
+        Reduction levels in bases, ascending. Empty if the bigwig
+        has no zoom levels or is not a local file
+    """
+    try:
+        with open(wig_location, 'rb') as f:
+            header = f.read(__BIGWIG_HEADER_SIZE__)
+            for byte_order in ('<', '>'):
+                magic, _, zoom_levels = struct.unpack(byte_order + 'IHH', header[:8])
+                if magic == __BIGWIG_MAGIC__:
+                    break
+            else:
+                return []
+            zoom_headers = f.read(zoom_levels * __ZOOM_HEADER_SIZE__)
+    except (IOError, OSError, struct.error):
+        return []
+    levels = [struct.unpack_from(byte_order + 'I', zoom_headers, i * __ZOOM_HEADER_SIZE__)[0]
+              for i in range(len(zoom_headers) // __ZOOM_HEADER_SIZE__)]
+    return sorted(levels)
+
+
+def _equal_width_intervals(intervals):
+    """Return intervals as Intervals and their common width"""
+    if not isinstance(intervals, Intervals):
+        intervals = Intervals.from_tuples(intervals)
+    widths = np.unique(intervals.widths)
+    if len(widths) > 1:
+        raise MocaException('All intervals should have the same width, found: {}'.format(widths))
+    return intervals, int(widths[0]) if len(widths) else 0
+
 
 class WigReader(object):
     """Class for reading and querying wigfiles"""
-    def __init__(self, wig_location):
+    def __init__(self, wig_location, pooled=True):
         """
         Arguments
         ---------
         wig_location: Path to bigwig
+        pooled: Share the open handle through the process-wide pool
+                instead of opening a handle owned by this reader
 
         """
         self.wig_location = wig_location
+        self.pooled = pooled
+        self._wig = None
+        self._zoom_levels = None
         try:
-            self.wig = pyBigWig.open(self.wig_location)
+            if pooled:
+                get_handle_pool().get(self.wig_location)
+            else:
+                self._wig = pyBigWig.open(self.wig_location)
         except Exception as e:
             raise MocaException('Error reading wig file: {}'.format(e))
 
+    @property
+    def wig(self):
+        """Open pyBigWig handle"""
+        if self.pooled:
+            return get_handle_pool().get(self.wig_location)
+        return self._wig
+
+    def acquire(self):
+        """Return the open handle, kept open until `release`
+
+        A query holds one handle for all its regions instead of
+        going through the pool for each region.
+        """
+        if self.pooled:
+            return get_handle_pool().acquire(self.wig_location)
+        return self._wig
+
+    def release(self, wig):
+        """Release a handle returned by `acquire`"""
+        if self.pooled:
+            get_handle_pool().release(wig)
+
+    def value_fetcher(self, wig):
+        """Return a function reading scores of (chrom, start, end) from an acquired handle"""
+        if __PYBIGWIG_NUMPY__:
+            return partial(wig.values, numpy=True)
+        return wig.values
+
     def query(self, intervals):
         """ Query regions for scores
 
@@ -40,7 +143,7 @@ class WigReader(object):
         scores = []
         chrom_lengths = self.get_chromosomes
         for chrom, chromStart, chromEnd, strand in intervals:
-            if chrom not in list(chrom_lengths.keys()):
+            if chrom not in chrom_lengths:
                 warnings.warn('Chromosome {} does not appear in the bigwig'.format(chrom), UserWarning)
                 continue
 
@@ -49,12 +152,188 @@ class WigReader(object):
                 raise MocaException('Chromsome start point exceeds chromosome length: {}>{}'.format(chromStart, chrom_length))
             elif int(chromEnd)> chrom_length:
                 raise MocaException('Chromsome end point exceeds chromosome length: {}>{}'.format(chromEnd, chrom_length))
-            score = self.wig.values(chrom, int(chromStart), int(chromEnd))
+            score = self.values(chrom, int(chromStart), int(chromEnd))
             if strand == '-':
-                score.reverse()
+                score = score[::-1]
             scores.append(score)
         return np.array(scores)
 
+    def query_matrix(self, intervals):
+        """Query regions of equal width for scores
+
+        Intervals are grouped by chromosome and scores are filled
+        into a preallocated matrix, minus strand rows reversed.
+        Rows of intervals on chromosomes absent in the bigwig
+        are left as NaN and flagged in the returned mask.
+
+        Parameters
+        ----------
+        intervals: Intervals or list of tuples
+            Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+
+        Returns
+        -------
+        scores: np.array
+            float32 matrix of shape (len(intervals), width)
+        valid: np.array
+            Boolean mask, False for intervals that could not be queried
+        """
+        intervals, width = _equal_width_intervals(intervals)
+        wig = self.acquire()
+        try:
+            return self._query_rows(intervals, width, self.value_fetcher(wig))
+        finally:
+            self.release(wig)
+
+    @property
+    def zoom_levels(self):
+        """Reduction levels of the bigwig's zoom levels, see `read_zoom_levels`"""
+        if self._zoom_levels is None:
+            self._zoom_levels = read_zoom_levels(self.wig_location)
+        return self._zoom_levels
+
+    def approximate_bins(self, width):
+        """Number of bins of a region that can be read from zoom levels
+
+        Parameters
+        ----------
+        width: int
+            Width of region
+
+        Returns
+        -------
+        bins: int
+            Largest number of bins at least as wide as the smallest
+            zoom level and `__MIN_ZOOM_BIN_WIDTH__`, 0 if the region is
+            too narrow for zoom levels to be faster than base level values
+        """
+        if not self.zoom_levels:
+            return 0
+        return width // max(self.zoom_levels[0], __MIN_ZOOM_BIN_WIDTH__)
+
+    def query_approximate(self, intervals, bins=None, tolerance=None, exact=False,
+                          check_sites=__CHECK_SITES__):
+        """Query mean scores of bins of each region from zoom levels
+
+        Bin means are read from the bigwig's zoom level summaries
+        (as `pyBigWig.stats` with exact=False), much faster than base level values.
+        Zoom levels only serve bins at least as wide as the smallest zoom
+        level and each bin costs a separate index search, so by default
+        regions are split into few wide bins (see `approximate_bins`).
+        If `tolerance` is given, bins of upto `check_sites` regions are also
+        read exactly and if the mean absolute error exceeds `tolerance`
+        all regions are read exactly instead.
+
+        Parameters
+        ----------
+        intervals: Intervals or list of tuples
+            Intervals with format (chr, chrStart, chrEnd, strand), all of same width
+        bins: int
+            Number of bins per region (Default: `approximate_bins` of the width.
+            Regions too narrow for zoom levels are read with `query_matrix`,
+            one bin per base)
+        tolerance: float
+            Maximum mean absolute error allowed from zoom levels
+        exact: bool
+            Compute bin means from base level values
+        check_sites: int
+            Number of regions compared with exact values
+
+        Returns
+        -------
+        scores: np.array
+            float32 matrix of shape (len(intervals), bins)
+        valid: np.array
+            Boolean mask, False for intervals that could not be queried
+        """
+        intervals, width = _equal_width_intervals(intervals)
+        if bins is None:
+            bins = self.approximate_bins(width)
+            if not bins:
+                # Zoom levels cannot serve the regions, base level
+                # values are cheapest read in a single call
+                return self.query_matrix(intervals)
+        wig = self.acquire()
+        try:
+            fetch = lambda chrom, start, end: self.bin_means(chrom, start, end, bins, exact=exact, wig=wig)
+            scores, valid = self._query_rows(intervals, bins, fetch)
+            if exact or tolerance is None or not valid.any():
+                return scores, valid
+            rows = np.flatnonzero(valid)
+            rows = rows[np.linspace(0, len(rows)-1, min(check_sites, len(rows))).astype(int)]
+            fetch = lambda chrom, start, end: self.bin_means(chrom, start, end, bins, exact=True, wig=wig)
+            exact_scores, _ = self._query_rows(intervals[rows], bins, fetch)
+        finally:
+            self.release(wig)
+        error = np.abs(scores[rows] - exact_scores)
+        error = np.nanmean(error) if np.any(~np.isnan(error)) else 0
+        if error > tolerance:
+            warnings.warn('Zoom level error {:.4g} exceeds tolerance {}, reading exact values'.format(error, tolerance),
+                          UserWarning)
+            return self.query_approximate(intervals, bins=bins, exact=True)
+        return scores, valid
+
+    def _query_rows(self, intervals, width, fetch):
+        """Fill a matrix with `fetch(chrom, start, end)` of every interval
+
+        Intervals are grouped by chromosome and scores are filled
+        into a preallocated matrix, minus strand rows reversed.
+        """
+        scores = np.full((len(intervals), width), np.nan, dtype=np.float32)
+        valid = np.zeros(len(intervals), dtype=bool)
+        chrom_lengths = self.get_chromosomes
+        starts = intervals.starts
+        ends = intervals.ends
+        for chrom, rows in intervals.group_by_chrom():
+            if chrom not in chrom_lengths:
+                warnings.warn('Chromosome {} does not appear in the bigwig'.format(chrom), UserWarning)
+                continue
+            chrom_length = chrom_lengths[chrom]
+            if starts[rows].max() > chrom_length:
+                raise MocaException('Chromsome start point exceeds chromosome length: {}>{}'.format(starts[rows].max(), chrom_length))
+            elif ends[rows].max() > chrom_length:
+                raise MocaException('Chromsome end point exceeds chromosome length: {}>{}'.format(ends[rows].max(), chrom_length))
+            for row, start, end in zip(rows.tolist(), starts[rows].tolist(), ends[rows].tolist()):
+                scores[row] = fetch(chrom, start, end)
+            valid[rows] = True
+        minus = intervals.strands == -1
+        scores[minus] = scores[minus, ::-1]
+        return scores, valid
+
+    def bin_means(self, chrom, start, end, bins, exact=False, wig=None):
+        """Mean score of equal bins of a region
+
+        Parameters
+        ----------
+        bins: int
+            Number of bins
+        exact: bool
+            Use base level values instead of zoom levels
+        wig: pyBigWig.bigWigFile
+            Handle returned by `acquire` (Default: `wig`)
+
+        Returns
+        -------
+        means: np.array
+            Mean of each bin over covered bases, NaN if not covered
+        """
+        if wig is None:
+            wig = self.wig
+        means = wig.stats(chrom, start, end, type='mean', nBins=bins, exact=exact)
+        return np.array([np.nan if x is None else x for x in means], dtype=np.float32)
+
+    def values(self, chrom, start, end):
+        """Scores at each base of a region
+
+        Returns
+        -------
+        scores: np.array or list
+            Scores from start to end, NaN where not covered
+        """
+        if __PYBIGWIG_NUMPY__:
+            return self.wig.values(chrom, start, end, numpy=True)
+        return self.wig.values(chrom, start, end)
+
     @property
     def get_chromosomes(self):
         """Return list of chromsome and their sizes
@@ -67,3 +346,8 @@ class WigReader(object):
 
         """
         return self.wig.chroms()
+
+    def close(self):
+        """Close the bigwig handle, pooled handles stay open for other readers"""
+        if not self.pooled:
+            self._wig.close()
@@ -10,8 +10,14 @@ from moca import bedoperations, pipeline
 from moca.bedoperations.fimo import get_start_stop_intervals
 from moca.helpers import filename_extension
 from moca.helpers import read_memefile
+from moca.helpers import strip_gz_extension
 from moca.helpers.job_executor import safe_makedir
+from moca.helpers.scores import score_file_paths
+from moca.pipeline.shuffler import background_cache_location
 from moca.plotter import create_plot
+from moca.wigoperations import build_track_cache
+from moca.wigoperations import is_track_cache
+from moca.wigoperations import track_cache_location
 from moca import version
 from tqdm import tqdm
 from click_help_colors import HelpColorsGroup, HelpColorsCommand
@@ -26,6 +32,11 @@ class ProgressBar(object):
                         miniters=1,
                         mininterval=0.01)
 
+    def add_steps(self, count):
+        """Extend the bar by `count` steps"""
+        self.bar.total += count
+        self.bar.refresh()
+
     def show_progress(self, msg):
         self.bar.set_description(msg)
         self.bar.update()
@@ -33,6 +44,22 @@ class ProgressBar(object):
 
     def close(self):
         self.bar.close()
+
+def get_wigfiles(configuration, genome_build, genome_data):
+    """Conservation tracks of a genome, dense tracks if built by `build_tracks`"""
+    wigfiles = {}
+    for key in list(conservation_wig_keys):
+        try:
+            wigfiles[key] = genome_data['{}_wig'.format(key)]
+        except KeyError:
+            continue
+        for dtype in ['float32', 'float16']:
+            track = track_cache_location(configuration, genome_build, key, dtype=dtype)
+            if is_track_cache(track):
+                wigfiles[key] = track
+                break
+    return wigfiles
+
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.group(cls=HelpColorsGroup,
@@ -45,7 +72,7 @@ def cli():
 
 @cli.command('find_motifs', context_settings=CONTEXT_SETTINGS)
 @click.option('--bedfile', '-i',
-              help='Bed file input',
+              help='Bed file input(plain or gzip/bgzip compressed)',
               required=True)
 @click.option('--oc',
               '-o',
@@ -72,7 +99,7 @@ def cli():
 @click.option('--cores',
               '-t',
               default=1,
-              help='Number of parallel MEME jobs',
+              help='Number of parallel MEME jobs and worker processes',
               type=int,
               required=True)
 @click.option('--genome-build',
@@ -83,37 +110,80 @@ def cli():
 @click.option('--show-progress',
               help='Print progress',
               is_flag=True)
+@click.option('--cache-dir',
+              help='Cache directory (Default: .moca_cache beside the output directory)')
+@click.option('--no-cache',
+              help='Do not read or write cached results',
+              is_flag=True)
+@click.option('--tool-cache-size',
+              default=10.0,
+              help='Maximum size in GB of cached MEME/FIMO/CentriMo outputs(least recently used are removed)',
+              type=float)
+@click.option('--keep-intermediates',
+              help='Write sorted, train/test and slopped bed files (for debugging)',
+              is_flag=True)
+@click.option('--native-scanner',
+              help='Scan motifs in-process instead of running fimo',
+              is_flag=True)
+@click.option('--export-text-scores',
+              help='Also write conservation scores as text files',
+              is_flag=True)
+@click.option('--profile-only',
+              help='Save only mean conservation profiles, in constant memory',
+              is_flag=True)
+@click.option('--approximate',
+              help='Read conservation profiles from bigwig zoom levels where sites are wide enough for them to be faster than exact scores (implies --profile-only)',
+              is_flag=True)
+@click.option('--tolerance',
+              default=0.05,
+              help='Maximum mean absolute error of --approximate before reading exact scores',
+              type=float)
+@click.option('--max-tasks',
+              default=1,
+              help='Maximum pipeline stages(MEME, FIMO, scores, plots) running at a time',
+              type=int)
+@click.option('--motif-workers',
+              default=1,
+              help='Number of motifs processed(FIMO, scores, plot) in parallel worker processes',
+              type=int)
 
 def find_motifs(bedfile, oc, configuration, slop_length,
-                flank_motif, n_motif, cores, genome_build, show_progress):
+                flank_motif, n_motif, cores, genome_build, show_progress,
+                cache_dir, no_cache, tool_cache_size, keep_intermediates, native_scanner,
+                export_text_scores, profile_only, approximate, tolerance, max_tasks,
+                motif_workers):
     """Search motifs and create conservation plots"""
     root_dir = os.path.dirname(os.path.abspath(bedfile))
     if not oc:
         moca_out_dir = os.path.join(os.getcwd(), 'moca_output')
     else:
         moca_out_dir = oc
-    moca_pipeline = pipeline.Pipeline(configuration)
+    if no_cache:
+        cache_dir = None
+    elif not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(moca_out_dir)), '.moca_cache')
+    tool_cache_dir = None
+    if cache_dir:
+        tool_cache_dir = os.path.join(cache_dir, 'tools')
+    tool_cache_size = int(tool_cache_size * (1 << 30))
+    moca_pipeline = pipeline.Pipeline(configuration, cache_dir=tool_cache_dir, cache_size=tool_cache_size)
     genome_data = moca_pipeline.get_genome_data(genome_build)
     genome_fasta = genome_data['fasta']
     genome_table = genome_data['genome_table']
 
-    wigfiles = {}
-    for key in list(conservation_wig_keys):
-        try:
-            wigfiles[key] = genome_data['{}_wig'.format(key)]
-        except KeyError:
-            pass
+    wigfiles = get_wigfiles(configuration, genome_build, genome_data)
     safe_makedir(moca_out_dir)
-    bedfile_fn, _ = filename_extension(bedfile)
+    bedfile_fn, _ = filename_extension(strip_gz_extension(bedfile))
 
 
     if show_progress:
-        msg_list = ['Extracting Fasta',
-                    'Running MEME',
-                    'Running CENTRIMO']
-        msg_list_e = ['Generating random Fasta', 'Running fimo random', 'Running fimo main'] + ['Extracting Scores']*len(list(wigfiles.keys())) + ['Creating PLot']
-        msg_list = msg_list + msg_list_e*n_motif
-        progress_bar = ProgressBar(msg_list)
+        # Extended by the number of tasks of each graph once built
+        progress_bar = ProgressBar(['Extracting Fasta'])
+
+        def task_finished(name):
+            progress_bar.show_progress('Finished {}'.format(name))
+    else:
+        task_finished = None
 
 
     query_train_fasta = os.path.join(moca_out_dir,
@@ -123,7 +193,11 @@ def find_motifs(bedfile, oc, configuration, slop_length,
 
     if show_progress:
         progress_bar.show_progress('Extracting Fasta')
-    bed_o = bedoperations.Bedfile(bedfile, genome_table, moca_out_dir)
+    peak_cache_dir = None
+    if cache_dir:
+        peak_cache_dir = os.path.join(cache_dir, 'peaks')
+    bed_o = bedoperations.Bedfile(bedfile, genome_table, moca_out_dir, cache_dir=peak_cache_dir,
+                                  keep_intermediates=keep_intermediates)
     bed_train, bed_test = bed_o.split_train_test_bed(train_peaks_count=500, test_peaks_count=500)
 
     bed_train_slopped  = bed_o.slop_bed(bed_train, flank_length=slop_length)
@@ -135,89 +209,133 @@ def find_motifs(bedfile, oc, configuration, slop_length,
     #memechip_out_dir = os.path.join(moca_out_dir, 'memechip_analysis')
     meme_out_dir = os.path.join(moca_out_dir, 'meme_out')
     memechip_out_dir = meme_out_dir
+    meme_file = os.path.join(meme_out_dir, 'meme.txt')
     meme_params = moca_pipeline.get_meme_default_params
     if cores==1:
         pass
     else:
         meme_params += ' -p {}'.format(cores)
-    if show_progress:
-        progress_bar.show_progress('Running MEME')
 
+    # MEME and the shuffled background(shared by all motifs) only need the training fasta
+    graph = pipeline.TaskGraph(max_workers=max_tasks)
     #meme_run_out = moca_pipeline.run_memechip(fasta_in=query_fasta, out_dir=memechip_out_dir)
-    #
-    meme_run_out = moca_pipeline.run_meme(fasta_in=query_train_fasta,
-                                          out_dir=meme_out_dir,
-                                          strargs=meme_params)
+    graph.add_task('meme', moca_pipeline.run_meme,
+                   kwargs=dict(fasta_in=query_train_fasta, out_dir=meme_out_dir, strargs=meme_params),
+                   inputs=[query_train_fasta], outputs=[meme_out_dir])
+    if cache_dir:
+        background_dir = os.path.join(cache_dir, 'backgrounds')
+        random_fasta = background_cache_location(background_dir, query_train_fasta)
+        graph.add_task('shuffle', moca_pipeline.get_background_fasta,
+                       kwargs=dict(fasta_in=query_train_fasta, cache_dir=background_dir, processes=cores),
+                       inputs=[query_train_fasta], outputs=[random_fasta])
+    else:
+        random_fasta = os.path.join(moca_out_dir, bedfile_fn + '_train_flank_{}_shuffled.fasta'.format(slop_length))
+        graph.add_task('shuffle', moca_pipeline.run_fasta_shuffler,
+                       kwargs=dict(fasta_in=query_train_fasta, fasta_out=random_fasta, processes=cores),
+                       inputs=[query_train_fasta], outputs=[random_fasta])
+    if show_progress:
+        progress_bar.add_steps(len(graph.tasks))
+    meme_run_out = graph.run(on_finish=task_finished)['meme']
     if meme_run_out['stderr']!='':
         sys.stdout.write('Error running MEME: {}'.format(meme_run_out['stderr']))
         sys.exit(1)
-    meme_file = os.path.join(meme_out_dir, 'meme.txt')
     meme_summary = read_memefile(meme_file)
+    motifs = list(range(1, meme_summary['total_motifs']+1))
 
-    if show_progress:
-        progress_bar.show_progress('Running CENTRIMO')
+    # Motif count is known only after MEME, so the remaining stages form a second graph
+    graph = pipeline.TaskGraph(max_workers=max_tasks)
     centrimo_main_dir = os.path.join(moca_out_dir, 'centrimo_out')
-    centrimo_main = moca_pipeline.run_centrimo(meme_file=meme_file,
-                                               fasta_in=query_test_fasta,
-                                               out_dir=centrimo_main_dir)
-    for motif in range(1, meme_summary['total_motifs']+1):
-        fimo_rand_dir = os.path.join(memechip_out_dir, 'fimo_random_{}'.format(motif))
-        fimo_main_dir = os.path.join(memechip_out_dir, 'fimo_out_{}'.format(motif))
-
-        safe_makedir(fimo_rand_dir)
-        random_fasta = os.path.join(fimo_rand_dir, 'random_{}.fa'.format(motif))
-        if show_progress:
-            progress_bar.show_progress('Generating Random Fasta: {}'.format(motif))
-        moca_pipeline.run_fasta_shuffler(fasta_in=query_train_fasta, fasta_out=random_fasta)
-
-        #Random
-        if show_progress:
-            progress_bar.show_progress('Running FIMO Random')
-        fimo_rand = moca_pipeline.run_fimo(motif_file=meme_file,
-                                           motif_num=motif,
-                                           sequence_file=random_fasta,
-                                           out_dir=fimo_rand_dir)
-        #Main
-        if show_progress:
-            progress_bar.show_progress('Running FIMO Main')
-        fimo_main = moca_pipeline.run_fimo(motif_file=meme_file,
-                                           motif_num=motif,
-                                           sequence_file=query_test_fasta,
-                                           out_dir=fimo_main_dir)
-
-
-        fimo_rand_file = os.path.join(fimo_rand_dir, 'fimo.txt')
-        fimo_main_file = os.path.join(fimo_main_dir, 'fimo.txt')
-
-        main_intervals = get_start_stop_intervals(fimo_main_file, flank_length=flank_motif)
-        random_intervals = get_start_stop_intervals(fimo_rand_file, flank_length=flank_motif)
-
-        sample_score_files = []
-        control_score_files = []
-        for key in list(conservation_wig_keys):
-            try:
-                wigfile = wigfiles[key]
-            except KeyError:
-                continue
-            if show_progress:
-                progress_bar.show_progress('Creating plots')
-            sample_score_file = moca_pipeline.save_conservation_scores(main_intervals, wigfile,
-                                                                       fimo_main_dir, out_prefix=key)
-            control_score_file = moca_pipeline.save_conservation_scores(random_intervals, wigfile,
-                                                                        fimo_rand_dir, out_prefix=key)
-            sample_score_files.append(sample_score_file)
-            control_score_files.append(control_score_file)
-        if show_progress:
-            progress_bar.show_progress('Creating Plot')
-        create_plot(mlocalieme_file,
-                    bedfile_fn,
-                    centrimo_dir=centrimo_main_dir,
-                    motif_number=motif,
-                    flank_length=flank_motif,
-                    sample_score_files=sample_score_files,
-                    control_score_files=control_score_files,
-                    reg_plot_titles=[key.capitalize() for key in list(conservation_wig_keys)],
-                    annotate=None)
+    graph.add_task('centrimo', moca_pipeline.run_centrimo,
+                   kwargs=dict(meme_file=meme_file, fasta_in=query_test_fasta, out_dir=centrimo_main_dir),
+                   inputs=[meme_file, query_test_fasta], outputs=[centrimo_main_dir])
+    fimo_main_dirs = {motif: os.path.join(memechip_out_dir, 'fimo_out_{}'.format(motif))
+                      for motif in motifs}
+    fimo_rand_dirs = {motif: os.path.join(memechip_out_dir, 'fimo_random_{}'.format(motif))
+                      for motif in motifs}
+    if native_scanner:
+        # All motifs are scanned in a single pass over each sequence set
+        graph.add_task('scan_main', moca_pipeline.scan_motifs,
+                       kwargs=dict(motif_file=meme_file, sequence_file=query_test_fasta, out_dirs=fimo_main_dirs),
+                       inputs=[meme_file, query_test_fasta], outputs=list(fimo_main_dirs.values()))
+        graph.add_task('scan_random', moca_pipeline.scan_motifs,
+                       kwargs=dict(motif_file=meme_file, sequence_file=random_fasta, out_dirs=fimo_rand_dirs),
+                       inputs=[meme_file, random_fasta], outputs=list(fimo_rand_dirs.values()))
+
+    if motif_workers > 1:
+        # Each motif's chain runs in its own process, writing the same directories
+        graph.add_task('motifs', pipeline.run_motif_chains,
+                       args=(motifs,),
+                       kwargs=dict(workers=motif_workers,
+                                   config_file=configuration,
+                                   meme_file=meme_file,
+                                   sequence_file=query_test_fasta,
+                                   random_fasta=random_fasta,
+                                   wig_files=wigfiles,
+                                   tracks=conservation_wig_keys,
+                                   centrimo_dir=centrimo_main_dir,
+                                   plot_title=bedfile_fn,
+                                   run_fimo=not native_scanner,
+                                   flank_length=flank_motif,
+                                   cache_dir=tool_cache_dir,
+                                   cache_size=tool_cache_size,
+                                   score_options=dict(export_text=export_text_scores,
+                                                      profile_only=profile_only,
+                                                      approximate=approximate,
+                                                      tolerance=tolerance)),
+                       inputs=[meme_file, query_test_fasta, random_fasta],
+                       requires=['centrimo'] + (['scan_main', 'scan_random'] if native_scanner else []))
+    else:
+        # Score tasks of up to max_tasks motifs run at once and share the cores
+        score_processes = max(1, cores // max(1, min(max_tasks, len(motifs))))
+
+        def save_motif_scores(fimo_main_dir, fimo_rand_dir):
+            main_intervals = get_start_stop_intervals(os.path.join(fimo_main_dir, 'fimo.txt'), flank_length=flank_motif)
+            random_intervals = get_start_stop_intervals(os.path.join(fimo_rand_dir, 'fimo.txt'), flank_length=flank_motif)
+            return moca_pipeline.save_multi_conservation_scores([main_intervals, random_intervals],
+                                                                wigfiles,
+                                                                [fimo_main_dir, fimo_rand_dir],
+                                                                processes=score_processes,
+                                                                flank_length=flank_motif,
+                                                                export_text=export_text_scores,
+                                                                profile_only=profile_only,
+                                                                approximate=approximate,
+                                                                tolerance=tolerance)
+
+        for motif in motifs:
+            fimo_rand_dir = fimo_rand_dirs[motif]
+            fimo_main_dir = fimo_main_dirs[motif]
+            if not native_scanner:
+                graph.add_task('fimo_random_{}'.format(motif), moca_pipeline.run_fimo,
+                               kwargs=dict(motif_file=meme_file, motif_num=motif,
+                                           sequence_file=random_fasta, out_dir=fimo_rand_dir),
+                               inputs=[meme_file, random_fasta], outputs=[fimo_rand_dir])
+                graph.add_task('fimo_main_{}'.format(motif), moca_pipeline.run_fimo,
+                               kwargs=dict(motif_file=meme_file, motif_num=motif,
+                                           sequence_file=query_test_fasta, out_dir=fimo_main_dir),
+                               inputs=[meme_file, query_test_fasta], outputs=[fimo_main_dir])
+
+            keys = [key for key in conservation_wig_keys if key in wigfiles]
+            sample_score_files = [score_file_paths(fimo_main_dir, key)['mean'] for key in keys]
+            control_score_files = [score_file_paths(fimo_rand_dir, key)['mean'] for key in keys]
+            graph.add_task('scores_{}'.format(motif), save_motif_scores,
+                           args=(fimo_main_dir, fimo_rand_dir),
+                           inputs=[os.path.join(fimo_main_dir, 'fimo.txt'), os.path.join(fimo_rand_dir, 'fimo.txt')],
+                           outputs=sample_score_files + control_score_files)
+            # matplotlib is not thread safe
+            graph.add_task('plot_{}'.format(motif), create_plot,
+                           args=(meme_file, bedfile_fn),
+                           kwargs=dict(centrimo_dir=centrimo_main_dir,
+                                       motif_number=motif,
+                                       flank_length=flank_motif,
+                                       sample_score_files=sample_score_files,
+                                       control_score_files=control_score_files,
+                                       reg_plot_titles=[key.capitalize() for key in list(conservation_wig_keys)],
+                                       annotate=None),
+                           inputs=[meme_file, os.path.join(centrimo_main_dir, 'centrimo.txt')] + sample_score_files + control_score_files,
+                           exclusive='plot')
+    if show_progress:
+        progress_bar.add_steps(len(graph.tasks))
+    graph.run(on_finish=task_finished)
 
     if show_progress:
         progress_bar.close()
@@ -252,26 +370,40 @@ def find_motifs(bedfile, oc, configuration, slop_length,
               '-g', '-gb',
               help='Key denoting genome build to use in configuration file',
               required=True)
+@click.option('--cores',
+              '-t',
+              default=1,
+              help='Number of processes extracting conservation scores',
+              type=int)
+@click.option('--export-text-scores',
+              help='Also write conservation scores as text files',
+              is_flag=True)
+@click.option('--profile-only',
+              help='Save only mean conservation profiles, in constant memory',
+              is_flag=True)
+@click.option('--approximate',
+              help='Read conservation profiles from bigwig zoom levels where sites are wide enough for them to be faster than exact scores (implies --profile-only)',
+              is_flag=True)
+@click.option('--tolerance',
+              default=0.05,
+              help='Maximum mean absolute error of --approximate before reading exact scores',
+              type=float)
 
 def plot(meme_dir, centrimo_dir, fimo_dir_sample, fimo_dir_control, name,
-         flank_motif, motif, oc, configuration, show_progress, genome_build):
+         flank_motif, motif, oc, configuration, show_progress, genome_build, cores,
+         export_text_scores, profile_only, approximate, tolerance):
     """Create conservation plots"""
     if not oc:
         moca_out_dir = os.path.join(os.getcwd(), 'moca_output')
     else:
         moca_out_dir = oc
     if show_progress:
-        progress_bar = ProgressBar(['Creating Plots']*len(conservation_wig_keys))
+        progress_bar = ProgressBar(['Extracting Scores', 'Creating Plots'])
     moca_pipeline = pipeline.Pipeline(configuration)
     meme_file = os.path.join(meme_dir, 'meme.txt')
     genome_data = moca_pipeline.get_genome_data(genome_build)
 
-    wigfiles = {}
-    for key in list(conservation_wig_keys):
-        try:
-            wigfiles[key] = genome_data['{}_wig'.format(key)]
-        except KeyError:
-            pass
+    wigfiles = get_wigfiles(configuration, genome_build, genome_data)
 
     fimo_control= os.path.join(fimo_dir_control, 'fimo.txt')
     fimo_sample = os.path.join(fimo_dir_sample, 'fimo.txt')
@@ -279,30 +411,61 @@ def plot(meme_dir, centrimo_dir, fimo_dir_sample, fimo_dir_control, name,
     main_intervals = get_start_stop_intervals(fimo_sample, flank_length=flank_motif)
     random_intervals = get_start_stop_intervals(fimo_control, flank_length=flank_motif)
 
-    sample_score_files = []
-    control_score_files = []
-    for key in list(conservation_wig_keys):
-        try:
-            wigfile = wigfiles[key]
-        except KeyError:
-            continue
-        if show_progress:
-            progress_bar.show_progress('Creating plots')
-        sample_score_file = moca_pipeline.save_conservation_scores(main_intervals, wigfile,
-                                                                    fimo_dir_sample, out_prefix=key)
-        control_score_file = moca_pipeline.save_conservation_scores(random_intervals, wigfile,
-                                                                    fimo_dir_control, out_prefix=key)
-        sample_score_files.append(sample_score_file)
-        control_score_files.append(control_score_file)
+    if show_progress:
+        progress_bar.show_progress('Extracting Scores')
+    sample_scores, control_scores = moca_pipeline.save_multi_conservation_scores([main_intervals, random_intervals],
+                                                                                 wigfiles,
+                                                                                 [fimo_dir_sample, fimo_dir_control],
+                                                                                 processes=cores,
+                                                                                 flank_length=flank_motif,
+                                                                                 export_text=export_text_scores,
+                                                                                 profile_only=profile_only,
+                                                                                 approximate=approximate,
+                                                                                 tolerance=tolerance)
+    sample_score_files = [sample_scores[key] for key in conservation_wig_keys if key in wigfiles]
+    control_score_files = [control_scores[key] for key in conservation_wig_keys if key in wigfiles]
+    if show_progress:
+        progress_bar.show_progress('Creating Plots')
     create_plot(meme_file,
                 name,
                 output_dir=moca_out_dir,
                 centrimo_dir=centrimo_dir,
                 motif_number=motif,
                 flank_length=flank_motif,
-                sample_score_files=[sample_score_file],
-                control_score_files=[control_score_file],
+                sample_score_files=sample_score_files,
+                control_score_files=control_score_files,
                 reg_plot_titles=[key.capitalize() for key in list(conservation_wig_keys)],
                 annotate=None)
 
+@cli.command('build_tracks', context_settings=CONTEXT_SETTINGS)
+@click.option('--configuration',
+              '-c',
+              help='Configuration file',
+              required=True)
+@click.option('--genome-build',
+              '-g', '-gb',
+              help='Key denoting genome build to use in configuration file',
+              required=True)
+@click.option('--dtype',
+              default='float32',
+              help='Precision of stored scores',
+              type=click.Choice(['float16', 'float32']))
+@click.option('--force',
+              help='Rebuild tracks that already exist',
+              is_flag=True)
 
+def build_tracks(configuration, genome_build, dtype, force):
+    """Store conservation tracks as memory mapped arrays for faster queries"""
+    moca_pipeline = pipeline.Pipeline(configuration)
+    genome_data = moca_pipeline.get_genome_data(genome_build)
+    for key in list(conservation_wig_keys):
+        try:
+            wigfile = genome_data['{}_wig'.format(key)]
+        except KeyError:
+            continue
+        track = track_cache_location(configuration, genome_build, key, dtype=dtype)
+        if is_track_cache(track) and not force:
+            sys.stdout.write('{} track exists: {}\n'.format(key, track))
+            continue
+        sys.stdout.write('Building {} track: {}\n'.format(key, track))
+        build_track_cache(wigfile, track, dtype=dtype)
@@ -0,0 +1,4 @@
+#!/bin/sh
+echo run >> /root/package/tests/data/generated_out/tool_cache/runs.txt
+mkdir -p $2
+cat $3 > $2/out.txt
@@ -5,11 +5,17 @@ bedoperations_test
 Tests for `moca.bedoperations` module.
 """
 
+import os
+import shutil
 import unittest
 import filecmp
+import gzip
 import pandas as pd
 import numpy as np
 from moca.bedoperations import Bedfile
+from moca.bedoperations.cache import load_peak_cache
+from moca.bedoperations.model import __SORT_COLUMNS__
+from moca.bedoperations.model import __SORT_ASCENDING__
 from moca.helpers import MocaException
 
 class TestBedoperations(unittest.TestCase):
@@ -89,3 +95,106 @@ class TestBedoperations(unittest.TestCase):
         train_bed_file, test_bed_file = loaded_bed.split_train_test_bed()
         assert len(open(train_bed_file).readlines()) == total_peaks/2.0
         assert len(open(test_bed_file).readlines()) == total_peaks/2.0
+
+    def test_compact_dtypes(self):
+        """Test peaks are loaded with compact dtypes"""
+        loaded_bed = Bedfile(self.narrowpeak, self.genome_table, 'tests/data/generated_out')
+        bed_df = loaded_bed.bed_df
+        assert bed_df['chrom'].dtype.name == 'category'
+        assert bed_df['chromStart'].dtype == np.int32
+        assert bed_df['chromEnd'].dtype == np.int32
+        assert bed_df['signalValue'].dtype == np.float32
+        assert bed_df['p-value'].dtype == np.float32
+        assert bed_df['q-value'].dtype == np.float32
+        assert loaded_bed.get_total_peaks == len(open(self.narrowpeak).readlines())
+        assert loaded_bed.get_memory_usage.sum() > 0
+
+    def test_top_peaks(self):
+        """Test partial selection matches a full sort"""
+        bedfile = 'tests/data/ENCSR000AKB/ENCFF002CDP_1000_unsorted.bed'
+        loaded_bed = Bedfile(bedfile, self.genome_table, 'tests/data/generated_out',
+                             keep_intermediates=False)
+        bed_df = loaded_bed.bed_df.sample(frac=1, random_state=0)
+        # Tie the 100th peak's score with peaks ranked after it
+        scores = bed_df['score'].values.copy()
+        ranked = np.argsort(-scores, kind='mergesort')
+        scores[ranked[95:110]] = scores[ranked[95]]
+        bed_df['score'] = scores
+        loaded_bed.bed_df = bed_df
+        expected_df = bed_df.sort_values(__SORT_COLUMNS__, ascending=__SORT_ASCENDING__,
+                                         kind='mergesort').head(100)
+        top_bed_df = loaded_bed.top_peaks(100)
+        assert len(top_bed_df.index) == 100
+        assert np.all(top_bed_df.index == expected_df.index)
+        ranks = loaded_bed.peak_ranks
+        assert np.all(ranks[bed_df.index.get_indexer(expected_df.index)] == np.arange(100))
+        # All peaks tied, ranked by position alone
+        bed_df['score'] = 0
+        loaded_bed.bed_df = bed_df
+        expected_df = bed_df.sort_values(__SORT_COLUMNS__, ascending=__SORT_ASCENDING__,
+                                         kind='mergesort').head(100)
+        top_bed_df = loaded_bed.top_peaks(100)
+        assert np.all(top_bed_df.index == expected_df.index)
+
+    def test_slop_clamp(self):
+        """Test slop clamps intervals to chromosome boundaries"""
+        loaded_bed = Bedfile(self.getfastapeak, 'tests/data/getfasta.gt', 'tests/data/generated_out')
+        train_bed_file, _ = loaded_bed.split_train_test_bed(train_peaks_count=2, test_peaks_count=1)
+        slopped_df = loaded_bed.slop_bed(train_bed_file, flank_length=100, as_dataframe=True)
+        assert list(slopped_df[1]) == [0, 4]
+        assert list(slopped_df[2]) == [111, 205]
+
+    def test_peak_cache(self):
+        """Test peaks loaded from cache match parsed peaks"""
+        bedfile = 'tests/data/ENCSR000AKB/ENCFF002CDP_1000_unsorted.bed'
+        cache_dir = 'tests/data/generated_out/peak_cache'
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        parsed_bed = Bedfile(bedfile, self.genome_table, 'tests/data/generated_out', cache_dir=cache_dir)
+        cached_bed = Bedfile(bedfile, self.genome_table, 'tests/data/generated_out', cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        assert cached_bed.bed_format == parsed_bed.bed_format
+        pd.testing.assert_frame_equal(cached_bed.bed_df, parsed_bed.bed_df)
+        # Numeric columns are views of the cached files
+        cached_df, _ = load_peak_cache(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+        assert isinstance(cached_df['chromStart'].values.base, np.memmap)
+
+    def test_gzipped(self):
+        """Test load gzip compressed bed"""
+        gzipped_bed = 'tests/data/generated_out/narrowPeak.bed.gz'
+        with open(self.narrowpeak, 'rb') as f_in, gzip.open(gzipped_bed, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        loaded_bed = Bedfile(self.narrowpeak, self.genome_table, 'tests/data/generated_out')
+        loaded_gzipped_bed = Bedfile(gzipped_bed, self.genome_table, 'tests/data/generated_out')
+        assert loaded_gzipped_bed.bed_format == 'narrowPeak'
+        pd.testing.assert_frame_equal(loaded_gzipped_bed.bed_df, loaded_bed.bed_df)
+        assert filecmp.cmp('tests/data/generated_out/narrowPeak.sorted','tests/data/expected_out/narrowPeak.sorted')
+
+    def test_peak_index(self):
+        """Test overlap and nearest peak queries"""
+        loaded_bed = Bedfile(self.getfastapeak, 'tests/data/getfasta.gt', 'tests/data/generated_out')
+        intervals = pd.DataFrame({'chrom': ['chr1', 'chr1', 'chr1', 'chr2'],
+                                  'start': [10, 70, 128, 10],
+                                  'end': [11, 75, 135, 20]},
+                                 columns=['chrom', 'start', 'end'])
+        peaks = loaded_bed.overlaps(intervals)
+        names = list(loaded_bed.bed_df['name'].values[peaks[:3]])
+        assert names == ['MACS_peak_1', 'MACS_peak_4', 'MACS_peak_3']
+        assert peaks[3] == -1
+        peaks, distances = loaded_bed.nearest_peak(['chr1', 'chr1'], [50, 120])
+        assert list(loaded_bed.bed_df['name'].values[peaks]) == ['MACS_peak_1', 'MACS_peak_2']
+        assert list(distances) == [40, 16]
+
+    def test_in_memory(self):
+        """Test fasta generated without intermediate files"""
+        loaded_bed = Bedfile(self.getfastapeak, 'tests/data/getfasta.gt',
+                             'tests/data/generated_out', keep_intermediates=False)
+        total_peaks = loaded_bed.get_total_peaks
+        train_bed_df, test_bed_df = loaded_bed.split_train_test_bed(train_peaks_count=total_peaks/2.0,
+                                                                    test_peaks_count=total_peaks/2.0)
+        assert isinstance(train_bed_df, pd.DataFrame)
+        train_slopped = loaded_bed.slop_bed(train_bed_df, flank_length=20)
+        loaded_bed.extract_fasta(bed_in=train_slopped,
+                                 fasta_in='tests/data/getfasta.fa',
+                                 fasta_out='tests/data/generated_out/getfasta.inmemory.fa')
+        assert filecmp.cmp('tests/data/generated_out/getfasta.inmemory.fa', 'tests/data/expected_out/getfasta.fa')
@@ -16,3 +16,30 @@ class TestFastaHelper(unittest.TestCase):
         assert metadata['num_seq'] == 1
         assert metadata['len_seq'] == 205
 
+
+    def test_indexed_fetch(self):
+        """Test indexed fasta slicing across lines"""
+        with fasta.IndexedFasta(self.fasta) as reference:
+            sequence = reference.fetch('chr1', 84, 125)
+        assert sequence == b'TAACCCTAACCTAACCCTAACCCTAACCCTAACCCTAACTC'
+
+    def test_build_index(self):
+        """Test index built from fasta matches .fai"""
+        index = fasta.build_fasta_index(self.fasta)
+        assert index['chr1'] == (205, 6, 41, 42)
+
+    def test_saved_index(self):
+        """Test index is saved next to the fasta and reused"""
+        out_dir = 'tests/data/generated_out/indexed_fasta'
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        fasta_location = os.path.join(out_dir, 'getfasta.fa')
+        shutil.copyfile(self.fasta, fasta_location)
+        with fasta.IndexedFasta(fasta_location) as reference:
+            built_index = reference.index
+        assert os.path.isfile(fasta_location + '.fai')
+        with open(fasta_location + '.fai') as f, open(self.fasta + '.fai') as expected:
+            assert f.read() == expected.read()
+        with fasta.IndexedFasta(fasta_location) as reference:
+            assert reference.index == built_index
@@ -7,13 +7,79 @@ Tests for `moca.bedoperations` module.
 
 import os
 import shutil
+import itertools
+import json
+import threading
+import time
 import unittest
+import numpy as np
 from Bio import SeqIO
 from moca.helpers import get_cpu_count
 from moca.pipeline import Pipeline
+from moca.pipeline import MotifScanner
+from moca.pipeline.motif_scanner import scan_motifs
+from moca.pipeline import shuffle_fasta
+from moca.pipeline import shuffle_sequence
+from moca.pipeline import cached_shuffle_fasta
+from moca.pipeline import TaskGraph
+from moca.pipeline import run_motif_chains
+from moca.pipeline.tool_cache import evict_tool_cache
+from moca.helpers import MocaException
+from moca.helpers import iter_fasta
+from moca.helpers import Intervals
+from moca.helpers import safe_makedir
+from moca.helpers import save_scores
+from moca.helpers import load_scores
+from moca.helpers import read_score_metadata
 from moca.bedoperations import fimo_to_sites
+from moca.bedoperations import get_start_stop_intervals
 from moca.helpers import read_memefile
 
+class Rendezvous(object):
+    """Block threads until `parties` of them are waiting
+
+    Used instead of threading.Barrier, which is Python 3 only.
+    `wait` returns False if the others did not arrive within `timeout` seconds.
+    """
+    def __init__(self, parties, timeout=10):
+        self.parties = parties
+        self.timeout = timeout
+        self.arrived = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.arrived += 1
+            self.condition.notify_all()
+            deadline = time.time() + self.timeout
+            while self.arrived < self.parties:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class RecordingPipeline(Pipeline):
+    """Pipeline recording command lines instead of running them
+
+    Binary lookups wait for all `parties` runs to start, so
+    runs sharing state between threads interleave.
+    """
+    def __init__(self, config_file, parties):
+        super(RecordingPipeline, self).__init__(config_file)
+        self.rendezvous = Rendezvous(parties)
+        self.timed_out = []
+
+    def get_binary_path(self, binary_name):
+        if not self.rendezvous.wait():
+            self.timed_out.append(binary_name)
+        return super(RecordingPipeline, self).get_binary_path(binary_name)
+
+    def _run_tool(self, cmd, binary, input_files, out_dir, cwd=None):
+        return b'', b'', 0, False
+
+
 class TestPipeline(unittest.TestCase):
     """Test pipeline """
 
@@ -101,6 +167,360 @@ class TestPipeline(unittest.TestCase):
         """Smoke test for shuffler"""
         fasta_in = 'tests/data/expected_out/macsPeak.fasta'
         fasta_out = 'tests/data/generated_out/macsPeak.shuffled.fastsa'
+        assert self.pipeline.shuffler_location is None
         output = self.pipeline.run_fasta_shuffler(fasta_in=fasta_in, fasta_out=fasta_out)
+        assert output['cmd'].startswith('native-shuffle')
         with open(fasta_out) as f:
             assert 'chr1' in f.readline()
+
+    def test_multi_conservation_scores(self):
+        """Test sample and control scores are saved for all tracks together"""
+        out_dirs = ['tests/data/generated_out/multi_sample', 'tests/data/generated_out/multi_control']
+        for out_dir in out_dirs:
+            safe_makedir(out_dir)
+        wig_location = 'tests/data/test.bw'
+        sample = Intervals.from_tuples([('1', 0, 3, '-'), ('10', 0, 3, '+')])
+        control = [('1', 150, 153, '+')]
+        mean_files = self.pipeline.save_multi_conservation_scores([sample, control],
+                                                                  {'phylop': wig_location, 'gerp': wig_location},
+                                                                  out_dirs)
+        assert sorted(mean_files[0].keys()) == ['gerp', 'phylop']
+        assert mean_files[1]['gerp'] == os.path.join(out_dirs[1], 'gerp.mean.npy')
+        single_file = self.pipeline.save_conservation_scores(control, wig_location, out_dirs[1],
+                                                             out_prefix='single')
+        np.testing.assert_array_equal(load_scores(mean_files[1]['phylop']), load_scores(single_file))
+        assert load_scores(os.path.join(out_dirs[0], 'phylop.raw.npy')).shape == (2, 3)
+        profile_dirs = ['tests/data/generated_out/profile_sample', 'tests/data/generated_out/profile_control']
+        for out_dir in profile_dirs:
+            safe_makedir(out_dir)
+        profile_files = self.pipeline.save_multi_conservation_scores([sample, control],
+                                                                     {'phylop': wig_location},
+                                                                     profile_dirs, profile_only=True)
+        np.testing.assert_allclose(load_scores(profile_files[0]['phylop']),
+                                   load_scores(mean_files[0]['phylop']), rtol=1e-6)
+        assert not os.path.exists(os.path.join(profile_dirs[0], 'phylop.raw.npy'))
+        assert read_score_metadata(profile_dirs[0], 'phylop')['total_sites'] == 2
+        approximate_files = self.pipeline.save_multi_conservation_scores([sample, control],
+                                                                         {'phylop': wig_location},
+                                                                         profile_dirs, approximate=True,
+                                                                         tolerance=0.05)
+        np.testing.assert_allclose(load_scores(approximate_files[1]['phylop']),
+                                   load_scores(mean_files[1]['phylop']), rtol=1e-6)
+
+    def test_score_files(self):
+        """Test binary score files, their metadata and text export"""
+        out_dir = safe_makedir('tests/data/generated_out/score_files')
+        scores = np.array([[0.5, np.nan, 1.25], [1.5, np.nan, -0.25]], dtype=np.float32)
+        mean_file = save_scores(scores, out_dir, 'phylop', flank_length=5, export_text=True)
+        assert isinstance(load_scores(mean_file), np.memmap)
+        np.testing.assert_array_equal(load_scores(mean_file), [1.0, np.nan, 0.5])
+        metadata = read_score_metadata(out_dir, 'phylop')
+        assert metadata['flank_length'] == 5
+        assert metadata['total_sites'] == 2 and metadata['width'] == 3
+        np.testing.assert_allclose(load_scores(os.path.join(out_dir, 'phylop.raw.txt')), scores)
+
+    def test_dinucleotide_shuffle(self):
+        """Test shuffled sequences preserve dinucleotide counts"""
+        sequence = b'ACGTTGCAAAGGCTTACCGATTAGCNNACGT'
+        dinucleotides = lambda s: sorted(s[i:i+2] for i in range(len(s)-1))
+        shuffled = shuffle_sequence(sequence, kmer=2, rng=np.random.RandomState(7))
+        assert shuffled != sequence
+        assert dinucleotides(shuffled) == dinucleotides(sequence)
+        assert shuffled[0:1] == sequence[0:1] and shuffled[-1:] == sequence[-1:]
+        assert shuffled == shuffle_sequence(sequence, kmer=2, rng=np.random.RandomState(7))
+
+    def test_shuffle_fasta(self):
+        """Test shuffling fasta is seeded and independent of processes"""
+        fasta_in = 'tests/data/expected_out/macsPeak.fasta'
+        serial_out = 'tests/data/generated_out/macsPeak.shuffled.serial.fasta'
+        parallel_out = 'tests/data/generated_out/macsPeak.shuffled.parallel.fasta'
+        total = shuffle_fasta(fasta_in, serial_out, seed=3, processes=1)
+        assert total == shuffle_fasta(fasta_in, parallel_out, seed=3, processes=2)
+        records = list(iter_fasta(serial_out))
+        assert records == list(iter_fasta(parallel_out))
+        for (name, sequence), (shuffled_name, shuffled) in zip(iter_fasta(fasta_in), records):
+            assert shuffled_name == name + '_shuf'
+            assert sorted(sequence) == sorted(shuffled)
+
+    def test_background_cache(self):
+        """Test shuffled background is generated once per fasta, kmer and seed"""
+        fasta_in = 'tests/data/expected_out/macsPeak.fasta'
+        cache_dir = 'tests/data/generated_out/background_cache'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        output = self.pipeline.get_background_fasta(fasta_in, cache_dir, processes=1)
+        assert not output['cached']
+        cached_output = self.pipeline.get_background_fasta(fasta_in, cache_dir, processes=1)
+        assert cached_output['cached']
+        assert cached_output['fasta'] == output['fasta']
+        other_seed, cached = cached_shuffle_fasta(fasta_in, cache_dir, seed=2)
+        assert not cached
+        assert other_seed != output['fasta']
+        assert len(os.listdir(cache_dir)) == 2
+
+    def test_fimoshuffled(self):
+        """Test fimo to sites with shuffled
+        sequence names read in chunks"""
+        fimo_file = 'tests/data/ENCSR000AKB/moca_output/fimo_random_1/fimo.txt'
+        fimo_df = fimo_to_sites(os.path.abspath(fimo_file))
+        fimo_chunked_df = fimo_to_sites(os.path.abspath(fimo_file), chunksize=100)
+        assert fimo_df.equals(fimo_chunked_df)
+        row = fimo_df.iloc[0]
+        chrom, interval = row['sequence name'].replace('_shuf', '').split(':')
+        chrom_start, chrom_end = [int(x) for x in interval.split('-')]
+        assert row['chrom'] == chrom
+        assert row['chromStart'] == chrom_start
+        assert row['chromEnd'] == chrom_end
+        assert row['motifStartZeroBased'] == chrom_start + row['start'] - 1
+        assert row['motifEndOneBased'] == chrom_start + row['stop']
+
+    def test_startstopintervals(self):
+        """Test columnar intervals of fimo hits"""
+        fimo_file = 'tests/data/expected_out/fimo_analysis/fimo.txt'
+        intervals = get_start_stop_intervals(fimo_file, flank_length=5)
+        fimo_df = fimo_to_sites(os.path.abspath(fimo_file))
+        assert len(intervals) == len(fimo_df.index)
+        assert intervals.starts.dtype == np.int64
+        assert intervals.strands.dtype == np.int8
+        assert list(intervals)[0] == ('chr1', 234335-5, 234360+5, '+')
+        assert np.all(intervals.widths == fimo_df['stop'] - fimo_df['start'] + 1 + 10)
+
+    def test_fimo_no_hits(self):
+        """Test fimo output without hits gives empty sites and intervals"""
+        out_dir = 'tests/data/generated_out/fimo_no_hits'
+        safe_makedir(out_dir)
+        fimo_file = os.path.join(out_dir, 'fimo.txt')
+        with open('tests/data/expected_out/fimo_analysis/fimo.txt') as f_in, open(fimo_file, 'w') as f_out:
+            f_out.write(f_in.readline())
+        for chunksize in [None, 100]:
+            fimo_df = fimo_to_sites(os.path.abspath(fimo_file), chunksize=chunksize)
+            assert len(fimo_df.index) == 0
+            assert fimo_df['motifStartZeroBased'].dtype == np.int64
+        intervals = get_start_stop_intervals(fimo_file, flank_length=5)
+        assert len(intervals) == 0
+
+    def test_nativescanner(self):
+        """Test native scanner hits and p-values"""
+        pwm = {'A': [0.97, 0.01, 0.01, 0.01],
+               'C': [0.01, 0.97, 0.01, 0.01],
+               'G': [0.01, 0.01, 0.97, 0.01],
+               'T': [0.01, 0.01, 0.01, 0.97]}
+        bg_frequencies = {'A': 0.3, 'C': 0.2, 'G': 0.2, 'T': 0.3}
+        scanner = MotifScanner(pwm, bg_frequencies, nsites=20)
+        records = [('chr1:100-120', b'GGGGACGTGGGGGGGG'),
+                   ('seq2', b'TTTTTTTTTTACGTNNACG')]
+        fimo_df = scanner.scan(records, threshold=0.01)
+        hits = set(zip(fimo_df['sequence name'], fimo_df['start'], fimo_df['strand']))
+        # ACGT is its own reverse complement
+        assert hits == {('chr1:100-120', 5, '+'), ('chr1:100-120', 5, '-'),
+                        ('seq2', 11, '+'), ('seq2', 11, '-')}
+        assert set(fimo_df['matched sequence']) == {'ACGT'}
+        # Exact p-value of best score by enumerating all 4-mers
+        bases = 'ACGT'
+        codes = dict(zip(bases, range(4)))
+        best_score = scanner.log_odds[[0, 1, 2, 3], [0, 1, 2, 3]].sum()
+        pvalue = 0
+        for kmer in itertools.product(bases, repeat=4):
+            score = sum(scanner.log_odds[codes[b], i] for i, b in enumerate(kmer))
+            if score >= best_score - 1e-9:
+                pvalue += np.prod([bg_frequencies[b] for b in kmer])
+        assert np.allclose(fimo_df['p-value'], pvalue, rtol=0.05)
+
+    def test_multimotifscan(self):
+        """Test scanning several motifs in one pass"""
+        bg_frequencies = {'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25}
+        scanners = []
+        for motif_name, consensus in enumerate(['AAACCC', 'GGGTTA'], 1):
+            pwm = {base: [0.97 if c == base else 0.01 for c in consensus] for base in 'ACGT'}
+            scanners.append(MotifScanner(pwm, bg_frequencies, motif_name=motif_name))
+        records = [('seq1', b'TTAAACCCTT'), ('seq2', b'CCGGGTTACC')]
+        fimo_dfs = scan_motifs(scanners, records, threshold=0.001)
+        for scanner, fimo_df in zip(scanners, fimo_dfs):
+            assert len(fimo_df.index) == 1
+            assert fimo_df.equals(scanner.scan(records, threshold=0.001))
+        assert list(fimo_dfs[0]['sequence name']) == ['seq1']
+        assert list(fimo_dfs[1]['sequence name']) == ['seq2']
+
+    def test_task_graph(self):
+        """Test tasks run after the tasks producing their inputs"""
+        out_dir = safe_makedir('tests/data/generated_out/task_graph')
+        finished = []
+        lock = threading.Lock()
+        # a and b can only pass the rendezvous if they run concurrently
+        rendezvous = Rendezvous(2)
+        timed_out = []
+
+        def write(path, value, wait=False):
+            if wait and not rendezvous.wait():
+                timed_out.append(path)
+            with open(path, 'w') as f:
+                f.write(value)
+            with lock:
+                finished.append(path)
+            return value
+
+        def concat(paths, path_out):
+            for path in paths:
+                assert path in finished
+            value = ''.join(open(path).read() for path in paths)
+            return write(path_out, value)
+
+        a = os.path.join(out_dir, 'a.txt')
+        b = os.path.join(out_dir, 'b.txt')
+        c = os.path.join(out_dir, 'c.txt')
+        graph = TaskGraph(max_workers=2)
+        graph.add_task('c', concat, args=([a, b], c), inputs=[a, b], outputs=[c])
+        graph.add_task('a', write, args=(a, 'A', True), outputs=[a])
+        graph.add_task('b', write, args=(b, 'B', True), outputs=[b])
+        assert graph.dependencies()['c'] == set(['a', 'b'])
+        assert graph.order()[-1] == 'c'
+        results = graph.run()
+        assert results == {'a': 'A', 'b': 'B', 'c': 'AB'}
+        assert timed_out == []
+        assert open(c).read() == 'AB'
+
+    def test_concurrent_fimo(self):
+        """Test fimo runs sharing a pipeline keep their own arguments"""
+        motifs = [1, 2, 3, 4]
+        pipeline = RecordingPipeline(self.configuration_file, parties=len(motifs))
+        graph = TaskGraph(max_workers=len(motifs))
+        out_dirs = {}
+        for motif in motifs:
+            out_dirs[motif] = os.path.abspath('tests/data/generated_out/fimo_out_{}'.format(motif))
+            graph.add_task('fimo_{}'.format(motif), pipeline.run_fimo,
+                           kwargs={'motif_file': 'tests/data/expected_out/meme_analysis/meme.txt',
+                                   'motif_num': motif,
+                                   'sequence_file': self.meme_fasta,
+                                   'out_dir': out_dirs[motif]})
+        results = graph.run()
+        assert pipeline.timed_out == []
+        for motif in motifs:
+            output = results['fimo_{}'.format(motif)]
+            assert output['out_dir'] == out_dirs[motif]
+            assert ' --motif {} -oc {} '.format(motif, out_dirs[motif]) in output['cmd']
+
+    def test_task_graph_errors(self):
+        """Test cyclic dependencies and failed tasks raise"""
+        graph = TaskGraph()
+        graph.add_task('a', len, args=('a',), inputs=['b.txt'], outputs=['a.txt'])
+        graph.add_task('b', len, args=('b',), inputs=['a.txt'], outputs=['b.txt'])
+        self.assertRaises(MocaException, graph.order)
+        self.assertRaises(MocaException, graph.add_task, 'a', len)
+
+        def fail():
+            raise ValueError('failed task')
+        ran = []
+        graph = TaskGraph(max_workers=2)
+        graph.add_task('fail', fail, outputs=['fail_out'])
+        graph.add_task('after', ran.append, args=(1,), inputs=['fail_out/file.txt'])
+        with self.assertRaises(MocaException) as context:
+            graph.run()
+        assert 'failed task' in str(context.exception)
+        assert ran == []
+
+    def test_motif_chains(self):
+        """Test motifs processed in worker processes match a serial run"""
+        fimo_header = '#pattern name\tsequence name\tstart\tstop\tstrand\tscore\tp-value\tq-value\tmatched sequence\n'
+        results = []
+        for workers in [1, 2]:
+            meme_out_dir = 'tests/data/generated_out/motif_chains_{}'.format(workers)
+            safe_makedir(meme_out_dir)
+            shutil.copy('tests/data/expected_out/meme_analysis/meme.txt', meme_out_dir)
+            for motif in [1, 2]:
+                for fimo_dir, chrom in [('fimo_out_{}', '1'), ('fimo_random_{}', '10')]:
+                    fimo_dir = safe_makedir(os.path.join(meme_out_dir, fimo_dir.format(motif)))
+                    with open(os.path.join(fimo_dir, 'fimo.txt'), 'w') as f:
+                        f.write(fimo_header)
+                        f.write('{}\t{}:100-200\t{}\t{}\t+\t10\t1e-5\t1e-3\tACGTAC\n'.format(motif, chrom, 10*motif, 10*motif+5))
+            results.append(run_motif_chains([1, 2], workers=workers, config_file=self.configuration_file,
+                                            meme_file=os.path.join(meme_out_dir, 'meme.txt'),
+                                            sequence_file=None, random_fasta=None,
+                                            wig_files={'phylop': 'tests/data/test.bw'},
+                                            run_fimo=False, flank_length=2))
+        serial, parallel = results
+        assert sorted(parallel.keys()) == [1, 2]
+        for motif in [1, 2]:
+            assert os.path.basename(os.path.dirname(parallel[motif]['sample_score_files'][0])) == 'fimo_out_{}'.format(motif)
+            np.testing.assert_array_equal(load_scores(serial[motif]['sample_score_files'][0]),
+                                          load_scores(parallel[motif]['sample_score_files'][0]))
+        shutil.rmtree(os.path.join('tests/data/generated_out/motif_chains_2', 'fimo_out_2'))
+        with self.assertRaises(MocaException) as context:
+            run_motif_chains([1, 2], workers=2, config_file=self.configuration_file,
+                             meme_file='tests/data/generated_out/motif_chains_2/meme.txt',
+                             sequence_file=None, random_fasta=None,
+                             wig_files={'phylop': 'tests/data/test.bw'}, run_fimo=False)
+        assert 'Motif 2 failed' in str(context.exception)
+        assert 'Motif 1' not in str(context.exception)
+
+    def test_tool_cache(self):
+        """Test program runs are restored from cache"""
+        out_dir = 'tests/data/generated_out/tool_cache'
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        out_dir = os.path.abspath(safe_makedir(out_dir))
+        tool = os.path.join(out_dir, 'tool.sh')
+        runs = os.path.join(out_dir, 'runs.txt')
+        with open(tool, 'w') as f:
+            f.write('#!/bin/sh\necho run >> {}\nmkdir -p $2\ncat $3 > $2/out.txt\n'.format(runs))
+        os.chmod(tool, 0o755)
+        fasta = os.path.join(out_dir, 'in.fa')
+        with open(fasta, 'w') as f:
+            f.write('>seq\nACGT\n')
+        pipeline = Pipeline(self.configuration_file, cache_dir=os.path.join(out_dir, 'cache'))
+
+        def run(run_dir):
+            run_dir = os.path.join(out_dir, run_dir)
+            cmd = '{} -oc {} {}'.format(tool, run_dir, fasta)
+            output = pipeline._run_tool(cmd, tool, [fasta], run_dir)
+            assert open(os.path.join(run_dir, 'out.txt')).read() == open(fasta).read()
+            return output[3]
+
+        assert not run('first')
+        assert run('second')
+        assert len(open(runs).readlines()) == 1
+        with open(fasta, 'w') as f:
+            f.write('>seq\nTTTT\n')
+        assert not run('third')
+        assert len(open(runs).readlines()) == 2
+        entries = sorted(os.listdir(pipeline.cache_dir))
+        assert len(entries) == 2
+        # Least recently used run is evicted first
+        os.utime(os.path.join(pipeline.cache_dir, entries[0], 'size'), (0, 0))
+        os.utime(os.path.join(pipeline.cache_dir, entries[1], 'size'), (1, 1))
+        sizes = [int(open(os.path.join(pipeline.cache_dir, entry, 'size')).read()) for entry in entries]
+        # Runs cached with an older layout are always evicted
+        stale = safe_makedir(os.path.join(pipeline.cache_dir, entries[0].split('_v')[0] + '_v1'))
+        with open(os.path.join(stale, 'result.json'), 'w') as f:
+            json.dump({'stdout': '', 'stderr': ''}, f)
+        assert evict_tool_cache(pipeline.cache_dir, max_size=sum(sizes)) == [stale]
+        evicted = evict_tool_cache(pipeline.cache_dir, max_size=sizes[1])
+        assert [os.path.basename(x) for x in evicted] == [entries[0]]
+        assert os.listdir(pipeline.cache_dir) == [entries[1]]
+
+    def test_meme_cache(self):
+        """Test cached meme runs are restored without starting meme"""
+        out_dir = 'tests/data/generated_out/meme_cache'
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        out_dir = os.path.abspath(safe_makedir(out_dir))
+        with open(os.path.join(out_dir, 'meme'), 'w') as f:
+            f.write('#!/bin/sh\nwhile [ $# -gt 1 ]; do [ "$1" = "-oc" ] && out=$2; shift; done\n'
+                    'mkdir -p $out\ncat $1 > $out/meme.txt\n')
+        os.chmod(os.path.join(out_dir, 'meme'), 0o755)
+        parallel_checks = []
+
+        class LocalMemePipeline(Pipeline):
+            def get_binary_path(self, binary_name):
+                return out_dir
+
+            def can_run_meme_parallel(self, cmd):
+                parallel_checks.append(cmd)
+                return True
+
+        pipeline = LocalMemePipeline(self.configuration_file, cache_dir=os.path.join(out_dir, 'cache'))
+        first = pipeline.run_meme(self.meme_fasta, out_dir=os.path.join(out_dir, 'first'), strargs='-dna')
+        assert not first['cached'] and len(parallel_checks) == 1
+        assert ' -p {} '.format(pipeline.cpu_cores) in first['cmd']
+        # A different process count is the same run
+        second = pipeline.run_meme(self.meme_fasta, out_dir=os.path.join(out_dir, 'second'), strargs='-dna -p 3')
+        assert second['cached'] and len(parallel_checks) == 1
+        assert os.path.isfile(os.path.join(out_dir, 'second', 'meme.txt'))
@@ -5,10 +5,23 @@ test_wigoperations
 Tests for `moca.wigoperations` module.
 """
 
+import shutil
 import unittest
 import warnings
 import numpy as np
+import pyBigWig
 from moca.wigoperations import WigReader
+from moca.wigoperations import query_matrix_parallel
+from moca.wigoperations import MemmapWigReader
+from moca.wigoperations import build_track_cache
+from moca.wigoperations import MultiWigReader
+from moca.wigoperations import ProfileAccumulator
+from moca.wigoperations import query_profile
+from moca.wigoperations import HandlePool
+from moca.wigoperations import get_handle_pool
+from moca.wigoperations import read_zoom_levels
+from moca.wigoperations.query import __MIN_ZOOM_BIN_WIDTH__
+from moca.wigoperations.profile import _bins_to_bases
 
 class TestWigoperations(unittest.TestCase):
     """Test Wigoperations"""
@@ -29,6 +42,148 @@ class TestWigoperations(unittest.TestCase):
                           [1.5]])
         np.equal(expected_scores, scores)
 
+    def test_query_matrix(self):
+        """Test wig query into a single matrix"""
+        loaded_wig = WigReader(self.wig_location)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            scores, valid = loaded_wig.query_matrix([("1", 0, 3, '-'), ("M", 0, 3, '+'), ("1", 0, 3, '+')])
+            assert len(w) == 1
+        assert scores.dtype == np.float32
+        assert list(valid) == [True, False, True]
+        np.testing.assert_allclose(scores[0], [0.3, 0.2, 0.1], rtol=1e-6)
+        np.testing.assert_allclose(scores[2], [0.1, 0.2, 0.3], rtol=1e-6)
+        assert np.isnan(scores[1]).all()
+
+    def test_query_parallel(self):
+        """Test sharded query matches serial query in input order"""
+        intervals = [("10", 5, 8, '+'), ("1", 0, 3, '-'), ("M", 0, 3, '+'),
+                     ("1", 150, 153, '+'), ("10", 0, 3, '-'), ("1", 0, 3, '+')]
+        loaded_wig = WigReader(self.wig_location)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            expected_scores, expected_valid = loaded_wig.query_matrix(intervals)
+            scores, valid = query_matrix_parallel(self.wig_location, intervals,
+                                                  processes=2, shard_size=1)
+        np.testing.assert_array_equal(valid, expected_valid)
+        np.testing.assert_array_equal(scores, expected_scores)
+
+    def test_memmap_track(self):
+        """Test dense track gives the same scores as the bigwig"""
+        wig_location = 'tests/data/generated_out/small.bw'
+        track_location = 'tests/data/generated_out/small_track'
+        small_wig = pyBigWig.open(wig_location, 'w')
+        small_wig.addHeader([('1', 1000), ('10', 500)])
+        small_wig.addEntries(['1', '1'], [0, 150], ends=[3, 160], values=[0.1, 1.5])
+        small_wig.addEntries('10', 10, values=[0.5, -0.25, 2.0], span=1, step=1)
+        small_wig.close()
+        build_track_cache(wig_location, track_location, chunk_size=128)
+        track = MemmapWigReader(track_location)
+        loaded_wig = WigReader(wig_location)
+        assert track.get_chromosomes == loaded_wig.get_chromosomes
+        intervals = [("1", 0, 3, '-'), ("1", 148, 151, '+'), ("10", 10, 13, '-')]
+        track_scores, track_valid = track.query_matrix(intervals)
+        scores, valid = loaded_wig.query_matrix(intervals)
+        np.testing.assert_array_equal(track_valid, valid)
+        np.testing.assert_array_equal(track_scores, scores)
+        scores, _ = query_matrix_parallel(track_location, intervals * 2, processes=2, shard_size=1)
+        np.testing.assert_array_equal(scores[:3], track_scores)
+
+    def test_multi_track(self):
+        """Test reading several tracks in one pass"""
+        intervals = [("1", 0, 3, '-'), ("M", 0, 3, '+'), ("10", 0, 3, '+')]
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            scores, valid = WigReader(self.wig_location).query_matrix(intervals)
+            multi_scores, multi_valid = MultiWigReader([self.wig_location, self.wig_location]).query_matrix(intervals)
+            parallel_scores, parallel_valid = query_matrix_parallel([self.wig_location, self.wig_location],
+                                                                    intervals, processes=2, shard_size=1)
+        assert multi_scores.shape == (3, 3, 2)
+        for track in range(2):
+            np.testing.assert_array_equal(multi_scores[:, :, track], scores)
+            np.testing.assert_array_equal(multi_valid[:, track], valid)
+        np.testing.assert_array_equal(parallel_scores, multi_scores)
+        np.testing.assert_array_equal(parallel_valid, multi_valid)
+
+    def test_profile_accumulator(self):
+        """Test streaming mean and variance match the full matrix"""
+        scores = np.random.RandomState(0).normal(size=(50, 4))
+        scores[::3, 1] = np.nan
+        scores[:, 3] = np.nan
+        profile = ProfileAccumulator((4,))
+        for start in range(0, 50, 7):
+            profile.update(scores[start:start+7])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            np.testing.assert_allclose(profile.mean, np.nanmean(scores, axis=0))
+            np.testing.assert_allclose(profile.variance(), np.nanvar(scores, axis=0))
+        assert list(profile.count) == [50, 33, 50, 0]
+        assert profile.total_sites == 50
+
+    def test_query_profile(self):
+        """Test profile of queried intervals in batches"""
+        intervals = [("1", 0, 3, '-'), ("1", 150, 153, '+'), ("10", 0, 3, '+')]
+        scores, valid = WigReader(self.wig_location).query_matrix(intervals)
+        profile = query_profile(self.wig_location, intervals, batch_size=2)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            np.testing.assert_allclose(profile.mean, np.nanmean(scores[valid], axis=0), rtol=1e-6)
+        assert profile.total_sites == 3
+
+    def test_query_approximate(self):
+        """Test bin means from zoom levels and exact fallback"""
+        loaded_wig = WigReader(self.wig_location)
+        intervals = [("1", 0, 6, '-'), ("1", 150, 156, '+')]
+        scores, valid = loaded_wig.query_approximate(intervals, bins=3, tolerance=0.01)
+        assert scores.shape == (2, 3) and valid.all()
+        np.testing.assert_allclose(scores[0], [np.nan, 0.3, 0.15], rtol=1e-6)
+        exact_scores, _ = loaded_wig.query_approximate(intervals, bins=3, exact=True)
+        np.testing.assert_allclose(scores, exact_scores, rtol=1e-6)
+        # Too narrow for zoom levels, read per base
+        per_base, _ = loaded_wig.query_approximate(intervals)
+        np.testing.assert_allclose(per_base, loaded_wig.query_matrix(intervals)[0], rtol=1e-6)
+
+    def test_approximate_bins(self):
+        """Test bins read from zoom levels are at least as wide as the smallest level"""
+        loaded_wig = WigReader(self.wig_location)
+        assert read_zoom_levels(self.wig_location) == [400]
+        assert loaded_wig.approximate_bins(6) == 0
+        assert loaded_wig.approximate_bins(10000) == 10000 // __MIN_ZOOM_BIN_WIDTH__
+        assert read_zoom_levels('tests/data/generated_out/missing.bw') == []
+        # Profiles repeat each bin mean over the bases of the bin
+        bases = _bins_to_bases(np.array([[1, 2, 3]], dtype=np.float32), 7)
+        assert list(bases[0]) == [1, 1, 2, 2, 3, 3, 3]
+
+    def test_handle_pool(self):
+        """Test handles are shared and least recently used are closed"""
+        first = WigReader(self.wig_location)
+        second = WigReader(self.wig_location)
+        assert first.wig is second.wig
+        assert self.wig_location in get_handle_pool()
+        first.close()
+        assert second.get_chromosomes == {'1': 195471971, '10': 130694993}
+        own = WigReader(self.wig_location, pooled=False)
+        assert own.wig is not first.wig
+        own.close()
+        copy_location = 'tests/data/generated_out/test_copy.bw'
+        shutil.copyfile(self.wig_location, copy_location)
+        pool = HandlePool(max_open=1)
+        handle = pool.get(self.wig_location)
+        assert pool.get('tests/data/../data/test.bw') is handle
+        pool.get(copy_location)
+        assert len(pool) == 1
+        assert copy_location in pool and self.wig_location not in pool
+        pool.close()
+        assert len(pool) == 0
+        # A pinned handle survives eviction until released
+        pinned = pool.acquire(self.wig_location)
+        pool.get(copy_location)
+        assert self.wig_location not in pool
+        assert len(pinned.values('1', 0, 3)) == 3
+        pool.release(pinned)
+        self.assertRaises(RuntimeError, pinned.values, '1', 0, 3)
+        pool.close()
+
     def test_chroms(self):
         loaded_wig = WigReader(self.wig_location)
         assert loaded_wig.get_chromosomes == {'1': 195471971, '10': 130694993}